@@ -0,0 +1,67 @@
+"""Small in-process caches shared by the request handlers."""
+import time
+from collections import OrderedDict
+
+MISSING = object()
+
+
+class TTLCache:
+    """LRU-bounded mapping whose entries expire after a fixed TTL
+
+    Intended for use from a single event loop, so no locking is done.
+    Cached values may be None; use MISSING to tell a miss from a cached None.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 30.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, record=False) is not MISSING
+
+    def get(self, key, default=MISSING, record: bool = True):
+        """Return the cached value, or default if missing or expired"""
+        item = self._data.get(key)
+        if item is not None:
+            expires_at, value = item
+            if expires_at > time.monotonic():
+                self._data.move_to_end(key)
+                if record:
+                    self.hits += 1
+                return value
+            del self._data[key]
+        if record:
+            self.misses += 1
+        return default
+
+    def set(self, key, value, ttl: float = None):
+        """Store a value, evicting the least recently used entries if full"""
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        """Drop a single entry"""
+        self._data.pop(key, None)
+
+    def clear(self):
+        """Drop every entry"""
+        self._data.clear()
+
+    def stats(self):
+        """Hit/miss counters and current size"""
+        total = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
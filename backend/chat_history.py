@@ -0,0 +1,89 @@
+"""Chat history previews and keyset pagination helpers."""
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+PREVIEW_LENGTH = 120
+
+# Full records without the stored previews
+FULL_PROJECTION = {"_id": 0, "user_message_preview": 0, "assistant_response_preview": 0}
+
+# Sidebar rows: previews only, no message bodies
+SUMMARY_PROJECTION = {
+    "_id": 0,
+    "chat_id": 1,
+    "session_id": 1,
+    "timestamp": 1,
+    "api_key_source": 1,
+    "user_message_preview": 1,
+    "assistant_response_preview": 1
+}
+
+# Sort matching the (user_id, timestamp desc, chat_id desc) index
+HISTORY_SORT = [("timestamp", -1), ("chat_id", -1)]
+
+
+def make_preview(text: str, length: int = PREVIEW_LENGTH):
+    """Truncate a message body for list views"""
+    text = text or ""
+    if len(text) <= length:
+        return text
+    return text[:length - 1].rstrip() + "…"
+
+
+def add_previews(chat_record: dict):
+    """Store truncated previews alongside the full message bodies"""
+    chat_record["user_message_preview"] = make_preview(chat_record.get("user_message"))
+    chat_record["assistant_response_preview"] = make_preview(chat_record.get("assistant_response"))
+    return chat_record
+
+
+def encode_cursor(chat: dict):
+    """Cursor pointing at a chat, as '<iso timestamp>,<chat_id>'"""
+    return f"{chat['timestamp'].isoformat()},{chat['chat_id']}"
+
+
+def decode_cursor(cursor: str):
+    """Parse a cursor from encode_cursor; raises ValueError if malformed"""
+    timestamp, chat_id = cursor.split(",", 1)
+    if not chat_id:
+        raise ValueError("Cursor is missing a chat_id")
+    return datetime.fromisoformat(timestamp), chat_id
+
+
+def history_query(user_id: str, before: str = None):
+    """Filter for one page of a user's chats older than the cursor"""
+    query = {"user_id": user_id}
+    if before:
+        timestamp, chat_id = decode_cursor(before)
+        query["$or"] = [
+            {"timestamp": {"$lt": timestamp}},
+            {"timestamp": timestamp, "chat_id": {"$lt": chat_id}}
+        ]
+    return query
+
+
+async def backfill_previews(chats_collection, batch_size: int = 500):
+    """Add previews to chats stored before previews existed"""
+    count = 0
+    cursor = chats_collection.find(
+        {"user_message_preview": {"$exists": False}},
+        {"_id": 1, "user_message": 1, "assistant_response": 1}
+    ).batch_size(batch_size)
+    async for chat in cursor:
+        previews = add_previews({
+            "user_message": chat.get("user_message"),
+            "assistant_response": chat.get("assistant_response")
+        })
+        await chats_collection.update_one(
+            {"_id": chat["_id"]},
+            {"$set": {
+                "user_message_preview": previews["user_message_preview"],
+                "assistant_response_preview": previews["assistant_response_preview"]
+            }}
+        )
+        count += 1
+    if count:
+        logger.info("Backfilled previews on %s chats", count)
+    return count
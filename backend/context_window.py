@@ -0,0 +1,182 @@
+"""Token-budgeted context assembly for conversation threads.
+
+Each stored message carries a `tokens` field counted once when the turn is
+written, so building the prompt for the next turn is a sum over cached
+integers rather than a re-tokenization of the whole thread. Older turns are
+dropped until system prompt, history and the new message fit the model's
+budget.
+
+Counting uses tiktoken when it is installed and its encoding loads, and
+falls back to a characters-per-token estimate otherwise. Loading an
+encoding may download and parse its BPE file, so the server preloads the
+chat model's counter in a thread at startup rather than on a request.
+"""
+import asyncio
+import logging
+import os
+
+from summaries import summary_message
+
+try:
+    import tiktoken
+except ImportError:  # pragma: no cover - depends on the environment
+    tiktoken = None
+
+# Per-message framing overhead in the chat completions format
+MESSAGE_OVERHEAD = 4
+# Tokens kept free for the reply, subtracted from the model's context size
+DEFAULT_BUDGETS = {
+    "gpt-4": 8192 - 1024,
+    "gpt-4-32k": 32768 - 2048,
+    "gpt-4-turbo": 128000 - 4096,
+    "gpt-4o": 128000 - 4096,
+    "gpt-4o-mini": 128000 - 4096,
+    "gpt-3.5-turbo": 16385 - 1024,
+}
+FALLBACK_BUDGET = 4096 - 512
+CHARS_PER_TOKEN = 4
+
+logger = logging.getLogger(__name__)
+
+
+def parse_budgets(value: str):
+    """Parse "model=tokens,model=tokens" overrides, e.g. from CONTEXT_TOKEN_BUDGETS"""
+    budgets = {}
+    for item in (value or "").split(","):
+        if not item.strip():
+            continue
+        model, _, tokens = item.partition("=")
+        budgets[model.strip()] = int(tokens)
+    return budgets
+
+
+def load_encoding(model: str):
+    """The model's tiktoken encoding (cl100k_base for unknown models), or None without tiktoken"""
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+class TokenCounter:
+    """Counts tokens for one model"""
+
+    def __init__(self, model: str, loader=None):
+        self.model = model
+        try:
+            self.encoding = (loader or load_encoding)(model)
+        except Exception as e:
+            # E.g. the BPE file cannot be downloaded: estimate rather than fail chats
+            logger.warning("Token encoding for %s unavailable, estimating counts: %s", model, e)
+            self.encoding = None
+
+    def count(self, text: str):
+        if self.encoding is not None:
+            return len(self.encoding.encode(text, disallowed_special=()))
+        return len(text) // CHARS_PER_TOKEN + 1
+
+    def count_message(self, content: str):
+        return self.count(content) + MESSAGE_OVERHEAD
+
+
+class ContextBuilder:
+    """Builds upstream prompts that fit a per-model token budget"""
+
+    def __init__(self, budgets: dict = None, counter_factory=TokenCounter):
+        self.budgets = {**DEFAULT_BUDGETS, **(budgets or {})}
+        self.counter_factory = counter_factory
+        self._counters = {}
+        self._fixed = {}
+
+    @classmethod
+    def from_env(cls):
+        return cls(parse_budgets(os.environ.get('CONTEXT_TOKEN_BUDGETS', '')))
+
+    def counter(self, model: str):
+        counter = self._counters.get(model)
+        if counter is None:
+            counter = self._counters[model] = self.counter_factory(model)
+        return counter
+
+    async def preload(self, models):
+        """Create the models' counters in a thread, off the event loop"""
+        for model in models:
+            if model not in self._counters:
+                self._counters[model] = await asyncio.to_thread(self.counter_factory, model)
+
+    def budget(self, model: str):
+        return self.budgets.get(model, FALLBACK_BUDGET)
+
+    def count(self, model: str, content: str):
+        return self.counter(model).count_message(content)
+
+    def count_fixed(self, model: str, content: str):
+        """Count a message that repeats on every request, such as the system prompt"""
+        key = (model, content)
+        tokens = self._fixed.get(key)
+        if tokens is None:
+            tokens = self._fixed[key] = self.count(model, content)
+        return tokens
+
+    def ensure_counts(self, model: str, docs):
+        """Fill in `tokens` on messages stored before counts were cached
+
+        Returns the documents that were counted so the caller can persist them.
+        """
+        counted = []
+        for doc in docs:
+            if doc.get("tokens") is None:
+                doc["tokens"] = self.count(model, doc["content"])
+                counted.append(doc)
+        return counted
+
+    def build(self, model: str, system_prompt: str, history, user_message: str, user_tokens: int = None,
+              summary: dict = None):
+        """Assemble system prompt, conversation summary, the newest history that
+        fits, and the new message
+
+        Returns (messages, info); info has prompt_tokens, user_tokens, kept and
+        dropped message counts and the documents whose counts were computed here.
+        """
+        counted = self.ensure_counts(model, history)
+        if user_tokens is None:
+            user_tokens = self.count(model, user_message)
+        remaining = self.budget(model) - self.count_fixed(model, system_prompt) - user_tokens
+        if summary:
+            remaining -= summary["tokens"] + MESSAGE_OVERHEAD
+
+        # Walk back from the newest message while the budget allows
+        first = len(history)
+        while first > 0 and history[first - 1]["tokens"] <= remaining:
+            first -= 1
+            remaining -= history[first]["tokens"]
+        # Never open the context with a dangling assistant reply
+        while first < len(history) and history[first]["role"] != "user":
+            remaining += history[first]["tokens"]
+            first += 1
+
+        kept = history[first:]
+        messages = [{"role": "system", "content": system_prompt}]
+        if summary:
+            messages.append(summary_message(summary))
+        messages.extend({"role": doc["role"], "content": doc["content"]} for doc in kept)
+        messages.append({"role": "user", "content": user_message})
+        return messages, {
+            "prompt_tokens": self.budget(model) - remaining,
+            "user_tokens": user_tokens,
+            "kept": len(kept),
+            "dropped": first,
+            "counted": counted,
+        }
+
+
+async def store_token_counts(messages_collection, docs):
+    """Persist counts computed for legacy messages so they are never recounted"""
+    if not docs:
+        return
+    await asyncio.gather(*(
+        messages_collection.update_one({"message_id": doc["message_id"]}, {"$set": {"tokens": doc["tokens"]}})
+        for doc in docs
+    ))
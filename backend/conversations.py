@@ -0,0 +1,89 @@
+"""Conversation threads stored in the messages collection.
+
+Each chat turn appends a user and an assistant message tagged with the
+conversation_id. Context for the next turn is the last N turns, fetched with
+a single query on the (conversation_id, timestamp desc, _id desc) index.
+"""
+import uuid
+from datetime import datetime
+
+from pymongo import ReturnDocument
+
+# Newest first; _id breaks ties between messages written in the same batch
+RECENT_SORT = [("timestamp", -1), ("_id", -1)]
+MESSAGE_PROJECTION = {"_id": 0, "message_id": 1, "role": 1, "content": 1, "tokens": 1, "timestamp": 1}
+TITLE_LENGTH = 80
+
+
+def new_conversation_id():
+    return str(uuid.uuid4())
+
+
+async def load_recent_messages(messages_collection, conversation_id: str, user_id: str, turns: int,
+                               projection: dict = MESSAGE_PROJECTION):
+    """Last `turns` user/assistant pairs of a conversation, oldest first"""
+    if turns <= 0:
+        return []
+    limit = turns * 2
+    docs = await messages_collection.find(
+        {"conversation_id": conversation_id, "user_id": user_id},
+        projection
+    ).sort(RECENT_SORT).limit(limit).to_list(length=limit)
+    docs.reverse()
+    return docs
+
+
+def to_chat_messages(docs):
+    """Convert stored messages to OpenAI chat message dicts"""
+    return [{"role": doc["role"], "content": doc["content"]} for doc in docs]
+
+
+def build_turn(conversation_id: str, user_id: str, user_message: str, response: str, tokens=(None, None), **extra):
+    """The pair of message documents recorded for one exchange
+
+    tokens holds the (user, assistant) token counts cached on each message.
+    """
+    now = datetime.utcnow()
+    return [
+        {
+            "message_id": str(uuid.uuid4()),
+            "conversation_id": conversation_id,
+            "user_id": user_id,
+            "role": "user",
+            "content": user_message,
+            "tokens": tokens[0],
+            "timestamp": now,
+            **extra
+        },
+        {
+            "message_id": str(uuid.uuid4()),
+            "conversation_id": conversation_id,
+            "user_id": user_id,
+            "role": "assistant",
+            "content": response,
+            "tokens": tokens[1],
+            "timestamp": now,
+            **extra
+        }
+    ]
+
+
+async def append_turn(messages_collection, conversations_collection, conversation_id: str, user_id: str,
+                      user_message: str, response: str, tokens=(None, None), **extra):
+    """Store one exchange and bump the conversation's metadata
+
+    Returns the updated conversation's turn and unsummarized token counts.
+    """
+    turn = build_turn(conversation_id, user_id, user_message, response, tokens, **extra)
+    await messages_collection.insert_many(turn, ordered=True)
+    return await conversations_collection.find_one_and_update(
+        {"conversation_id": conversation_id, "user_id": user_id},
+        {
+            "$set": {"updated_at": turn[-1]["timestamp"]},
+            "$setOnInsert": {"created_at": turn[0]["timestamp"], "title": user_message[:TITLE_LENGTH]},
+            "$inc": {"turns": 1, "unsummarized_tokens": sum(count or 0 for count in tokens)}
+        },
+        projection={"_id": 0, "turns": 1, "unsummarized_tokens": 1},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
@@ -0,0 +1,42 @@
+"""Async MongoDB access layer built on Motor."""
+import os
+
+from motor.motor_asyncio import AsyncIOMotorClient
+
+
+def pool_options():
+    """Connection pool options read from the environment"""
+    return {
+        'maxPoolSize': int(os.environ.get('MONGO_MAX_POOL_SIZE', 100)),
+        'minPoolSize': int(os.environ.get('MONGO_MIN_POOL_SIZE', 0)),
+        'maxIdleTimeMS': int(os.environ.get('MONGO_MAX_IDLE_TIME_MS', 60000)),
+        'waitQueueTimeoutMS': int(os.environ.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', 5000)),
+        'serverSelectionTimeoutMS': int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', 5000)),
+    }
+
+
+def create_client(url: str, **overrides):
+    """Create a Motor client with the configured pool settings"""
+    options = pool_options()
+    options.update(overrides)
+    return AsyncIOMotorClient(url, **options)
+
+
+class Database:
+    """Holds the Motor client and the application's collections"""
+
+    def __init__(self, client, name: str):
+        self.client = client
+        self.db = client[name]
+        self.users = self.db.users
+        self.chats = self.db.chats
+        self.admin = self.db.admin
+        self.messages = self.db.messages
+        self.conversations = self.db.conversations
+        self.response_cache = self.db.response_cache
+        self.rate_limits = self.db.rate_limits
+        self.profiles = self.db.profiles
+
+    def close(self):
+        """Close the underlying client and its connection pool"""
+        self.client.close()
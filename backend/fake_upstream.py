@@ -0,0 +1,178 @@
+"""Local stand-in for the OpenAI chat completions API.
+
+Serves POST /v1/chat/completions, streaming or not, with configurable
+latency, token rate and error injection. Resilience tests and the load test
+point a real AsyncOpenAI client at it, so retries, Retry-After handling and
+SSE parsing go through the actual SDK code paths.
+
+    python fake_upstream.py --port 8100 --latency 0.3 --tokens-per-second 50 --error-rate 0.02
+    OPENAI_BASE_URL=http://127.0.0.1:8100/v1 python run.py
+"""
+import argparse
+import asyncio
+import json
+import random
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+@dataclass
+class FakeUpstreamConfig:
+    """Behaviour of the fake upstream; script entries override it per request, in order"""
+    latency: float = 0.0
+    latency_jitter: float = 0.0
+    tokens_per_second: float = 0.0
+    reply_tokens: int = 20
+    error_rate: float = 0.0
+    error_status: int = 503
+    retry_after: float = None
+    script: deque = field(default_factory=deque)
+
+
+def _error(status: int, retry_after: float = None):
+    headers = {"retry-after": str(retry_after)} if retry_after is not None else None
+    error_type = "rate_limit_exceeded" if status == 429 else "server_error"
+    return JSONResponse(
+        {"error": {"message": f"Injected {status} from fake upstream", "type": error_type, "code": None}},
+        status_code=status,
+        headers=headers
+    )
+
+
+def create_app(config: FakeUpstreamConfig = None):
+    """ASGI app implementing the subset of the OpenAI API the proxy uses"""
+    config = config or FakeUpstreamConfig()
+    app = FastAPI(title="Fake OpenAI upstream")
+    app.state.config = config
+    app.state.stats = {"requests": 0, "in_flight": 0, "peak_in_flight": 0, "errors": 0}
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        stats = app.state.stats
+        stats["requests"] += 1
+        behaviour = config.script.popleft() if config.script else {}
+        latency = behaviour.get("latency", config.latency + random.uniform(0, config.latency_jitter))
+        status = behaviour.get("status")
+        if status is None and random.random() < config.error_rate:
+            status = config.error_status
+
+        stats["in_flight"] += 1
+        stats["peak_in_flight"] = max(stats["peak_in_flight"], stats["in_flight"])
+        try:
+            if latency:
+                await asyncio.sleep(latency)
+        finally:
+            stats["in_flight"] -= 1
+        if status:
+            stats["errors"] += 1
+            return _error(status, behaviour.get("retry_after", config.retry_after))
+
+        words = [f"token{i}" for i in range(behaviour.get("reply_tokens", config.reply_tokens))]
+        prompt_tokens = sum(len(str(message.get("content", "")).split()) + 4 for message in body.get("messages", []))
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(words),
+                 "total_tokens": prompt_tokens + len(words)}
+        created = int(time.time())
+        tps = behaviour.get("tokens_per_second", config.tokens_per_second)
+
+        if not body.get("stream"):
+            if tps:
+                await asyncio.sleep(len(words) / tps)
+            return {
+                "id": "chatcmpl-fake", "object": "chat.completion", "created": created, "model": body["model"],
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": " ".join(words)},
+                             "finish_reason": "stop"}],
+                "usage": usage
+            }
+
+        async def events():
+            for i, word in enumerate(words):
+                if tps:
+                    await asyncio.sleep(1 / tps)
+                chunk = {
+                    "id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": created,
+                    "model": body["model"],
+                    "choices": [{"index": 0, "delta": {"content": word if i == 0 else " " + word},
+                                 "finish_reason": None}]
+                }
+                yield f"data: {json.dumps(chunk)}\n\n"
+            if (body.get("stream_options") or {}).get("include_usage"):
+                chunk = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": created,
+                         "model": body["model"], "choices": [], "usage": usage}
+                yield f"data: {json.dumps(chunk)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return app
+
+
+class FakeUpstreamServer:
+    """Runs the fake upstream with uvicorn on a free local port in a background thread"""
+
+    def __init__(self, config: FakeUpstreamConfig = None, host: str = "127.0.0.1", port: int = 0):
+        self.config = config or FakeUpstreamConfig()
+        self.app = create_app(self.config)
+        self.server = uvicorn.Server(uvicorn.Config(
+            self.app, host=host, port=port, log_level="warning", timeout_graceful_shutdown=1
+        ))
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.server.servers[0].sockets[0].getsockname()[1]
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}/v1"
+
+    @property
+    def stats(self):
+        return self.app.state.stats
+
+    def start(self, timeout: float = 10.0):
+        self.thread = threading.Thread(target=self.server.run, name="fake-upstream", daemon=True)
+        self.thread.start()
+        deadline = time.monotonic() + timeout
+        while not self.server.started:
+            if time.monotonic() > deadline or not self.thread.is_alive():
+                raise RuntimeError("Fake upstream did not start")
+            time.sleep(0.01)
+        return self
+
+    def stop(self):
+        self.server.should_exit = True
+        if self.thread is not None:
+            self.thread.join(timeout=10)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a fake OpenAI chat completions API")
+    parser.add_argument('--port', type=int, default=8100)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds before the response starts")
+    parser.add_argument('--latency-jitter', type=float, default=0.0, help="extra uniform random latency")
+    parser.add_argument('--tokens-per-second', type=float, default=0.0, help="0 sends all tokens at once")
+    parser.add_argument('--reply-tokens', type=int, default=20)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--error-status', type=int, default=503)
+    parser.add_argument('--retry-after', type=float)
+    args = parser.parse_args()
+
+    config = FakeUpstreamConfig(
+        latency=args.latency, latency_jitter=args.latency_jitter, tokens_per_second=args.tokens_per_second,
+        reply_tokens=args.reply_tokens, error_rate=args.error_rate, error_status=args.error_status,
+        retry_after=args.retry_after
+    )
+    uvicorn.run(create_app(config), host="0.0.0.0", port=args.port)
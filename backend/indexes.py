@@ -0,0 +1,282 @@
+"""Index bootstrap, migrations and query plan checks for the app's collections.
+
+Run as a script to build indexes ahead of a deploy:
+
+    python indexes.py            # pending migrations, then ensure indexes
+    python indexes.py --explain  # also verify the hot queries use an index
+"""
+import argparse
+import asyncio
+import logging
+import os
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from pymongo import ASCENDING, DESCENDING, IndexModel, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from chat_history import HISTORY_SORT, backfill_previews
+from conversations import RECENT_SORT
+
+logger = logging.getLogger(__name__)
+
+INDEXES = {
+    'users': [
+        IndexModel([('user_id', ASCENDING)], unique=True, name='user_id_unique'),
+        IndexModel([('email', ASCENDING)], unique=True, name='email_unique'),
+    ],
+    'chats': [
+        IndexModel([('user_id', ASCENDING), ('timestamp', DESCENDING), ('chat_id', DESCENDING)],
+                   name='user_id_timestamp_chat_id'),
+        IndexModel([('chat_id', ASCENDING)], unique=True, name='chat_id_unique'),
+    ],
+    'admin': [
+        IndexModel([('type', ASCENDING)], unique=True, name='type_unique'),
+    ],
+    'messages': [
+        IndexModel([('conversation_id', ASCENDING), ('timestamp', DESCENDING), ('_id', DESCENDING)],
+                   name='conversation_id_timestamp'),
+        IndexModel([('message_id', ASCENDING)], unique=True, name='message_id_unique'),
+    ],
+    'conversations': [
+        IndexModel([('conversation_id', ASCENDING)], unique=True, name='conversation_id_unique'),
+        IndexModel([('user_id', ASCENDING), ('updated_at', DESCENDING), ('conversation_id', DESCENDING)],
+                   name='user_id_updated_at'),
+    ],
+    'response_cache': [
+        IndexModel([('expires_at', ASCENDING)], expireAfterSeconds=0, name='expires_at_ttl'),
+    ],
+    'rate_limits': [
+        IndexModel([('expires_at', ASCENDING)], expireAfterSeconds=0, name='expires_at_ttl'),
+    ],
+    'profiles': [
+        IndexModel([('id', ASCENDING)], unique=True, name='id_unique'),
+        IndexModel([('started_at', DESCENDING)], name='started_at'),
+    ],
+}
+
+# How long a worker may hold the migration lock before others may take it over
+MIGRATION_LOCK_TTL = timedelta(minutes=30)
+
+# Indexes superseded by the ones above, dropped during migration
+OBSOLETE_INDEXES = {
+    'chats': ['user_id_timestamp'],
+}
+
+
+async def backfill_user_ids(database):
+    """Give users created by an admin upsert a user_id so the unique index can build"""
+    count = 0
+    async for user in database.users.find({'user_id': {'$exists': False}}, {'_id': 1}):
+        await database.users.update_one({'_id': user['_id']}, {'$set': {'user_id': str(uuid.uuid4())}})
+        count += 1
+    if count:
+        logger.info("Backfilled user_id on %s users", count)
+    return count
+
+
+# One-off data migrations, run in order by migrate(). Completion is recorded
+# in the admin collection so later startups skip their collection scans.
+MIGRATIONS = [
+    ('user_ids', backfill_user_ids),
+    ('chat_previews', lambda database: backfill_previews(database.chats)),
+]
+
+
+async def run_migrations(database):
+    """Run the migrations not yet recorded as completed; returns their names"""
+    applied = []
+    for name, migration in MIGRATIONS:
+        marker = {'type': f'migration:{name}'}
+        if await database.admin.find_one(marker, {'_id': 1}):
+            continue
+        await migration(database)
+        await database.admin.update_one(marker, {'$set': {'completed_at': datetime.utcnow()}}, upsert=True)
+        applied.append(name)
+    return applied
+
+
+async def _report_progress(database, collection_name: str, interval: float):
+    """Log in-progress index builds for a collection from $currentOp"""
+    namespace = f"{database.db.name}.{collection_name}"
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            ops = await database.client.admin.aggregate([
+                {'$currentOp': {'allUsers': True}},
+                {'$match': {'ns': namespace, 'command.createIndexes': {'$exists': True}}}
+            ]).to_list(length=None)
+        except Exception as e:
+            logger.debug("Index build progress unavailable: %s", e)
+            return
+        for op in ops:
+            progress = op.get('progress') or {}
+            if progress.get('total'):
+                logger.info("Building indexes on %s: %s/%s (%s)", collection_name, progress['done'], progress['total'], op.get('msg', ''))
+
+
+class IndexBuildError(Exception):
+    """Raised by ensure_indexes once every index was attempted and some failed"""
+
+    def __init__(self, created: dict, failed: dict):
+        super().__init__("Index builds failed: " + ', '.join(
+            f"{collection_name}.{name}" for collection_name, names in failed.items() for name in names
+        ))
+        self.created = created
+        self.failed = failed
+
+
+async def ensure_indexes(database, progress_interval: float = 5.0):
+    """Create every index in INDEXES, reporting progress and timings
+
+    A failed build is logged and the remaining indexes are still created;
+    IndexBuildError is raised at the end if any failed.
+    """
+    created, failed = {}, {}
+    for collection_name, models in INDEXES.items():
+        collection = getattr(database, collection_name)
+        reporter = asyncio.create_task(_report_progress(database, collection_name, progress_interval))
+        start = time.perf_counter()
+        created[collection_name] = []
+        try:
+            for model in models:
+                name = model.document['name']
+                try:
+                    created[collection_name].extend(await collection.create_indexes([model]))
+                except Exception as e:
+                    logger.error("Index %s.%s failed to build: %s", collection_name, name, e)
+                    failed.setdefault(collection_name, []).append(name)
+        finally:
+            reporter.cancel()
+        elapsed = time.perf_counter() - start
+        logger.info("Indexes ready on %s: %s (%.2fs)", collection_name, ', '.join(created[collection_name]), elapsed)
+    if failed:
+        raise IndexBuildError(created, failed)
+    return created
+
+
+async def drop_obsolete_indexes(database):
+    """Drop indexes listed in OBSOLETE_INDEXES that still exist"""
+    dropped = []
+    for collection_name, names in OBSOLETE_INDEXES.items():
+        collection = getattr(database, collection_name)
+        existing = await collection.index_information()
+        for name in names:
+            if name in existing:
+                await collection.drop_index(name)
+                dropped.append(f"{collection_name}.{name}")
+                logger.info("Dropped obsolete index %s.%s", collection_name, name)
+    return dropped
+
+
+async def acquire_migration_lock(database, owner: str, ttl: timedelta = MIGRATION_LOCK_TTL):
+    """Claim the migration lock in the admin collection; False if another worker holds it"""
+    # The claim relies on the unique type index to reject a second lock document
+    await database.admin.create_indexes(INDEXES['admin'])
+    now = datetime.utcnow()
+    try:
+        # Matches only an expired lock; with none, the upsert inserts a fresh one
+        lock = await database.admin.find_one_and_update(
+            {'type': 'migration_lock', 'expires_at': {'$lt': now}},
+            {'$set': {'owner': owner, 'expires_at': now + ttl}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        return False
+    return lock['owner'] == owner
+
+
+async def release_migration_lock(database, owner: str):
+    await database.admin.delete_one({'type': 'migration_lock', 'owner': owner})
+
+
+async def migrate(database):
+    """Run pending data migrations, then ensure indexes
+
+    Only the worker holding the migration lock does the work; the others
+    skip it and return None.
+    """
+    owner = f"{os.getpid()}:{uuid.uuid4().hex}"
+    if not await acquire_migration_lock(database, owner):
+        logger.info("Migrations are running in another worker, skipping")
+        return None
+    try:
+        await run_migrations(database)
+        created = await ensure_indexes(database)
+        await drop_obsolete_indexes(database)
+        return created
+    finally:
+        await release_migration_lock(database, owner)
+
+
+def hot_queries(database, user_id: str = 'explain-user', email: str = 'explain@example.com'):
+    """Cursors for the queries on the request path, keyed by a readable name"""
+    return {
+        'users.by_user_id': database.users.find({'user_id': user_id}).limit(1),
+        'users.by_email': database.users.find({'email': email}).limit(1),
+        'users.page': database.users.find({'user_id': {'$gt': ''}}).sort('user_id', 1).limit(100),
+        'chats.history': database.chats.find({'user_id': user_id}).sort(HISTORY_SORT).limit(50),
+        'chats.by_chat_id': database.chats.find({'user_id': user_id, 'chat_id': 'explain-chat'}).limit(1),
+        'admin.default': database.admin.find({'type': 'default'}).limit(1),
+        'messages.recent': database.messages.find({'conversation_id': 'explain-conversation', 'user_id': user_id})
+                                            .sort(RECENT_SORT).limit(20),
+        'conversations.list': database.conversations.find({'user_id': user_id})
+                                                    .sort([('updated_at', -1), ('conversation_id', -1)]).limit(20),
+    }
+
+
+def plan_stages(plan):
+    """Yield every stage name in a query plan tree"""
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            yield plan['stage']
+        for value in plan.values():
+            yield from plan_stages(value)
+    elif isinstance(plan, list):
+        for item in plan:
+            yield from plan_stages(item)
+
+
+async def find_collection_scans(database):
+    """Return the names of hot queries whose winning plan is a collection scan"""
+    scans = []
+    for name, cursor in hot_queries(database).items():
+        explain = await cursor.explain()
+        winning_plan = explain.get('queryPlanner', {}).get('winningPlan', {})
+        if 'COLLSCAN' in plan_stages(winning_plan):
+            scans.append(name)
+    return scans
+
+
+async def _main(args):
+    from database import Database, create_client
+
+    database = Database(create_client(os.environ.get('MONGO_URL', 'mongodb://localhost:27017')),
+                        os.environ.get('DB_NAME', 'test_database'))
+    try:
+        try:
+            await migrate(database)
+        except IndexBuildError as e:
+            logger.error("%s", e)
+            return 1
+        if args.explain:
+            scans = await find_collection_scans(database)
+            if scans:
+                logger.error("Collection scans on hot queries: %s", ', '.join(scans))
+                return 1
+            logger.info("All hot queries use an index")
+        return 0
+    finally:
+        database.close()
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Create MongoDB indexes and run migrations")
+    parser.add_argument('--explain', action='store_true', help="fail if a hot query uses a collection scan")
+    raise SystemExit(asyncio.run(_main(parser.parse_args())))
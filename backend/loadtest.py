@@ -0,0 +1,370 @@
+"""End-to-end load test of server.py against a local fake OpenAI upstream.
+
+Runs the real FastAPI app in process (lifespan included) with the upstream
+replaced by fake_upstream.FakeUpstreamServer and MongoDB by an in-memory
+stand-in, then drives concurrent requests across the main endpoints:
+
+    python loadtest.py --concurrency 32 --duration 30 --latency 0.3 --tokens-per-second 80 --output run.json
+    python loadtest.py --mongo-url mongodb://localhost:27017 --error-rate 0.05
+
+Each endpoint gets a request count, error count, throughput and latency
+percentiles (for streams, also time to the first event). The JSON report is
+the input of the regression comparison, so keep its layout stable.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import platform
+import random
+import subprocess
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+
+import httpx
+from mongomock_motor import AsyncMongoMockClient
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+import server
+from database import Database, create_client
+from fake_upstream import FakeUpstreamConfig, FakeUpstreamServer
+from openai_clients import OpenAIClientRegistry
+from profiling import MongoProfileStore
+from rate_limit import RateLimiter
+from resilience import CircuitBreaker, UpstreamPolicy
+from upstream_scheduler import FairScheduler
+from write_behind import WriteBehindQueue
+
+# Relative share of requests per endpoint; chat routes dominate real traffic
+DEFAULT_MIX = {
+    'POST /api/chat': 30,
+    'POST /api/chat/stream': 20,
+    'GET /api/chat/history': 20,
+    'GET /api/user/profile': 10,
+    'GET /api/user/api-key-status': 10,
+    'GET /api/admin/users': 10,
+}
+ADMIN_ENDPOINTS = {'GET /api/admin/users'}
+PROMPTS = [
+    "Explain the difference between a process and a thread",
+    "Write a haiku about load testing",
+    "What is the capital of Hungary?",
+    "Summarize the CAP theorem in two sentences",
+    "How do I reverse a list in Python?",
+]
+
+
+def percentile(ordered, q: float):
+    """Nearest-rank percentile of an already sorted list"""
+    if not ordered:
+        return None
+    return ordered[max(0, math.ceil(q * len(ordered)) - 1)]
+
+
+def latency_summary(samples):
+    """Mean and tail percentiles of samples given in seconds, in milliseconds"""
+    ordered = sorted(samples)
+    if not ordered:
+        return None
+    ms = lambda seconds: round(seconds * 1000, 2)
+    return {
+        'mean': ms(sum(ordered) / len(ordered)),
+        'p50': ms(percentile(ordered, 0.50)),
+        'p95': ms(percentile(ordered, 0.95)),
+        'p99': ms(percentile(ordered, 0.99)),
+        'max': ms(ordered[-1]),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              timeout=5, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+@contextmanager
+def configure_server(database, upstream_url: str, rate_limits: bool = False):
+    """Point server.py at the given database and fake upstream, restoring it afterwards"""
+    limits = httpx.Limits(max_connections=1000, max_keepalive_connections=200)
+    overrides = {
+        'mongo': database,
+        'users_collection': database.users,
+        'chats_collection': database.chats,
+        'admin_collection': database.admin,
+        'messages_collection': database.messages,
+        'conversations_collection': database.conversations,
+        'OPENAI_API_KEY': 'sk-loadtest',
+        'openai_clients': OpenAIClientRegistry(client_factory=lambda api_key: AsyncOpenAI(
+            api_key=api_key, base_url=upstream_url, max_retries=0,
+            http_client=DefaultAsyncHttpxClient(limits=limits)
+        )),
+        # The in-memory stand-in has no index support worth migrating
+        'ENSURE_INDEXES_ON_STARTUP': not isinstance(database.client, AsyncMongoMockClient),
+    }
+    if not rate_limits:
+        overrides['rate_limiter'] = RateLimiter({})
+    # Fresh copies of the stateful upstream and write path objects, so one
+    # run's queue, breaker and latency history do not leak into the next
+    writer, scheduler, policy = server.chat_writer, server.upstream_scheduler, server.upstream_policy
+    overrides['chat_writer'] = WriteBehindQueue(
+        write=lambda docs: database.chats.insert_many(docs, ordered=False),
+        max_size=writer.queue.maxsize, batch_size=writer.batch_size, flush_interval=writer.flush_interval,
+        put_timeout=writer.put_timeout, spill_path=writer.spill_path
+    )
+    overrides['upstream_scheduler'] = FairScheduler(scheduler.max_concurrency, scheduler.quantum,
+                                                    scheduler.queue_timeout)
+    overrides['upstream_policy'] = UpstreamPolicy(
+        attempt_timeout=policy.attempt_timeout, total_timeout=policy.total_timeout,
+        max_attempts=policy.max_attempts, backoff_base=policy.backoff_base, backoff_max=policy.backoff_max,
+        hedge=policy.hedge, hedge_quantile=policy.hedge_quantile,
+        breaker=CircuitBreaker(window=policy.breaker.outcomes.maxlen, failure_ratio=policy.breaker.failure_ratio,
+                               min_calls=policy.breaker.min_calls, cooldown=policy.breaker.cooldown)
+    )
+    saved = {name: getattr(server, name) for name in overrides}
+    for name, value in overrides.items():
+        setattr(server, name, value)
+    # ProfilingMiddleware holds the profiler itself, so rebind its store rather than replace it
+    profile_store = server.profiler.store
+    if profile_store is not None:
+        server.profiler.store = MongoProfileStore(database.admin, database.profiles, keep=profile_store.keep)
+    for cache in (server.default_api_key_cache, server.token_cache, server.user_cache):
+        cache.clear()
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(server, name, value)
+        server.profiler.store = profile_store
+
+
+async def seed_users(database, count: int):
+    """Insert count users plus one admin; returns (user tokens, admin token)"""
+    now = datetime.utcnow()
+    users = [{
+        'user_id': str(uuid.uuid4()),
+        'email': f'load{i}@loadtest.local',
+        'name': f'load{i}',
+        'picture': '',
+        'is_admin': i == 0,
+        'created_at': now,
+        'last_login': now,
+    } for i in range(count + 1)]
+    await database.users.insert_many([dict(user) for user in users])
+    tokens = [server.create_jwt_token(user) for user in users]
+    return tokens[1:], tokens[0]
+
+
+class LoadRun:
+    """Issues requests from concurrent workers and records per-endpoint samples"""
+
+    def __init__(self, client, user_tokens, admin_token, mix, rng):
+        self.client = client
+        self.user_tokens = user_tokens
+        self.admin_token = admin_token
+        self.endpoints = list(mix)
+        self.weights = [mix[endpoint] for endpoint in self.endpoints]
+        self.rng = rng
+        self.samples = {endpoint: [] for endpoint in self.endpoints}
+        self.first_events = {endpoint: [] for endpoint in self.endpoints}
+        self.errors = {endpoint: 0 for endpoint in self.endpoints}
+        self.statuses = {endpoint: {} for endpoint in self.endpoints}
+        self.issued = 0
+
+    async def request(self, endpoint: str, record: bool = True):
+        method, path = endpoint.split(' ', 1)
+        token = self.admin_token if endpoint in ADMIN_ENDPOINTS else self.rng.choice(self.user_tokens)
+        headers = {'Authorization': f'Bearer {token}'}
+        body = {'message': self.rng.choice(PROMPTS)} if method == 'POST' else None
+        first_event = None
+        failed = False
+        start = time.perf_counter()
+        try:
+            if path.endswith('/stream'):
+                async with self.client.stream(method, path, json=body, headers=headers) as response:
+                    status = response.status_code
+                    async for line in response.aiter_lines():
+                        if line == 'event: error':
+                            failed = True
+                        elif line.startswith('data:') and first_event is None:
+                            first_event = time.perf_counter() - start
+            else:
+                response = await self.client.request(method, path, json=body, headers=headers)
+                status = response.status_code
+        except httpx.HTTPError:
+            status = 'exception'
+        elapsed = time.perf_counter() - start
+        if not record:
+            return
+        self.samples[endpoint].append(elapsed)
+        if first_event is not None:
+            self.first_events[endpoint].append(first_event)
+        statuses = self.statuses[endpoint]
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+        if failed or status == 'exception' or status >= 400:
+            self.errors[endpoint] += 1
+
+    async def worker(self, deadline: float, limit: int):
+        while time.perf_counter() < deadline and (not limit or self.issued < limit):
+            self.issued += 1
+            await self.request(self.rng.choices(self.endpoints, self.weights)[0])
+
+    async def run(self, concurrency: int, duration: float, requests: int, warmup: int):
+        for endpoint in self.endpoints[:warmup]:
+            await self.request(endpoint, record=False)
+        for _ in range(max(0, warmup - len(self.endpoints))):
+            await self.request(self.rng.choices(self.endpoints, self.weights)[0], record=False)
+        deadline = time.perf_counter() + (duration if duration else float('inf'))
+        start = time.perf_counter()
+        await asyncio.gather(*(self.worker(deadline, requests) for _ in range(concurrency)))
+        return time.perf_counter() - start
+
+    def report(self, elapsed: float):
+        endpoints = {}
+        for endpoint in self.endpoints:
+            samples = self.samples[endpoint]
+            if not samples:
+                continue
+            endpoints[endpoint] = {
+                'requests': len(samples),
+                'errors': self.errors[endpoint],
+                'error_rate': round(self.errors[endpoint] / len(samples), 4),
+                'throughput_rps': round(len(samples) / elapsed, 2),
+                'latency_ms': latency_summary(samples),
+                'statuses': self.statuses[endpoint],
+            }
+            if self.first_events[endpoint]:
+                endpoints[endpoint]['first_event_ms'] = latency_summary(self.first_events[endpoint])
+        every = [sample for samples in self.samples.values() for sample in samples]
+        total_errors = sum(self.errors.values())
+        overall = {
+            'requests': len(every),
+            'errors': total_errors,
+            'error_rate': round(total_errors / len(every), 4) if every else 0,
+            'throughput_rps': round(len(every) / elapsed, 2),
+            'latency_ms': latency_summary(every),
+        }
+        return endpoints, overall
+
+
+async def run_load(concurrency: int = 16, duration: float = 10.0, requests: int = 0, users: int = 50,
+                   upstream_config: FakeUpstreamConfig = None, mix: dict = None, mongo_url: str = None,
+                   rate_limits: bool = False, warmup: int = 20, seed: int = 0):
+    """Run one load test and return the report
+
+    Stops after duration seconds or, if requests is set, after that many
+    requests, whichever comes first (duration=0 means no time limit).
+    """
+    upstream_config = upstream_config or FakeUpstreamConfig()
+    mix = mix or DEFAULT_MIX
+    if mongo_url:
+        database = Database(create_client(mongo_url), 'loadtest_' + uuid.uuid4().hex[:8])
+    else:
+        database = Database(AsyncMongoMockClient(), 'loadtest')
+
+    with FakeUpstreamServer(upstream_config) as upstream, configure_server(database, upstream.base_url, rate_limits):
+        try:
+            async with server.app.router.lifespan_context(server.app):
+                user_tokens, admin_token = await seed_users(database, users)
+                transport = httpx.ASGITransport(app=server.app)
+                async with httpx.AsyncClient(transport=transport, base_url='http://loadtest', timeout=300) as client:
+                    run = LoadRun(client, user_tokens, admin_token, mix, random.Random(seed))
+                    elapsed = await run.run(concurrency, duration, requests, warmup)
+                    server_stats = {
+                        'upstream_policy': server.upstream_policy.stats(),
+                        'upstream_queue': server.upstream_scheduler.stats(),
+                        'chat_write_queue': server.chat_writer.stats(),
+                    }
+        finally:
+            if mongo_url:
+                await database.client.drop_database(database.db.name)
+        upstream_stats = dict(upstream.stats)
+
+    endpoints, overall = run.report(elapsed)
+    return {
+        'meta': {
+            'started_at': datetime.utcnow().isoformat() + 'Z',
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'mongo': 'external' if mongo_url else 'in-memory',
+            'concurrency': concurrency,
+            'duration_s': round(elapsed, 3),
+            'users': users,
+            'warmup': warmup,
+            'rate_limits': rate_limits,
+            'upstream': {
+                'latency': upstream_config.latency,
+                'latency_jitter': upstream_config.latency_jitter,
+                'tokens_per_second': upstream_config.tokens_per_second,
+                'reply_tokens': upstream_config.reply_tokens,
+                'error_rate': upstream_config.error_rate,
+                'error_status': upstream_config.error_status,
+            },
+        },
+        'overall': overall,
+        'endpoints': endpoints,
+        'upstream': upstream_stats,
+        'server': server_stats,
+    }
+
+
+def format_report(report):
+    """Render a load test report as a text table"""
+    meta = report['meta']
+    lines = [
+        f"{meta['duration_s']}s at concurrency {meta['concurrency']} "
+        f"(upstream latency {meta['upstream']['latency']}s, error rate {meta['upstream']['error_rate']})",
+        f"{'endpoint':<30} {'reqs':>6} {'errors':>6} {'rps':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}",
+    ]
+    rows = list(report['endpoints'].items()) + [('overall', report['overall'])]
+    for endpoint, row in rows:
+        latency = row['latency_ms'] or {}
+        lines.append(
+            f"{endpoint:<30} {row['requests']:>6} {row['errors']:>6} {row['throughput_rps']:>8.1f} "
+            f"{latency.get('p50', 0):>8.1f} {latency.get('p95', 0):>8.1f} {latency.get('p99', 0):>8.1f}"
+        )
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test server.py against a local fake OpenAI upstream")
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds to run; 0 for no limit")
+    parser.add_argument('--requests', type=int, default=0, help="stop after this many requests (0 = no limit)")
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--warmup', type=int, default=20, help="unrecorded requests before measuring")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0.05, help="fake upstream seconds before responding")
+    parser.add_argument('--latency-jitter', type=float, default=0.0)
+    parser.add_argument('--tokens-per-second', type=float, default=0.0, help="0 sends all tokens at once")
+    parser.add_argument('--reply-tokens', type=int, default=20)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--error-status', type=int, default=503)
+    parser.add_argument('--mongo-url', help="use a scratch database on this MongoDB instead of an in-memory one")
+    parser.add_argument('--rate-limits', action='store_true', help="keep the configured rate limits")
+    parser.add_argument('--mix', help="endpoint weights as JSON, e.g. '{\"POST /api/chat\": 1}'")
+    parser.add_argument('--output', help="write the report as JSON to this path")
+    args = parser.parse_args()
+    # Per-request httpx logging would dominate the output and the profile
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    if not args.duration and not args.requests:
+        parser.error("set --duration or --requests")
+
+    config = FakeUpstreamConfig(
+        latency=args.latency, latency_jitter=args.latency_jitter, tokens_per_second=args.tokens_per_second,
+        reply_tokens=args.reply_tokens, error_rate=args.error_rate, error_status=args.error_status
+    )
+    report = asyncio.run(run_load(
+        concurrency=args.concurrency, duration=args.duration, requests=args.requests, users=args.users,
+        upstream_config=config, mix=json.loads(args.mix) if args.mix else None, mongo_url=args.mongo_url,
+        rate_limits=args.rate_limits, warmup=args.warmup, seed=args.seed
+    ))
+    print(format_report(report))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
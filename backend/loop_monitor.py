@@ -0,0 +1,119 @@
+"""Diagnostic detector for callbacks that block the event loop.
+
+A heartbeat task on the loop records when it last ran. A watchdog thread
+notices when the heartbeat is overdue and samples the loop thread's stack
+while it is still blocked, so the report names the exact line doing the
+blocking (e.g. a synchronous driver call inside a route). When the loop
+recovers, the stall is logged with that sample and added to cumulative
+totals.
+"""
+import asyncio
+import logging
+import os
+import sys
+import sysconfig
+import threading
+import time
+import traceback
+from collections import deque
+
+from metrics import EVENT_LOOP_STALLS, EVENT_LOOP_STALL_SECONDS
+
+logger = logging.getLogger(__name__)
+
+_LIBRARY_PATHS = tuple(
+    os.path.normcase(path) for path in {sysconfig.get_paths()['stdlib'], sysconfig.get_paths()['purelib'],
+                                        sysconfig.get_paths()['platlib']}
+)
+
+
+def _is_application_frame(filename: str):
+    filename = os.path.normcase(os.path.abspath(filename))
+    return not filename.startswith(_LIBRARY_PATHS) and filename != os.path.normcase(os.path.abspath(__file__))
+
+
+class LoopBlockingDetector:
+    """Reports event loop stalls longer than threshold seconds with a stack sample"""
+
+    def __init__(self, threshold: float = 0.1, interval: float = 0.02, max_samples: int = 50):
+        self.threshold = threshold
+        self.interval = interval
+        self.stalls = 0
+        self.stall_seconds = 0.0
+        self.samples = deque(maxlen=max_samples)
+        self._last_beat = time.monotonic()
+        self._pending_sample = None
+        self._loop_thread_id = None
+        self._heartbeat_task = None
+        self._watchdog = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        """Start monitoring the running loop; call from inside the loop"""
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._stopped.clear()
+        self._heartbeat_task = asyncio.get_running_loop().create_task(self._heartbeat())
+        self._watchdog = threading.Thread(target=self._watch, name="loop-blocking-detector", daemon=True)
+        self._watchdog.start()
+
+    async def stop(self):
+        """Stop the heartbeat and watchdog"""
+        self._stopped.set()
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+            try:
+                await self._heartbeat_task
+            except asyncio.CancelledError:
+                pass
+            self._heartbeat_task = None
+
+    async def _heartbeat(self):
+        while True:
+            self._last_beat = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = time.monotonic() - self._last_beat - self.interval
+            if lag >= self.threshold:
+                self._record(lag)
+
+    def _watch(self):
+        while not self._stopped.wait(self.interval):
+            beat = self._last_beat
+            if time.monotonic() - beat >= self.threshold and (self._pending_sample is None or self._pending_sample[0] != beat):
+                frame = sys._current_frames().get(self._loop_thread_id)
+                if frame is not None:
+                    self._pending_sample = (beat, traceback.extract_stack(frame))
+
+    def _record(self, lag: float):
+        stack = None
+        if self._pending_sample is not None and self._pending_sample[0] == self._last_beat:
+            stack = self._pending_sample[1]
+        self._pending_sample = None
+
+        culprit = None
+        if stack:
+            application = [entry for entry in stack if _is_application_frame(entry.filename)]
+            entry = application[-1] if application else stack[-1]
+            culprit = f"{os.path.basename(entry.filename)}:{entry.lineno} in {entry.name}"
+
+        self.stalls += 1
+        self.stall_seconds += lag
+        EVENT_LOOP_STALLS.inc()
+        EVENT_LOOP_STALL_SECONDS.inc(lag)
+        sample = {
+            "duration": lag,
+            "culprit": culprit,
+            "stack": "".join(traceback.format_list(stack)) if stack else None,
+            "at": time.time()
+        }
+        self.samples.append(sample)
+        logger.warning("Event loop blocked for %.0fms at %s\n%s", lag * 1000, culprit or 'unknown location', sample['stack'] or '')
+
+    def stats(self):
+        """Cumulative stall counters and the most recent samples"""
+        return {
+            "threshold_ms": self.threshold * 1000,
+            "stalls": self.stalls,
+            "stall_seconds": self.stall_seconds,
+            "recent": list(self.samples)
+        }
@@ -0,0 +1,151 @@
+"""Prometheus instrumentation for routes, the OpenAI upstream, MongoDB and the event loop.
+
+Metrics are per process. When running several workers (see run.py), set
+PROMETHEUS_MULTIPROC_DIR to a writable directory so /metrics aggregates all
+workers.
+"""
+import asyncio
+import os
+import threading
+import time
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from prometheus_client import REGISTRY, multiprocess
+from pymongo import monitoring
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+MONGO_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+
+REQUEST_LATENCY = Histogram(
+    'http_request_duration_seconds', 'HTTP request latency by route',
+    ['route', 'method', 'status'], buckets=LATENCY_BUCKETS
+)
+UPSTREAM_LATENCY = Histogram(
+    'openai_request_duration_seconds', 'OpenAI chat completion latency',
+    ['api_key_source', 'stream'], buckets=LATENCY_BUCKETS
+)
+TIME_TO_FIRST_TOKEN = Histogram(
+    'openai_time_to_first_token_seconds', 'Time until the first streamed token arrives',
+    ['api_key_source'], buckets=LATENCY_BUCKETS
+)
+TOKENS = Counter(
+    'openai_tokens_total', 'Tokens sent to and received from OpenAI',
+    ['api_key_source', 'direction']
+)
+UPSTREAM_QUEUE_DEPTH = Gauge(
+    'openai_queue_depth', 'Requests waiting for an upstream concurrency slot',
+    ['api_key_source'], multiprocess_mode='livesum'
+)
+UPSTREAM_QUEUE_WAIT = Histogram(
+    'openai_queue_wait_seconds', 'Time spent waiting for an upstream concurrency slot',
+    ['api_key_source'], buckets=LATENCY_BUCKETS
+)
+MONGO_LATENCY = Histogram(
+    'mongo_operation_duration_seconds', 'MongoDB command latency by collection',
+    ['collection', 'operation', 'outcome'], buckets=MONGO_BUCKETS
+)
+EVENT_LOOP_LAG = Gauge(
+    'event_loop_lag_seconds', 'Most recent event loop scheduling delay', multiprocess_mode='max'
+)
+EVENT_LOOP_STALLS = Counter(
+    'event_loop_stalls_total', 'Event loop stalls longer than the blocking detector threshold'
+)
+EVENT_LOOP_STALL_SECONDS = Counter(
+    'event_loop_stall_seconds_total', 'Cumulative time the event loop was blocked'
+)
+EVENT_LOOP_LAG_HISTOGRAM = Histogram(
+    'event_loop_lag_observed_seconds', 'Event loop scheduling delay samples',
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+)
+
+
+class MetricsMiddleware:
+    """Pure ASGI middleware recording latency per matched route template
+
+    Label children are cached so the hot path is a dict lookup plus one
+    histogram observation.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._children = {}
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get('route')
+            # Unmatched paths share one label to keep cardinality bounded
+            key = (route.path if route is not None else 'unmatched', scope['method'], status)
+            child = self._children.get(key)
+            if child is None:
+                child = self._children[key] = REQUEST_LATENCY.labels(key[0], key[1], str(key[2]))
+            child.observe(time.perf_counter() - start)
+
+
+def record_usage(api_key_source: str, usage):
+    """Count prompt and completion tokens from an OpenAI usage object"""
+    if usage is None:
+        return
+    TOKENS.labels(api_key_source, 'in').inc(getattr(usage, 'prompt_tokens', 0) or 0)
+    TOKENS.labels(api_key_source, 'out').inc(getattr(usage, 'completion_tokens', 0) or 0)
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """pymongo command listener observing latency per collection and command"""
+
+    def __init__(self):
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, str):
+            collection = 'admin' if event.command_name != 'getMore' else event.command.get('collection', 'unknown')
+        with self._lock:
+            self._pending[(event.connection_id, event.request_id)] = collection
+
+    def _finish(self, event, outcome):
+        with self._lock:
+            collection = self._pending.pop((event.connection_id, event.request_id), 'unknown')
+        MONGO_LATENCY.labels(collection, event.command_name, outcome).observe(event.duration_micros / 1e6)
+
+    def succeeded(self, event):
+        self._finish(event, 'success')
+
+    def failed(self, event):
+        self._finish(event, 'failure')
+
+
+async def monitor_event_loop_lag(interval: float = 0.5):
+    """Sample how late the loop wakes a sleeping task"""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - start - interval)
+        EVENT_LOOP_LAG.set(lag)
+        EVENT_LOOP_LAG_HISTOGRAM.observe(lag)
+
+
+def render_metrics():
+    """Exposition payload and content type for /metrics"""
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,131 @@
+"""Bounded registry of reusable AsyncOpenAI clients keyed by API key."""
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+logger = logging.getLogger(__name__)
+
+
+def default_client_factory(api_key: str):
+    """Build an AsyncOpenAI client with a keep-alive connection pool"""
+    limits = httpx.Limits(
+        max_connections=int(os.environ.get('OPENAI_MAX_CONNECTIONS', 100)),
+        max_keepalive_connections=int(os.environ.get('OPENAI_MAX_KEEPALIVE_CONNECTIONS', 20)),
+        keepalive_expiry=float(os.environ.get('OPENAI_KEEPALIVE_EXPIRY', 60)),
+    )
+    # Retries are handled by resilience.UpstreamPolicy, so the SDK's own are off by default
+    return AsyncOpenAI(
+        api_key=api_key,
+        http_client=DefaultAsyncHttpxClient(limits=limits),
+        max_retries=int(os.environ.get('OPENAI_MAX_RETRIES', 0))
+    )
+
+
+class _Entry:
+    __slots__ = ('client', 'last_used', 'in_use', 'evicted')
+
+    def __init__(self, client):
+        self.client = client
+        self.last_used = time.monotonic()
+        self.in_use = 0
+        self.evicted = False
+
+
+class OpenAIClientRegistry:
+    """LRU cache of AsyncOpenAI clients that closes idle and evicted clients
+
+    Clients are keyed by a hash of the API key so every request resolving to
+    the same key (e.g. the shared default admin key) reuses one httpx pool.
+    A client evicted while requests are still using it is closed once the
+    last of those requests releases it.
+    """
+
+    def __init__(self, max_clients: int = 32, idle_timeout: float = 300.0, client_factory=None):
+        self.max_clients = max_clients
+        self.idle_timeout = idle_timeout
+        self.client_factory = client_factory or default_client_factory
+        self._entries = OrderedDict()
+        self._reaper = None
+
+    @staticmethod
+    def _key(api_key: str):
+        return hashlib.sha256(api_key.encode()).hexdigest()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @asynccontextmanager
+    async def client(self, api_key: str):
+        """Borrow the shared client for an API key for the duration of a call"""
+        key = self._key(api_key)
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = _Entry(self.client_factory(api_key))
+            self._entries[key] = entry
+            await self._evict_overflow()
+        else:
+            self._entries.move_to_end(key)
+        entry.in_use += 1
+        entry.last_used = time.monotonic()
+        try:
+            yield entry.client
+        finally:
+            entry.in_use -= 1
+            entry.last_used = time.monotonic()
+            if entry.evicted and entry.in_use == 0:
+                await self._close(entry)
+
+    async def _evict_overflow(self):
+        while len(self._entries) > self.max_clients:
+            _, entry = self._entries.popitem(last=False)
+            await self._retire(entry)
+
+    async def _retire(self, entry):
+        entry.evicted = True
+        if entry.in_use == 0:
+            await self._close(entry)
+
+    async def _close(self, entry):
+        try:
+            await entry.client.close()
+        except Exception as e:
+            logger.warning("Failed to close OpenAI client: %s", e)
+
+    async def close_idle(self):
+        """Close clients that have not been used within idle_timeout"""
+        cutoff = time.monotonic() - self.idle_timeout
+        idle = [key for key, entry in self._entries.items() if entry.in_use == 0 and entry.last_used < cutoff]
+        for key in idle:
+            await self._retire(self._entries.pop(key))
+        return len(idle)
+
+    def start(self, interval: float = 60.0):
+        """Start the background task that closes idle clients"""
+        if self._reaper is None:
+            self._reaper = asyncio.create_task(self._reap(interval))
+
+    async def _reap(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            await self.close_idle()
+
+    async def aclose(self):
+        """Stop the reaper and close every client"""
+        if self._reaper is not None:
+            self._reaper.cancel()
+            try:
+                await self._reaper
+            except asyncio.CancelledError:
+                pass
+            self._reaper = None
+        entries = list(self._entries.values())
+        self._entries.clear()
+        for entry in entries:
+            await self._close(entry)
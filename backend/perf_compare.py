@@ -0,0 +1,170 @@
+"""Performance regression gate over load test reports.
+
+Compares loadtest.py JSON reports for a candidate against a stored
+baseline and exits non-zero when throughput or latency on a gated endpoint
+got worse by more than the allowed tolerance:
+
+    python loadtest.py --duration 30 --output baseline-1.json   # repeat for a few runs, on main
+    python loadtest.py --duration 30 --output candidate-1.json  # same settings, on the branch
+    python perf_compare.py --baseline baseline-*.json --candidate candidate-*.json
+
+Several runs per side are recommended. Each metric is then the median
+across runs, and the tolerance widens to cover the spread seen between
+runs on either side, so run-to-run noise is not reported as a regression.
+Latency changes smaller than an absolute floor are ignored, since
+sub-millisecond routes jitter by more than any sensible percentage.
+"""
+import argparse
+import json
+import statistics
+import sys
+
+# Gated endpoints; the last two only authenticate and read the user
+DEFAULT_ENDPOINTS = [
+    'POST /api/chat',
+    'GET /api/chat/history',
+    'GET /api/admin/users',
+    'GET /api/user/profile',
+    'GET /api/user/api-key-status',
+]
+# (report path, higher is better)
+METRICS = {
+    'throughput_rps': (('throughput_rps',), True),
+    'p50_ms': (('latency_ms', 'p50'), False),
+    'p95_ms': (('latency_ms', 'p95'), False),
+    'p99_ms': (('latency_ms', 'p99'), False),
+}
+DEFAULT_METRICS = ['throughput_rps', 'p50_ms', 'p95_ms']
+# Run settings that must match for the comparison to be meaningful
+COMPARABLE_SETTINGS = ('concurrency', 'mongo', 'upstream', 'rate_limits')
+
+
+def load_reports(paths):
+    reports = []
+    for path in paths:
+        with open(path) as f:
+            reports.append(json.load(f))
+    return reports
+
+
+def metric_values(reports, endpoint: str, metric: str):
+    """The metric for endpoint in every report that has it"""
+    return report_values(reports, endpoint, METRICS[metric][0])
+
+
+def report_values(reports, endpoint: str, path):
+    values = []
+    for report in reports:
+        value = report.get('endpoints', {}).get(endpoint)
+        for key in path:
+            value = value.get(key) if isinstance(value, dict) else None
+        if value is not None:
+            values.append(value)
+    return values
+
+
+def relative_spread(values):
+    """(max - min) / median, or 0 with fewer than two values"""
+    if len(values) < 2:
+        return 0.0
+    median = statistics.median(values)
+    return (max(values) - min(values)) / median if median else 0.0
+
+
+def setting_mismatches(baseline, candidate):
+    """Run settings that differ between the first baseline and candidate reports"""
+    base_meta = baseline[0].get('meta', {})
+    cand_meta = candidate[0].get('meta', {})
+    return [name for name in COMPARABLE_SETTINGS if base_meta.get(name) != cand_meta.get(name)]
+
+
+def compare(baseline, candidate, endpoints=DEFAULT_ENDPOINTS, metrics=DEFAULT_METRICS, threshold: float = 0.10,
+            noise_factor: float = 1.0, latency_floor_ms: float = 2.0, max_error_rate_increase: float = 0.01):
+    """Rows of (endpoint, metric, baseline, candidate, change, tolerance, status)
+
+    status is 'ok', 'improved', 'regressed', or 'missing' when the
+    candidate has no samples for an endpoint the baseline covers.
+    Endpoints absent from the baseline are skipped.
+    """
+    rows = []
+    for endpoint in endpoints:
+        if not metric_values(baseline, endpoint, 'throughput_rps'):
+            continue
+        if not metric_values(candidate, endpoint, 'throughput_rps'):
+            rows.append({'endpoint': endpoint, 'metric': 'requests', 'baseline': None, 'candidate': None,
+                         'change': None, 'tolerance': None, 'status': 'missing'})
+            continue
+
+        for metric in metrics:
+            base_values = metric_values(baseline, endpoint, metric)
+            cand_values = metric_values(candidate, endpoint, metric)
+            if not base_values or not cand_values:
+                continue
+            base, cand = statistics.median(base_values), statistics.median(cand_values)
+            higher_is_better = METRICS[metric][1]
+            noise = max(relative_spread(base_values), relative_spread(cand_values))
+            tolerance = max(threshold, noise_factor * noise)
+            change = (cand - base) / base if base else 0.0
+            worse = -change if higher_is_better else change
+            status = 'ok'
+            if worse > tolerance and (higher_is_better or cand - base > latency_floor_ms):
+                status = 'regressed'
+            elif worse < -tolerance and (higher_is_better or base - cand > latency_floor_ms):
+                status = 'improved'
+            rows.append({'endpoint': endpoint, 'metric': metric, 'baseline': base, 'candidate': cand,
+                         'change': change, 'tolerance': tolerance, 'status': status})
+
+        base_errors = statistics.median(report_values(baseline, endpoint, ('error_rate',)))
+        cand_errors = statistics.median(report_values(candidate, endpoint, ('error_rate',)))
+        rows.append({'endpoint': endpoint, 'metric': 'error_rate', 'baseline': base_errors, 'candidate': cand_errors,
+                     'change': cand_errors - base_errors, 'tolerance': max_error_rate_increase,
+                     'status': 'regressed' if cand_errors - base_errors > max_error_rate_increase else 'ok'})
+    return rows
+
+
+def format_table(rows):
+    """Render comparison rows as a text table"""
+    lines = [f"{'endpoint':<28} {'metric':<15} {'baseline':>10} {'candidate':>10} {'change':>8} {'allowed':>8}  status"]
+    for row in rows:
+        if row['status'] == 'missing':
+            lines.append(f"{row['endpoint']:<28} {row['metric']:<15} {'':>10} {'':>10} {'':>8} {'':>8}  MISSING")
+            continue
+        absolute = row['metric'] == 'error_rate'
+        change = f"{row['change']:+.3f}" if absolute else f"{row['change']:+.1%}"
+        allowed = f"{row['tolerance']:.3f}" if absolute else f"{row['tolerance']:.0%}"
+        status = row['status'].upper() if row['status'] == 'regressed' else row['status']
+        lines.append(f"{row['endpoint']:<28} {row['metric']:<15} {row['baseline']:>10.2f} {row['candidate']:>10.2f} "
+                     f"{change:>8} {allowed:>8}  {status}")
+    return "\n".join(lines)
+
+
+def failed(rows):
+    return [row for row in rows if row['status'] in ('regressed', 'missing')]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fail when a load test regressed against a baseline")
+    parser.add_argument('--baseline', nargs='+', required=True, help="baseline loadtest.py JSON reports")
+    parser.add_argument('--candidate', nargs='+', required=True, help="candidate loadtest.py JSON reports")
+    parser.add_argument('--endpoints', nargs='+', default=DEFAULT_ENDPOINTS)
+    parser.add_argument('--metrics', nargs='+', default=DEFAULT_METRICS, choices=sorted(METRICS))
+    parser.add_argument('--threshold', type=float, default=0.10, help="minimum relative change that fails")
+    parser.add_argument('--noise-factor', type=float, default=1.0,
+                        help="widen the threshold to this multiple of the run-to-run spread")
+    parser.add_argument('--latency-floor-ms', type=float, default=2.0, help="ignore smaller latency changes")
+    parser.add_argument('--max-error-rate-increase', type=float, default=0.01)
+    args = parser.parse_args()
+
+    baseline = load_reports(args.baseline)
+    candidate = load_reports(args.candidate)
+    mismatches = setting_mismatches(baseline, candidate)
+    if mismatches:
+        print(f"warning: runs used different settings for {', '.join(mismatches)}; results may not be comparable")
+    rows = compare(baseline, candidate, args.endpoints, args.metrics, args.threshold, args.noise_factor,
+                   args.latency_floor_ms, args.max_error_rate_increase)
+    print(format_table(rows))
+    regressions = failed(rows)
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) beyond tolerance")
+        sys.exit(1)
+    print("\nNo regressions beyond tolerance")
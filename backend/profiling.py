@@ -0,0 +1,470 @@
+"""Opt-in sampled profiles of single requests.
+
+A request is profiled when an admin armed the profiler for the next N
+requests (optionally under a path prefix), when it carries an X-Profile
+header matching PROFILING_TOKEN, or when it is picked by the sampling
+rate. Otherwise the middleware is a single attribute check.
+
+While a profile is active, a sampler thread looks at the request's asyncio
+tasks every interval. The task running the request and any tasks it
+spawns (e.g. the one asyncio.wait_for runs the OpenAI call in) are tracked
+through a task factory installed on the loop only while profiling:
+
+* a task executing on the loop contributes its live stack to both the
+  wall-clock and the CPU profile;
+* a suspended task contributes its await chain (ending in "(awaiting)")
+  to the wall-clock profile only, so time spent waiting on OpenAI or
+  MongoDB shows up under the line that awaited it.
+
+Stacks of spawned tasks are prefixed with the stack that spawned them, so
+the OpenAI call appears under the route rather than as a separate root.
+
+Each task is sampled on its own, so wall-clock totals can exceed the
+request's duration while several of its tasks are alive.
+
+Profiles are kept in memory and can be downloaded as collapsed stacks
+(flamegraph.pl, speedscope) or speedscope JSON. With several worker
+processes, give the Profiler a MongoProfileStore: the armed count is then
+claimed atomically from MongoDB (each worker picks up arming within
+sync_interval) and finished profiles are saved there, so any worker can
+list and serve them.
+"""
+import asyncio
+import contextvars
+import hmac
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+import weakref
+from collections import Counter, deque
+
+from pymongo import ReturnDocument
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = b'x-profile'
+AWAITING = '(awaiting)'
+
+_active = contextvars.ContextVar('request_profile', default=None)
+
+
+def _label(code):
+    return f"{code.co_qualname} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def coroutine_stack(coro):
+    """Labels of a suspended coroutine's await chain, outermost first"""
+    labels = []
+    while coro is not None:
+        frame = getattr(coro, 'cr_frame', None) or getattr(coro, 'gi_frame', None) or getattr(coro, 'ag_frame', None)
+        if frame is None:
+            break
+        labels.append(_label(frame.f_code))
+        coro = getattr(coro, 'cr_await', None) or getattr(coro, 'gi_yieldfrom', None) or getattr(coro, 'ag_await', None)
+    return labels
+
+
+def running_stack(frame, root):
+    """Labels of a thread's stack from the root frame down, outermost first"""
+    labels = []
+    while frame is not None:
+        labels.append(_label(frame.f_code))
+        if frame is root:
+            break
+        frame = frame.f_back
+    labels.reverse()
+    return labels
+
+
+class RequestProfile:
+    """Sampled stacks of one request"""
+
+    def __init__(self, method: str, path: str, reason: str, interval: float, max_seconds: float):
+        self.id = uuid.uuid4().hex[:12]
+        self.method = method
+        self.path = path
+        self.reason = reason
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.duration = None
+        self.status = None
+        self.wall = Counter()
+        self.cpu = Counter()
+        self.tasks = weakref.WeakSet()
+        self.origins = weakref.WeakKeyDictionary()
+        self.loop = None
+        self.thread_id = None
+
+    @property
+    def finished(self):
+        return self.duration is not None
+
+    def adopt(self, task, frame):
+        """Track a task spawned by the request, remembering where it was spawned from"""
+        parent = asyncio.current_task()
+        origin = ()
+        if parent is not None and parent in self.tasks and getattr(parent.get_coro(), 'cr_running', False):
+            origin = self.origins.get(parent, ()) + tuple(running_stack(frame, parent.get_coro().cr_frame))
+        self.origins[task] = origin
+        self.tasks.add(task)
+
+    def sample(self, loop_frame):
+        """Record one sample of every live task belonging to the request"""
+        for task in list(self.tasks):
+            if task.done():
+                continue
+            coro = task.get_coro()
+            origin = self.origins.get(task, ())
+            if getattr(coro, 'cr_running', False) and loop_frame is not None:
+                stack = origin + tuple(running_stack(loop_frame, coro.cr_frame))
+                self.wall[stack] += 1
+                self.cpu[stack] += 1
+            else:
+                stack = coroutine_stack(coro)
+                if stack:
+                    self.wall[origin + tuple(stack) + (AWAITING,)] += 1
+
+    def summary(self):
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "reason": self.reason,
+            "status": self.status,
+            "started_at": self.started_at,
+            "duration_ms": round(self.duration * 1000, 2) if self.finished else None,
+            "interval_ms": self.interval * 1000,
+            "wall_samples": sum(self.wall.values()),
+            "cpu_samples": sum(self.cpu.values()),
+            "cpu_ms": round(sum(self.cpu.values()) * self.interval * 1000, 2),
+        }
+
+    def to_document(self):
+        return {
+            "id": self.id,
+            "summary": self.summary(),
+            "started_at": self.started_at,
+            "wall": [{"stack": list(stack), "count": count} for stack, count in self.wall.items()],
+            "cpu": [{"stack": list(stack), "count": count} for stack, count in self.cpu.items()],
+        }
+
+    @classmethod
+    def from_document(cls, document):
+        summary = document["summary"]
+        profile = cls(summary["method"], summary["path"], summary["reason"], summary["interval_ms"] / 1000, 0)
+        profile.id = summary["id"]
+        profile.started_at = summary["started_at"]
+        profile.status = summary["status"]
+        profile.duration = (summary["duration_ms"] or 0) / 1000
+        profile.wall = Counter({tuple(item["stack"]): item["count"] for item in document["wall"]})
+        profile.cpu = Counter({tuple(item["stack"]): item["count"] for item in document["cpu"]})
+        return profile
+
+    def collapsed(self, kind: str = 'wall'):
+        """Folded stacks, one 'frame;frame;frame count' line per distinct stack"""
+        stacks = self.cpu if kind == 'cpu' else self.wall
+        return "".join(f"{';'.join(stack)} {count}\n" for stack, count in sorted(stacks.items()))
+
+    def speedscope(self):
+        """Speedscope file with the wall-clock and CPU profiles, weighted in milliseconds"""
+        frames = []
+        index = {}
+
+        def profile(name, stacks):
+            samples = []
+            weights = []
+            for stack, count in stacks.items():
+                ids = []
+                for label in stack:
+                    if label not in index:
+                        index[label] = len(frames)
+                        frames.append({"name": label})
+                    ids.append(index[label])
+                samples.append(ids)
+                weights.append(count * self.interval * 1000)
+            return {"type": "sampled", "name": name, "unit": "milliseconds", "startValue": 0,
+                    "endValue": sum(weights), "samples": samples, "weights": weights}
+
+        title = f"{self.method} {self.path}"
+        profiles = [profile(f"{title} (wall)", self.wall), profile(f"{title} (cpu)", self.cpu)]
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "shared": {"frames": frames},
+            "profiles": profiles,
+            "name": f"{title} {self.id}",
+            "exporter": "chatgpt-proxy profiling",
+        }
+
+
+class MongoProfileStore:
+    """Arm state and finished profiles shared by all workers through MongoDB
+
+    The arm state is the {"type": "profiling"} document of the admin
+    collection; profiles go to their own collection, trimmed to the newest keep.
+    """
+
+    def __init__(self, control, profiles, keep: int = 20):
+        self.control = control
+        self.profiles = profiles
+        self.keep = keep
+
+    async def arm(self, count: int, path_prefix: str, sample_rate: float = None):
+        update = {"armed": count, "armed_prefix": path_prefix}
+        if sample_rate is not None:
+            update["sample_rate"] = sample_rate
+        await self.control.update_one({"type": "profiling"}, {"$set": update}, upsert=True)
+
+    async def settings(self):
+        return await self.control.find_one({"type": "profiling"}, {"_id": 0})
+
+    async def claim(self):
+        """Take one armed request; returns how many remain, or None if none were left"""
+        document = await self.control.find_one_and_update(
+            {"type": "profiling", "armed": {"$gt": 0}}, {"$inc": {"armed": -1}},
+            projection={"armed": 1}, return_document=ReturnDocument.AFTER
+        )
+        return None if document is None else document["armed"]
+
+    async def save(self, profile: RequestProfile):
+        await self.profiles.insert_one(profile.to_document())
+        cursor = self.profiles.find({}, {"id": 1}).sort("started_at", -1).skip(self.keep)
+        stale = [document["id"] async for document in cursor]
+        if stale:
+            await self.profiles.delete_many({"id": {"$in": stale}})
+
+    async def recent(self):
+        cursor = self.profiles.find({}, {"summary": 1}).sort("started_at", -1).limit(self.keep)
+        return [document["summary"] async for document in cursor]
+
+    async def get(self, profile_id: str):
+        document = await self.profiles.find_one({"id": profile_id}, {"_id": 0})
+        return RequestProfile.from_document(document) if document else None
+
+
+class Profiler:
+    """Decides which requests to profile, runs the sampler and keeps results"""
+
+    def __init__(self, sample_rate: float = 0.0, token: str = None, interval: float = 0.005,
+                 keep: int = 20, max_seconds: float = 60.0, store: MongoProfileStore = None,
+                 sync_interval: float = 1.0):
+        self.sample_rate = sample_rate
+        self.token = token.encode() if token else None
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self.armed = 0
+        self.armed_prefix = None
+        self.profiles = deque(maxlen=keep)
+        self._running = []
+        self._lock = threading.Lock()
+        self._sampler = None
+        self._factories = {}
+        self.store = store
+        self.sync_interval = sync_interval
+        self._sync_task = None
+
+    async def arm(self, count: int = 1, path_prefix: str = None, sample_rate: float = None):
+        """Profile the next count requests under path_prefix; optionally change the sampling rate"""
+        if self.store is not None:
+            await self.store.arm(count, path_prefix, sample_rate)
+        self.armed = count
+        self.armed_prefix = path_prefix
+        if sample_rate is not None:
+            self.sample_rate = sample_rate
+
+    async def claim(self):
+        """Take one of the armed requests, from the count shared with other workers if there is a store"""
+        if self.store is None:
+            if self.armed <= 0:
+                return False
+            self.armed -= 1
+            return True
+        remaining = await self.store.claim()
+        self.armed = remaining or 0
+        return remaining is not None
+
+    def start(self):
+        """Follow the shared arm state; call from the running loop"""
+        if self.store is not None and self._sync_task is None:
+            self._sync_task = asyncio.create_task(self._sync())
+
+    async def stop(self):
+        if self._sync_task is not None:
+            self._sync_task.cancel()
+            try:
+                await self._sync_task
+            except asyncio.CancelledError:
+                pass
+            self._sync_task = None
+
+    async def _sync(self):
+        while True:
+            try:
+                settings = await self.store.settings()
+                if settings:
+                    self.armed = settings.get("armed", 0)
+                    self.armed_prefix = settings.get("armed_prefix")
+                    self.sample_rate = settings.get("sample_rate", self.sample_rate)
+            except Exception as e:
+                logger.warning("Profiler settings sync failed: %s", e)
+            await asyncio.sleep(self.sync_interval)
+
+    def wants(self, scope):
+        """Why this request should be profiled, or None"""
+        if not (self.armed or self.sample_rate or self.token):
+            return None
+        if scope['path'].startswith('/api/admin/profiles'):
+            return None
+        if self.token:
+            for name, value in scope['headers']:
+                if name == PROFILE_HEADER and hmac.compare_digest(value, self.token):
+                    return 'header'
+        if self.armed and (not self.armed_prefix or scope['path'].startswith(self.armed_prefix)):
+            # Confirmed by claim(), which may find another worker took the last one
+            return 'armed'
+        if self.sample_rate and random.random() < self.sample_rate:
+            return 'sampled'
+        return None
+
+    def begin(self, method: str, path: str, reason: str):
+        """Start profiling the current task; call from inside the request"""
+        profile = RequestProfile(method, path, reason, self.interval, self.max_seconds)
+        profile.loop = asyncio.get_running_loop()
+        profile.thread_id = threading.get_ident()
+        profile.tasks.add(asyncio.current_task())
+        self._install_factory(profile.loop)
+        with self._lock:
+            self._running.append(profile)
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample, name="request-profiler", daemon=True)
+                self._sampler.start()
+        return profile
+
+    def finish(self, profile: RequestProfile, status: int = None):
+        profile.duration = time.perf_counter() - profile.start
+        profile.status = status
+        with self._lock:
+            if profile in self._running:
+                self._running.remove(profile)
+            still_profiling = any(other.loop is profile.loop for other in self._running)
+        if not still_profiling:
+            self._remove_factory(profile.loop)
+        self.profiles.append(profile)
+
+    def get(self, profile_id: str):
+        for profile in self.profiles:
+            if profile.id == profile_id:
+                return profile
+        return None
+
+    async def save(self, profile: RequestProfile):
+        """Share a finished profile with the other workers"""
+        if self.store is None:
+            return
+        try:
+            await self.store.save(profile)
+        except Exception as e:
+            logger.warning("Saving profile %s failed: %s", profile.id, e)
+
+    async def recent(self):
+        """Summaries of the kept profiles, newest first"""
+        if self.store is not None:
+            return await self.store.recent()
+        return [profile.summary() for profile in reversed(self.profiles)]
+
+    async def load(self, profile_id: str):
+        """A kept profile by id, from any worker if there is a store"""
+        if self.store is not None:
+            return self.get(profile_id) or await self.store.get(profile_id)
+        return self.get(profile_id)
+
+    def _install_factory(self, loop):
+        if loop in self._factories:
+            return
+        previous = loop.get_task_factory()
+
+        def factory(loop, coro, context=None):
+            if previous is not None:
+                task = previous(loop, coro) if context is None else previous(loop, coro, context=context)
+            else:
+                task = asyncio.Task(coro, loop=loop, context=context)
+            profile = context.get(_active) if context is not None else _active.get()
+            if profile is not None and not profile.finished:
+                profile.adopt(task, sys._getframe(1))
+            return task
+
+        self._factories[loop] = (factory, previous)
+        loop.set_task_factory(factory)
+
+    def _remove_factory(self, loop):
+        factory, previous = self._factories.pop(loop, (None, None))
+        if factory is not None and loop.get_task_factory() is factory:
+            loop.set_task_factory(previous)
+
+    def _sample(self):
+        while True:
+            with self._lock:
+                if not self._running:
+                    self._sampler = None
+                    return
+                running = list(self._running)
+            frames = sys._current_frames()
+            now = time.perf_counter()
+            for profile in running:
+                if now - profile.start <= profile.max_seconds:
+                    profile.sample(frames.get(profile.thread_id))
+            time.sleep(self.interval)
+
+    def stats(self):
+        return {
+            "sample_rate": self.sample_rate,
+            "header_enabled": self.token is not None,
+            "armed": self.armed,
+            "armed_prefix": self.armed_prefix,
+            "interval_ms": self.interval * 1000,
+            "running": len(self._running),
+            "shared": self.store is not None,
+        }
+
+
+class ProfilingMiddleware:
+    """Pure ASGI middleware profiling the requests the profiler asks for
+
+    The profile id is returned in an X-Profile-Id response header.
+    """
+
+    def __init__(self, app, profiler: Profiler):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        reason = self.profiler.wants(scope) if scope['type'] == 'http' else None
+        if reason == 'armed' and not await self.profiler.claim():
+            reason = None
+        if reason is None:
+            await self.app(scope, receive, send)
+            return
+
+        profile = self.profiler.begin(scope['method'], scope['path'], reason)
+        token = _active.set(profile)
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                message = {**message, 'headers': list(message.get('headers', [])) +
+                           [(b'x-profile-id', profile.id.encode())]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _active.reset(token)
+            self.profiler.finish(profile, status)
+            await self.profiler.save(profile)
@@ -0,0 +1,199 @@
+"""Token-bucket rate limits on requests and tokens per minute.
+
+Each request is checked against a fixed set of buckets: requests/minute
+and tokens/minute for the user, for the API key source and globally. A
+bucket holds up to a minute's allowance and refills continuously, so short
+bursts pass while the sustained rate stays capped. A request is admitted
+only if every bucket has room (nothing is deducted otherwise); when one is
+short, the caller gets the wait until it refills for a Retry-After.
+
+Prompt tokens are taken up front and completion tokens charged once the
+reply is known, which may leave a bucket in debt for later requests.
+
+Buckets live in process by default, so each worker process (see
+WEB_CONCURRENCY in run.py) and each instance enforces the limits on its
+own: N workers admit up to N times the configured rates. The Mongo backend
+shares them across workers and instances (e.g. several Cloud Run
+containers), with each bucket refilled and taken in one atomic update.
+"""
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+
+class RateLimited(Exception):
+    """Raised when a request exceeds a limit; retry_after is in seconds"""
+
+    def __init__(self, scope: str, retry_after: float):
+        super().__init__(f"Rate limit exceeded for {scope}")
+        self.scope = scope
+        self.retry_after = retry_after
+
+
+class LocalBucketBackend:
+    """In-process buckets in an LRU map
+
+    Evicting an idle bucket is harmless since it would have refilled anyway,
+    so the map can be bounded without tracking expiry.
+    """
+
+    def __init__(self, maxsize: int = 100000):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+
+    def _refilled(self, key, rate, capacity, now):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [capacity, now]
+            if len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+        return bucket
+
+    async def take(self, checks, now: float):
+        """Deduct cost from every bucket if all have room; else return the longest wait"""
+        waits = []
+        buckets = []
+        for key, rate, capacity, cost in checks:
+            bucket = self._refilled(key, rate, capacity, now)
+            buckets.append(bucket)
+            if bucket[0] < cost:
+                waits.append((key, (cost - bucket[0]) / rate))
+        if waits:
+            return max(waits, key=lambda wait: wait[1])
+        for bucket, (_, _, _, cost) in zip(buckets, checks):
+            bucket[0] -= cost
+        return None
+
+    async def charge(self, key, rate, capacity, amount, now: float):
+        """Deduct amount unconditionally, allowing debt"""
+        self._refilled(key, rate, capacity, now)[0] -= amount
+
+
+class MongoBucketBackend:
+    """Buckets shared through a collection with a TTL index on expires_at"""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def _refill(self, rate, capacity, now):
+        return {"$min": [capacity, {"$add": [
+            {"$ifNull": ["$tokens", capacity]},
+            {"$multiply": [{"$subtract": [now, {"$ifNull": ["$updated", now]}]}, rate]}
+        ]}]}
+
+    @staticmethod
+    async def _upsert(update):
+        try:
+            return await update()
+        except DuplicateKeyError:
+            # A concurrent request created the bucket first; it exists now, so update it
+            return await update()
+
+    async def _take_one(self, key, rate, capacity, cost, now):
+        expires_at = datetime.utcnow() + timedelta(seconds=capacity / rate)
+        doc = await self._upsert(lambda: self.collection.find_one_and_update(
+            {"_id": key},
+            [
+                {"$set": {"tokens": self._refill(rate, capacity, now), "updated": now, "expires_at": expires_at}},
+                {"$set": {"allowed": {"$gte": ["$tokens", cost]}}},
+                {"$set": {"tokens": {"$cond": ["$allowed", {"$subtract": ["$tokens", cost]}, "$tokens"]}}}
+            ],
+            projection={"tokens": 1, "allowed": 1},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        ))
+        return None if doc["allowed"] else (cost - doc["tokens"]) / rate
+
+    async def take(self, checks, now: float):
+        """Take from each bucket in turn, refunding earlier ones if a later one is short"""
+        taken = []
+        for key, rate, capacity, cost in checks:
+            wait = await self._take_one(key, rate, capacity, cost, now)
+            if wait is not None:
+                for refund_key, refund_cost in taken:
+                    await self.collection.update_one({"_id": refund_key}, {"$inc": {"tokens": refund_cost}})
+                return key, wait
+            taken.append((key, cost))
+        return None
+
+    async def charge(self, key, rate, capacity, amount, now: float):
+        await self._upsert(lambda: self.collection.update_one(
+            {"_id": key},
+            [{"$set": {"tokens": {"$subtract": [self._refill(rate, capacity, now), amount]}, "updated": now}}],
+            upsert=True
+        ))
+
+
+class RateLimiter:
+    """Per-user, per-key-source and global limits on requests and tokens per minute
+
+    limits maps a scope ('user', 'source', 'global') to a
+    (requests_per_minute, tokens_per_minute) pair; a 0 or None entry is
+    unlimited.
+    """
+
+    SCOPES = ('user', 'source', 'global')
+
+    def __init__(self, limits: dict, backend=None, clock=time.time):
+        self.backend = backend or LocalBucketBackend()
+        self.clock = clock
+        self.limits = {}
+        for scope in self.SCOPES:
+            requests, tokens = limits.get(scope) or (0, 0)
+            self.limits[scope] = (requests or 0, tokens or 0)
+        self.allowed = 0
+        self.limited = 0
+
+    @property
+    def enabled(self):
+        return any(requests or tokens for requests, tokens in self.limits.values())
+
+    def _subjects(self, user_id: str, source: str):
+        return (('user', user_id), ('source', source), ('global', '*'))
+
+    def _checks(self, user_id, source, prompt_tokens):
+        checks = []
+        for scope, subject in self._subjects(user_id, source):
+            requests, tokens = self.limits[scope]
+            if requests:
+                checks.append((f"{scope}:{subject}:rpm", requests / 60.0, requests, 1))
+            if tokens:
+                checks.append((f"{scope}:{subject}:tpm", tokens / 60.0, tokens, min(prompt_tokens, tokens)))
+        return checks
+
+    async def check(self, user_id: str, source: str, prompt_tokens: int = 0):
+        """Admit a request or raise RateLimited"""
+        checks = self._checks(user_id, source, prompt_tokens)
+        if not checks:
+            return
+        denied = await self.backend.take(checks, self.clock())
+        if denied is not None:
+            self.limited += 1
+            key, wait = denied
+            kind = 'requests' if key.endswith(':rpm') else 'tokens'
+            raise RateLimited(f"{key.split(':', 1)[0]} {kind} per minute", wait)
+        self.allowed += 1
+
+    async def charge(self, user_id: str, source: str, tokens: int):
+        """Charge tokens used by the reply to the token buckets"""
+        if not tokens:
+            return
+        now = self.clock()
+        for scope, subject in self._subjects(user_id, source):
+            limit = self.limits[scope][1]
+            if limit:
+                await self.backend.charge(f"{scope}:{subject}:tpm", limit / 60.0, limit, tokens, now)
+
+    def stats(self):
+        return {
+            "limits": {scope: {"requests_per_minute": r, "tokens_per_minute": t} for scope, (r, t) in self.limits.items()},
+            "allowed": self.allowed,
+            "limited": self.limited
+        }
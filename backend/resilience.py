@@ -0,0 +1,275 @@
+"""Retry, deadline, hedging and circuit-breaker policy for upstream calls.
+
+UpstreamPolicy.call(attempt) runs attempt() (one OpenAI request) under:
+
+* a per-attempt timeout and a total deadline across all attempts;
+* retries of transient failures (429, 5xx, timeouts, connection errors)
+  with exponential backoff and full jitter, never sooner than the
+  upstream's Retry-After;
+* optional hedging: when an attempt is slower than the recent p95
+  latency, a second identical request is raced against it and the first
+  answer wins. The hedge needs its own concurrency slot from the caller's
+  hedge_slot (see FairScheduler.try_slot), so hedging never exceeds the
+  per-key cap and is skipped when the key is busy;
+* a circuit breaker that fails fast while most recent calls failed with
+  upstream errors, then lets a single probe through after a cooldown.
+
+429s are not counted by the breaker since they are specific to one key.
+Failures surface as UpstreamError with the status the proxy should return.
+"""
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+
+import openai
+
+logger = logging.getLogger(__name__)
+
+
+class UpstreamError(Exception):
+    """A failed upstream call, with the status and Retry-After to relay"""
+
+    def __init__(self, status_code: int, detail: str, retry_after: float = None):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+class CircuitOpen(UpstreamError):
+    def __init__(self, retry_after: float):
+        super().__init__(503, "The upstream model API is degraded, please retry shortly", retry_after)
+
+
+def retry_after_seconds(error):
+    """Seconds requested by a Retry-After (or retry-after-ms) header, if any"""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if not headers:
+        return None
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        if headers.get('retry-after'):
+            return float(headers['retry-after'])
+    except ValueError:
+        return None
+    return None
+
+
+def classify(error):
+    """(retryable, counts_against_breaker, status_to_return) for an attempt failure"""
+    if isinstance(error, asyncio.TimeoutError) or isinstance(error, openai.APITimeoutError):
+        return True, True, 504
+    if isinstance(error, openai.RateLimitError):
+        return True, False, 429
+    if isinstance(error, openai.APIStatusError):
+        if error.status_code >= 500:
+            return True, True, 502
+        # A rejected API key is the proxy's problem, not the caller's credentials
+        return False, False, 502 if error.status_code in (401, 403) else error.status_code
+    if isinstance(error, openai.APIConnectionError):
+        return True, True, 502
+    return False, False, 500
+
+
+class LatencyTracker:
+    """Recent successful attempt latencies with a cached quantile"""
+
+    def __init__(self, size: int = 200, min_samples: int = 20, recompute_every: int = 10):
+        self.samples = deque(maxlen=size)
+        self.min_samples = min_samples
+        self.recompute_every = recompute_every
+        self._since = 0
+        self._quantile = None
+
+    def observe(self, seconds: float):
+        self.samples.append(seconds)
+        self._since += 1
+
+    def quantile(self, q: float):
+        if len(self.samples) < self.min_samples:
+            return None
+        if self._quantile is None or self._since >= self.recompute_every:
+            ordered = sorted(self.samples)
+            self._quantile = ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+            self._since = 0
+        return self._quantile
+
+
+class CircuitBreaker:
+    """Opens when failure_ratio of the last window outcomes were upstream failures"""
+
+    def __init__(self, window: int = 20, failure_ratio: float = 0.5, min_calls: int = 10,
+                 cooldown: float = 30.0, clock=time.monotonic):
+        self.outcomes = deque(maxlen=window)
+        self.failure_ratio = failure_ratio
+        self.min_calls = min_calls
+        self.cooldown = cooldown
+        self.clock = clock
+        self.opened_at = None
+        self._probing = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if self.clock() - self.opened_at >= self.cooldown:
+            return "half_open"
+        return "open"
+
+    def before(self):
+        """Raise CircuitOpen unless a call may proceed"""
+        state = self.state
+        if state == "open" or (state == "half_open" and self._probing):
+            remaining = self.cooldown - (self.clock() - self.opened_at)
+            raise CircuitOpen(max(1.0, remaining))
+        if state == "half_open":
+            self._probing = True
+
+    def record(self, success: bool):
+        if self.opened_at is not None:
+            # Outcome of the half-open probe decides whether to close again
+            self._probing = False
+            if success:
+                self.opened_at = None
+                self.outcomes.clear()
+            else:
+                self.opened_at = self.clock()
+            return
+        self.outcomes.append(success)
+        failures = self.outcomes.count(False)
+        if len(self.outcomes) >= self.min_calls and failures >= self.failure_ratio * len(self.outcomes):
+            logger.warning("Opening upstream circuit: %s/%s recent calls failed", failures, len(self.outcomes))
+            self.opened_at = self.clock()
+
+    def release(self):
+        """Forget an in-flight probe that ended without an upstream verdict"""
+        self._probing = False
+
+
+class UpstreamPolicy:
+    """Runs upstream attempts with deadlines, retries, hedging and a breaker"""
+
+    def __init__(self, attempt_timeout: float = 60.0, total_timeout: float = 120.0, max_attempts: int = 3,
+                 backoff_base: float = 0.5, backoff_max: float = 8.0, hedge: bool = False,
+                 hedge_quantile: float = 0.95, breaker: CircuitBreaker = None, latency: LatencyTracker = None):
+        self.attempt_timeout = attempt_timeout
+        self.total_timeout = total_timeout
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.breaker = breaker or CircuitBreaker()
+        self.latency = latency or LatencyTracker()
+        self.retries = 0
+        self.hedges = 0
+        self.hedges_skipped = 0
+        self.hedge_wins = 0
+
+    def backoff(self, attempt: int, retry_after: float = None):
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        return max(delay, retry_after or 0)
+
+    async def _timed(self, attempt, timeout, observe=True):
+        start = time.perf_counter()
+        result = await asyncio.wait_for(attempt(), timeout=timeout)
+        if observe:
+            self.latency.observe(time.perf_counter() - start)
+        return result
+
+    async def _hedged(self, attempt, timeout, hedge_allowed, hedge_slot=None, observe=True):
+        """One attempt, raced against a second one if it outlasts the hedge delay"""
+        delay = self.latency.quantile(self.hedge_quantile) if hedge_allowed else None
+        if delay is None or delay >= timeout:
+            return await self._timed(attempt, timeout, observe)
+
+        primary = asyncio.ensure_future(self._timed(attempt, timeout))
+        tasks = [primary]
+        release = None
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                release = hedge_slot() if hedge_slot is not None else (lambda: None)
+                if release is None:
+                    self.hedges_skipped += 1
+                else:
+                    self.hedges += 1
+                    tasks.append(asyncio.ensure_future(self._timed(attempt, timeout - delay)))
+            pending = set(tasks)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            self.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            unfinished = [task for task in tasks if not task.done()]
+            for task in unfinished:
+                task.cancel()
+            # Let cancelled attempts finish closing their connections
+            await asyncio.gather(*unfinished, return_exceptions=True)
+            if release is not None:
+                release()
+
+    async def call(self, attempt, hedge: bool = True, hedge_slot=None):
+        """Run attempt() until it succeeds, fails permanently, or the deadline passes
+
+        hedge=False disables hedging for this call (e.g. streaming requests)
+        and keeps its latency out of the samples that set the hedge delay.
+        hedge_slot() is asked for an extra concurrency slot before hedging and
+        returns a release callable, or None to skip the hedge.
+        """
+        self.breaker.before()
+        deadline = time.monotonic() + self.total_timeout
+        counted = False
+        try:
+            for number in range(self.max_attempts):
+                remaining = deadline - time.monotonic()
+                try:
+                    result = await self._hedged(attempt, min(self.attempt_timeout, remaining), self.hedge and hedge,
+                                                hedge_slot, observe=hedge)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    retryable, breaker_failure, status = classify(e)
+                    if breaker_failure:
+                        self.breaker.record(False)
+                        counted = True
+                        # Fail fast if this failure opened the circuit
+                        if self.breaker.state != "closed":
+                            raise UpstreamError(503, "The upstream model API is degraded, please retry shortly",
+                                                self.breaker.cooldown) from e
+                    retry_after = retry_after_seconds(e)
+                    if not retryable or number == self.max_attempts - 1:
+                        raise UpstreamError(status, f"Upstream request failed: {e}", retry_after) from e
+                    wait = self.backoff(number, retry_after)
+                    if time.monotonic() + wait >= deadline:
+                        raise UpstreamError(status, f"Upstream request failed: {e}", retry_after) from e
+                    self.retries += 1
+                    logger.info("Retrying upstream request in %.2fs after: %s", wait, e)
+                    await asyncio.sleep(wait)
+                    continue
+                self.breaker.record(True)
+                counted = True
+                return result
+        finally:
+            if not counted:
+                self.breaker.release()
+
+    def stats(self):
+        return {
+            "circuit": self.breaker.state,
+            "retries": self.retries,
+            "hedges": self.hedges,
+            "hedges_skipped": self.hedges_skipped,
+            "hedge_wins": self.hedge_wins,
+            "hedge_delay": self.latency.quantile(self.hedge_quantile) if self.hedge else None
+        }
@@ -0,0 +1,110 @@
+"""Exact-match cache for chat completions.
+
+Entries are keyed by (model, system prompt, normalized user message, key
+scope) and kept in a local in-memory tier in front of a pluggable shared
+backend (MongoDB by default).
+"""
+import hashlib
+import json
+import logging
+import re
+import unicodedata
+from datetime import datetime, timedelta
+
+from cache import MISSING, TTLCache
+
+logger = logging.getLogger(__name__)
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_message(text: str):
+    """Canonical form of a prompt: NFC, trimmed, internal whitespace collapsed"""
+    return _WHITESPACE.sub(" ", unicodedata.normalize("NFC", text)).strip()
+
+
+def key_scope(api_key_info: dict, user_id: str):
+    """Cache scope for a resolved key; personal keys never share entries"""
+    if api_key_info['source'] == 'user_specific':
+        return f"user_specific:{user_id}"
+    return api_key_info['source']
+
+
+def cache_key(model: str, system_prompt: str, user_message: str, scope: str):
+    """Stable hash of everything that determines the completion"""
+    material = json.dumps([model, system_prompt, normalize_message(user_message), scope])
+    return hashlib.sha256(material.encode()).hexdigest()
+
+
+class MongoCacheBackend:
+    """Shared tier stored in a collection with a TTL index on expires_at"""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def get(self, key: str):
+        doc = await self.collection.find_one({"_id": key}, {"response": 1, "expires_at": 1})
+        # The TTL monitor only runs once a minute, so check expiry here too
+        if doc and doc["expires_at"] > datetime.utcnow():
+            return doc["response"]
+        return None
+
+    async def set(self, key: str, response: str, ttl: float):
+        now = datetime.utcnow()
+        await self.collection.update_one(
+            {"_id": key},
+            {"$set": {"response": response, "created_at": now, "expires_at": now + timedelta(seconds=ttl)}},
+            upsert=True
+        )
+
+
+class ResponseCache:
+    """Local TTL/LRU tier in front of an optional shared backend"""
+
+    def __init__(self, backend=None, local_size: int = 1000, ttl: float = 3600.0):
+        self.backend = backend
+        self.ttl = ttl
+        self.local = TTLCache(maxsize=local_size, ttl=ttl)
+        self.local_hits = 0
+        self.backend_hits = 0
+        self.misses = 0
+
+    async def get(self, key: str):
+        """Return a cached response or None"""
+        response = self.local.get(key, record=False)
+        if response is not MISSING:
+            self.local_hits += 1
+            return response
+        if self.backend is not None:
+            try:
+                response = await self.backend.get(key)
+            except Exception as e:
+                logger.warning("Response cache backend read failed: %s", e)
+                response = None
+            if response is not None:
+                self.backend_hits += 1
+                self.local.set(key, response)
+                return response
+        self.misses += 1
+        return None
+
+    async def set(self, key: str, response: str):
+        """Store a response in both tiers"""
+        self.local.set(key, response)
+        if self.backend is not None:
+            try:
+                await self.backend.set(key, response, self.ttl)
+            except Exception as e:
+                logger.warning("Response cache backend write failed: %s", e)
+
+    def stats(self):
+        """Hit counters per tier and overall hit rate"""
+        hits = self.local_hits + self.backend_hits
+        total = hits + self.misses
+        return {
+            "local_hits": self.local_hits,
+            "backend_hits": self.backend_hits,
+            "misses": self.misses,
+            "hit_rate": hits / total if total else 0.0,
+            "local_size": len(self.local)
+        }
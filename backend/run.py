@@ -0,0 +1,66 @@
+"""Production entry point: multi-worker uvicorn with tuned settings.
+
+Settings come from the environment:
+
+    WEB_CONCURRENCY              worker processes (default: available CPUs)
+    PORT                         listen port (default 8001, set by Cloud Run)
+    UVICORN_BACKLOG              listen backlog (default 2048)
+    UVICORN_KEEP_ALIVE           idle keep-alive timeout in seconds (default 75)
+    UVICORN_GRACEFUL_TIMEOUT     seconds to drain in-flight requests, including
+                                 streaming chats, after SIGTERM (default 8)
+    UVICORN_LIMIT_CONCURRENCY    max concurrent connections per worker (optional)
+    UVICORN_ACCESS_LOG           'true' to add uvicorn's own access lines (off by
+                                 default: RequestLogMiddleware logs every request)
+
+Logging is left to structured_logging (LOG_* variables): uvicorn's loggers
+go through the same queued JSON pipeline instead of their own handlers.
+
+uvloop and httptools are used automatically when installed.
+"""
+import os
+
+import uvicorn
+
+from structured_logging import configure_logging_from_env
+
+
+def available_cpus():
+    """CPUs this process may use, honouring cgroup v2 quotas (e.g. Cloud Run --cpu)"""
+    try:
+        count = len(os.sched_getaffinity(0))
+    except AttributeError:
+        count = os.cpu_count() or 1
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()
+        if quota != 'max':
+            count = min(count, max(1, int(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return count
+
+
+def uvicorn_options(env=os.environ):
+    """Keyword arguments for uvicorn.run derived from the environment"""
+    limit_concurrency = env.get('UVICORN_LIMIT_CONCURRENCY')
+    return {
+        'host': env.get('HOST', '0.0.0.0'),
+        'port': int(env.get('PORT', 8001)),
+        'workers': int(env.get('WEB_CONCURRENCY') or available_cpus()),
+        'loop': 'auto',
+        'http': 'auto',
+        'backlog': int(env.get('UVICORN_BACKLOG', 2048)),
+        # Longer than typical load balancer idle timeouts so the proxy closes first
+        'timeout_keep_alive': int(env.get('UVICORN_KEEP_ALIVE', 75)),
+        'timeout_graceful_shutdown': int(env.get('UVICORN_GRACEFUL_TIMEOUT', 8)),
+        'limit_concurrency': int(limit_concurrency) if limit_concurrency else None,
+        'access_log': env.get('UVICORN_ACCESS_LOG', 'false').lower() == 'true',
+        'log_config': None,
+        'proxy_headers': True,
+        'forwarded_allow_ips': env.get('FORWARDED_ALLOW_IPS', '*'),
+    }
+
+
+if __name__ == "__main__":
+    configure_logging_from_env()
+    uvicorn.run("server:app", **uvicorn_options())
@@ -0,0 +1,147 @@
+"""Semantic cache: reuse answers for paraphrased prompts.
+
+Prompts are embedded, searched against previously answered prompt vectors
+in the same key scope, and the stored answer is returned when the cosine
+similarity clears a threshold. Embedders and vector indexes are pluggable;
+the defaults are an OpenAI embedding model and a brute-force NumPy index.
+"""
+import hashlib
+import re
+
+import numpy as np
+
+from response_cache import normalize_message
+
+_TOKEN = re.compile(r"\w+")
+
+
+class HashingEmbedder:
+    """Deterministic local embedder using hashed word and character n-grams
+
+    Needs no network, so it suits tests and offline evaluation.
+    """
+
+    def __init__(self, dim: int = 512):
+        self.dim = dim
+
+    def _features(self, text: str):
+        words = _TOKEN.findall(normalize_message(text).lower())
+        for word in words:
+            yield word, 1.0
+            padded = f"#{word}#"
+            for i in range(len(padded) - 2):
+                yield padded[i:i + 3], 0.5
+        for first, second in zip(words, words[1:]):
+            yield f"{first} {second}", 1.0
+
+    def embed_one(self, text: str):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for feature, weight in self._features(text):
+            digest = hashlib.blake2b(feature.encode(), digest_size=8).digest()
+            bucket = int.from_bytes(digest[:4], 'little') % self.dim
+            sign = 1.0 if digest[4] & 1 else -1.0
+            vector[bucket] += sign * weight
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    async def __call__(self, texts, api_key: str = None):
+        return np.stack([self.embed_one(text) for text in texts])
+
+
+class OpenAIEmbedder:
+    """Embeds prompts with the OpenAI embeddings API using pooled clients"""
+
+    def __init__(self, client_registry, model: str = "text-embedding-3-small"):
+        self.client_registry = client_registry
+        self.model = model
+
+    async def __call__(self, texts, api_key: str = None):
+        async with self.client_registry.client(api_key) as client:
+            result = await client.embeddings.create(model=self.model, input=list(texts))
+        vectors = np.array([item.embedding for item in result.data], dtype=np.float32)
+        return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+class NumpyIndex:
+    """Brute-force cosine index over a fixed-capacity ring buffer of unit vectors"""
+
+    def __init__(self, dim: int, capacity: int = 10000):
+        self.vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self.payloads = [None] * capacity
+        self.capacity = capacity
+        self.size = 0
+        self._next = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, vector, payload):
+        """Store a unit vector, overwriting the oldest entry when full"""
+        self.vectors[self._next] = vector
+        self.payloads[self._next] = payload
+        self._next = (self._next + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def search(self, vector):
+        """Best (similarity, payload) match, or (0.0, None) when empty"""
+        if not self.size:
+            return 0.0, None
+        scores = self.vectors[:self.size] @ vector
+        best = int(np.argmax(scores))
+        return float(scores[best]), self.payloads[best]
+
+
+class SemanticCache:
+    """Per-scope vector indexes of answered prompts"""
+
+    def __init__(self, embedder, threshold: float = 0.92, capacity: int = 10000, index_factory=None):
+        self.embedder = embedder
+        self.threshold = threshold
+        self.capacity = capacity
+        self.index_factory = index_factory or (lambda dim: NumpyIndex(dim, capacity))
+        self.indexes = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def embed(self, message: str, api_key: str = None):
+        return (await self.embedder([message], api_key))[0]
+
+    def _index(self, scope: str, dim: int):
+        index = self.indexes.get(scope)
+        if index is None:
+            index = self.indexes[scope] = self.index_factory(dim)
+        return index
+
+    def search(self, vector, scope: str):
+        """Best (similarity, response) in a scope, ignoring the threshold"""
+        index = self.indexes.get(scope)
+        if index is None:
+            return 0.0, None
+        return index.search(vector)
+
+    async def lookup(self, message: str, scope: str, api_key: str = None):
+        """Return (response, similarity, vector); response is None below the threshold
+
+        The vector is returned so a miss can be stored without re-embedding.
+        """
+        vector = await self.embed(message, api_key)
+        similarity, response = self.search(vector, scope)
+        if response is not None and similarity >= self.threshold:
+            self.hits += 1
+            return response, similarity, vector
+        self.misses += 1
+        return None, similarity, vector
+
+    def add(self, vector, scope: str, response: str):
+        """Remember the answer for an embedded prompt"""
+        self._index(scope, len(vector)).add(vector, response)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "threshold": self.threshold,
+            "entries": sum(len(index) for index in self.indexes.values())
+        }
@@ -0,0 +1,107 @@
+"""Offline evaluation of the semantic cache against exported chat history.
+
+Export chats (one JSON document per line) and sweep similarity thresholds:
+
+    mongoexport --uri "$MONGO_URL" --db "$DB_NAME" --collection chats --out chats.jsonl
+    python semantic_eval.py chats.jsonl --thresholds 0.8 0.85 0.9 0.95 --output sweep.json
+
+Chats are replayed in timestamp order. Each prompt is matched against the
+prompts answered before it in the same key scope, so the reported hit rate
+is what the cache would have achieved had it been enabled for that period.
+The default embedder is the local hashing embedder, so no network is needed.
+"""
+import argparse
+import asyncio
+import json
+from datetime import datetime
+
+from bson import json_util
+
+from response_cache import normalize_message
+from semantic_cache import HashingEmbedder, SemanticCache
+
+DEFAULT_THRESHOLDS = [0.80, 0.85, 0.90, 0.92, 0.95, 0.98]
+
+
+def load_chats(path: str):
+    """Read a mongoexport JSON-lines file or a JSON array of chat records"""
+    with open(path) as f:
+        content = f.read().strip()
+    if content.startswith('['):
+        return json_util.loads(content)
+    return [json_util.loads(line) for line in content.splitlines() if line.strip()]
+
+
+def chat_scope(chat: dict):
+    """Key scope of a stored chat, matching response_cache.key_scope"""
+    source = chat.get('api_key_source') or 'unknown'
+    if source == 'user_specific':
+        return f"user_specific:{chat.get('user_id')}"
+    return source
+
+
+async def replay(chats, embedder=None, thresholds=DEFAULT_THRESHOLDS, batch_size: int = 256):
+    """Replay chats through a semantic cache and report hit rate per threshold"""
+    embedder = embedder or HashingEmbedder()
+    chats = sorted(
+        (chat for chat in chats if chat.get('user_message') and chat.get('assistant_response')),
+        key=lambda chat: chat.get('timestamp') or datetime.min
+    )
+    cache = SemanticCache(embedder, capacity=max(len(chats), 1))
+    similarities = []
+    exact_repeats = 0
+    seen = set()
+
+    for start in range(0, len(chats), batch_size):
+        batch = chats[start:start + batch_size]
+        vectors = await embedder([chat['user_message'] for chat in batch])
+        for chat, vector in zip(batch, vectors):
+            scope = chat_scope(chat)
+            similarity, _ = cache.search(vector, scope)
+            similarities.append(similarity)
+            normalized = (scope, normalize_message(chat['user_message']))
+            exact_repeats += normalized in seen
+            seen.add(normalized)
+            cache.add(vector, scope, chat['assistant_response'])
+
+    total = len(similarities)
+    return {
+        'chats': total,
+        'exact_repeats': exact_repeats,
+        'exact_hit_rate': exact_repeats / total if total else 0.0,
+        'sweep': [
+            {
+                'threshold': threshold,
+                'hits': sum(similarity >= threshold for similarity in similarities),
+                'hit_rate': sum(similarity >= threshold for similarity in similarities) / total if total else 0.0,
+            }
+            for threshold in sorted(thresholds)
+        ],
+    }
+
+
+def format_report(report: dict):
+    """Render a sweep report as a small text table"""
+    lines = [
+        f"chats replayed: {report['chats']}, exact repeats: {report['exact_repeats']} "
+        f"({report['exact_hit_rate']:.1%})",
+        f"{'threshold':>9}  {'hits':>7}  {'hit rate':>8}",
+    ]
+    for row in report['sweep']:
+        lines.append(f"{row['threshold']:>9.2f}  {row['hits']:>7}  {row['hit_rate']:>8.1%}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay exported chats through the semantic cache")
+    parser.add_argument('path', help="mongoexport JSON-lines file or JSON array of chats")
+    parser.add_argument('--thresholds', type=float, nargs='+', default=DEFAULT_THRESHOLDS)
+    parser.add_argument('--dim', type=int, default=512, help="hashing embedder dimensions")
+    parser.add_argument('--output', help="write the report as JSON to this path")
+    args = parser.parse_args()
+
+    report = asyncio.run(replay(load_chats(args.path), HashingEmbedder(args.dim), args.thresholds))
+    print(format_report(report))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -1,26 +1,53 @@
-from fastapi import FastAPI, Request, HTTPException, Depends, status
+from fastapi import FastAPI, Request, HTTPException, Depends, Query, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, RedirectResponse
+from fastapi.responses import JSONResponse, RedirectResponse, StreamingResponse, Response
 from starlette.middleware.sessions import SessionMiddleware
 from authlib.integrations.starlette_client import OAuth
-from openai import OpenAI, AsyncOpenAI
-from pymongo import MongoClient
+from openai import OpenAI
+from pymongo import ReturnDocument
 from pydantic import BaseModel
 from typing import Optional, List
+from contextlib import asynccontextmanager
 import os
+import asyncio
+import hashlib
+import math
+import time
 import jwt
 import json
 import uuid
 from datetime import datetime, timedelta
 import logging
 from dotenv import load_dotenv
+from database import Database, create_client
+from openai_clients import OpenAIClientRegistry
+from cache import TTLCache, MISSING
+from indexes import migrate
+from response_cache import ResponseCache, MongoCacheBackend, cache_key, key_scope
+from semantic_cache import SemanticCache, HashingEmbedder, OpenAIEmbedder
+from metrics import (
+    MetricsMiddleware, MongoCommandMetrics, UPSTREAM_LATENCY, TIME_TO_FIRST_TOKEN,
+    monitor_event_loop_lag, record_usage, render_metrics
+)
+from loop_monitor import LoopBlockingDetector
+from chat_history import FULL_PROJECTION, SUMMARY_PROJECTION, HISTORY_SORT, add_previews, encode_cursor, decode_cursor, history_query
+from conversations import new_conversation_id, load_recent_messages, append_turn
+from context_window import ContextBuilder, store_token_counts
+from write_behind import WriteBehindQueue
+from upstream_scheduler import FairScheduler, QueueTimeout
+from rate_limit import RateLimiter, RateLimited, MongoBucketBackend
+from resilience import UpstreamPolicy, UpstreamError, CircuitBreaker
+from profiling import MongoProfileStore, Profiler, ProfilingMiddleware
+from tracing import CLIENT, Tracer, TracingMiddleware
+from structured_logging import RequestLogMiddleware, bind_request, configure_logging_from_env
+from summaries import BackgroundJobs, CONVERSATION_SUMMARY_PROJECTION, after_checkpoint, summarize_conversation
 
 # Load environment variables
 load_dotenv()
 
-# Setup logging
-logging.basicConfig(level=logging.INFO)
+# Setup logging: JSON lines (or LOG_FORMAT=text) written by a background thread
+log_listener = configure_logging_from_env()
 logger = logging.getLogger(__name__)
 
 # Environment variables
@@ -31,10 +58,162 @@ GOOGLE_CLIENT_SECRET = os.environ.get('GOOGLE_CLIENT_SECRET')
 OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY')
 ADMIN_EMAILS = os.environ.get('ADMIN_EMAILS', '').split(',') if os.environ.get('ADMIN_EMAILS') else []
 ENVIRONMENT = os.environ.get('ENVIRONMENT', 'development')
+ENSURE_INDEXES_ON_STARTUP = os.environ.get('ENSURE_INDEXES_ON_STARTUP', 'true').lower() == 'true'
+RESPONSE_CACHE_ENABLED = os.environ.get('RESPONSE_CACHE_ENABLED', 'false').lower() == 'true'
+RESPONSE_CACHE_BACKEND = os.environ.get('RESPONSE_CACHE_BACKEND', 'mongo')
+SEMANTIC_CACHE_ENABLED = os.environ.get('SEMANTIC_CACHE_ENABLED', 'false').lower() == 'true'
+SEMANTIC_CACHE_EMBEDDER = os.environ.get('SEMANTIC_CACHE_EMBEDDER', 'openai')
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+LOOP_DIAGNOSTICS = os.environ.get('LOOP_DIAGNOSTICS', 'false').lower() == 'true'
+CONTEXT_TURNS = max(1, int(os.environ.get('CONTEXT_TURNS', 50)))
+# Rolling summaries: fold older turns once this many tokens are unsummarized (0 disables)
+SUMMARY_TRIGGER_TOKENS = int(os.environ.get('SUMMARY_TRIGGER_TOKENS', 3000))
+SUMMARY_KEEP_TURNS = int(os.environ.get('SUMMARY_KEEP_TURNS', 4))
 FRONTEND_URL = os.environ.get('FRONTEND_URL', 'https://2e51ad72-7b0f-492c-a172-3771d8f293ac.preview.emergentagent.com')
 
+# Database setup
+mongo = Database(create_client(MONGO_URL, event_listeners=[MongoCommandMetrics()]), DB_NAME)
+users_collection = mongo.users
+chats_collection = mongo.chats
+admin_collection = mongo.admin
+messages_collection = mongo.messages
+conversations_collection = mongo.conversations
+
+# Chat records are written in batches off the request path
+CHAT_WRITE_BEHIND = os.environ.get('CHAT_WRITE_BEHIND', 'true').lower() == 'true'
+chat_writer = WriteBehindQueue(
+    write=lambda docs: chats_collection.insert_many(docs, ordered=False),
+    max_size=int(os.environ.get('CHAT_WRITE_QUEUE_SIZE', 10000)),
+    batch_size=int(os.environ.get('CHAT_WRITE_BATCH_SIZE', 100)),
+    flush_interval=float(os.environ.get('CHAT_WRITE_FLUSH_INTERVAL', 0.25)),
+    spill_path=os.environ.get('CHAT_WRITE_SPILL_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'chat_history_spill'))
+)
+
+# Opt-in cache of completions for repeated prompts
+response_cache = ResponseCache(
+    backend=MongoCacheBackend(mongo.response_cache) if RESPONSE_CACHE_BACKEND == 'mongo' else None,
+    local_size=int(os.environ.get('RESPONSE_CACHE_LOCAL_SIZE', 1000)),
+    ttl=float(os.environ.get('RESPONSE_CACHE_TTL', 3600))
+) if RESPONSE_CACHE_ENABLED else None
+
+# Shared OpenAI clients, one keep-alive pool per resolved API key
+openai_clients = OpenAIClientRegistry(
+    max_clients=int(os.environ.get('OPENAI_CLIENT_CACHE_SIZE', 32)),
+    idle_timeout=float(os.environ.get('OPENAI_CLIENT_IDLE_TIMEOUT', 300))
+)
+
+# Per-key cap on concurrent upstream calls; waiters are served fairly per user
+upstream_scheduler = FairScheduler(
+    max_concurrency=int(os.environ.get('UPSTREAM_MAX_CONCURRENCY', 16)),
+    quantum=int(os.environ.get('UPSTREAM_DRR_QUANTUM', 1000)),
+    queue_timeout=float(os.environ.get('UPSTREAM_QUEUE_TIMEOUT', 30))
+)
+
+# Deadlines, retries, hedging and circuit breaking for OpenAI calls
+upstream_policy = UpstreamPolicy(
+    attempt_timeout=float(os.environ.get('UPSTREAM_ATTEMPT_TIMEOUT', 60)),
+    total_timeout=float(os.environ.get('UPSTREAM_TOTAL_TIMEOUT', 120)),
+    max_attempts=int(os.environ.get('UPSTREAM_MAX_ATTEMPTS', 3)),
+    backoff_base=float(os.environ.get('UPSTREAM_BACKOFF_BASE', 0.5)),
+    backoff_max=float(os.environ.get('UPSTREAM_BACKOFF_MAX', 8)),
+    hedge=os.environ.get('UPSTREAM_HEDGE', 'false').lower() == 'true',
+    hedge_quantile=float(os.environ.get('UPSTREAM_HEDGE_QUANTILE', 0.95)),
+    breaker=CircuitBreaker(
+        window=int(os.environ.get('UPSTREAM_BREAKER_WINDOW', 20)),
+        failure_ratio=float(os.environ.get('UPSTREAM_BREAKER_FAILURE_RATIO', 0.5)),
+        cooldown=float(os.environ.get('UPSTREAM_BREAKER_COOLDOWN', 30))
+    )
+)
+
+# Token-bucket limits on requests and tokens per minute (0 disables a limit)
+rate_limiter = RateLimiter(
+    limits={
+        'user': (int(os.environ.get('RATE_LIMIT_USER_RPM', 60)), int(os.environ.get('RATE_LIMIT_USER_TPM', 60000))),
+        'source': (int(os.environ.get('RATE_LIMIT_SOURCE_RPM', 0)), int(os.environ.get('RATE_LIMIT_SOURCE_TPM', 0))),
+        'global': (int(os.environ.get('RATE_LIMIT_GLOBAL_RPM', 0)), int(os.environ.get('RATE_LIMIT_GLOBAL_TPM', 0)))
+    },
+    backend=MongoBucketBackend(mongo.rate_limits) if os.environ.get('RATE_LIMIT_BACKEND', 'memory') == 'mongo' else None
+)
+
+# Opt-in cache of answers for paraphrased prompts, checked after exact matches
+semantic_cache = SemanticCache(
+    embedder=OpenAIEmbedder(openai_clients, os.environ.get('SEMANTIC_CACHE_EMBEDDING_MODEL', 'text-embedding-3-small'))
+    if SEMANTIC_CACHE_EMBEDDER == 'openai' else HashingEmbedder(),
+    threshold=float(os.environ.get('SEMANTIC_CACHE_THRESHOLD', 0.92)),
+    capacity=int(os.environ.get('SEMANTIC_CACHE_CAPACITY', 10000))
+) if SEMANTIC_CACHE_ENABLED else None
+
+# Request spans, exported to a file or an OTLP collector when TRACING_EXPORTER is set
+tracer = Tracer.from_env()
+
+# Opt-in per-request profiles, triggered by an admin, a header token or sampling.
+# Arm state and results live in MongoDB so every worker process shares them.
+PROFILING_KEEP = int(os.environ.get('PROFILING_KEEP', 20))
+profiler = Profiler(
+    sample_rate=float(os.environ.get('PROFILING_SAMPLE_RATE', 0)),
+    token=os.environ.get('PROFILING_TOKEN'),
+    interval=float(os.environ.get('PROFILING_INTERVAL_MS', 5)) / 1000,
+    keep=PROFILING_KEEP,
+    max_seconds=float(os.environ.get('PROFILING_MAX_SECONDS', 60)),
+    store=MongoProfileStore(admin_collection, mongo.profiles, keep=PROFILING_KEEP)
+)
+
+# Diagnostic mode that reports blocking callbacks with a stack sample
+summary_jobs = BackgroundJobs()
+# Conversation writes queued per conversation, after the response is sent
+turn_jobs = BackgroundJobs()
+loop_detector = LoopBlockingDetector(
+    threshold=float(os.environ.get('LOOP_BLOCK_THRESHOLD_MS', 100)) / 1000
+) if LOOP_DIAGNOSTICS else None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Start background tasks and release shared resources on shutdown"""
+    if ENSURE_INDEXES_ON_STARTUP:
+        try:
+            await migrate(mongo)
+        except Exception as e:
+            logger.error("Index bootstrap failed: %s", e)
+    # Token encodings may be downloaded on first use; load them off the loop now
+    await context_builder.preload([CHAT_MODEL])
+    openai_clients.start()
+    if CHAT_WRITE_BEHIND:
+        chat_writer.start()
+    loop_lag_monitor = asyncio.create_task(monitor_event_loop_lag())
+    profiler.start()
+    if loop_detector:
+        loop_detector.start()
+    yield
+    await turn_jobs.drain()
+    await summary_jobs.drain()
+    await chat_writer.stop()
+    if loop_detector:
+        await loop_detector.stop()
+    loop_lag_monitor.cancel()
+    await profiler.stop()
+    await openai_clients.aclose()
+    tracer.shutdown()
+    mongo.close()
+
+# Resolved default API key, invalidated by the admin endpoint that changes it.
+# Personal keys are read from the (cached) user document.
+API_KEY_CACHE_TTL = float(os.environ.get('API_KEY_CACHE_TTL', 30))
+default_api_key_cache = TTLCache(maxsize=1, ttl=API_KEY_CACHE_TTL)
+
+# Authentication caches: verified tokens live until they expire (capped),
+# user documents for a short TTL and are invalidated by admin mutations in
+# this process only; admin endpoints bypass user_cache (get_current_user_uncached)
+token_cache = TTLCache(
+    maxsize=int(os.environ.get('TOKEN_CACHE_SIZE', 10000)),
+    ttl=float(os.environ.get('TOKEN_CACHE_TTL', 3600))
+)
+user_cache = TTLCache(
+    maxsize=int(os.environ.get('USER_CACHE_SIZE', 10000)),
+    ttl=float(os.environ.get('USER_CACHE_TTL', 10))
+)
+
 # Initialize FastAPI app
-app = FastAPI(title="ChatGPT Proxy POC Application", version="1.0.0")
+app = FastAPI(title="ChatGPT Proxy POC Application", version="1.0.0", lifespan=lifespan)
 
 # Configure CORS for production
 if ENVIRONMENT == 'production':
@@ -47,6 +226,7 @@ if ENVIRONMENT == 'production':
         allow_credentials=True,
         allow_methods=["*"],
         allow_headers=["*"],
+        expose_headers=["X-Trace-Id"],
     )
 else:
     app.add_middleware(
@@ -55,11 +235,25 @@ else:
         allow_credentials=True,
         allow_methods=["*"],
         allow_headers=["*"],
+        expose_headers=["X-Trace-Id"],
     )
 
 # Add session middleware
 app.add_middleware(SessionMiddleware, secret_key="your-secret-key-here")
 
+# Request latency covers the session and CORS layers, routing and the handler;
+# the profiling, logging and tracing middlewares added below wrap it
+app.add_middleware(MetricsMiddleware)
+
+# Added after metrics so a profile covers the metrics middleware too
+app.add_middleware(ProfilingMiddleware, profiler=profiler)
+
+# Per-request log context and access line, inside the span so they carry its trace id
+app.add_middleware(RequestLogMiddleware)
+
+# Outermost, so every other layer and log line runs inside the request span
+app.add_middleware(TracingMiddleware, tracer=tracer)
+
 # Initialize OAuth
 oauth = OAuth()
 oauth.register(
@@ -72,25 +266,23 @@ oauth.register(
     }
 )
 
-# Database setup
-client = MongoClient(MONGO_URL)
-db = client[DB_NAME]
-users_collection = db.users
-chats_collection = db.chats
-admin_collection = db.admin
-messages_collection = db.messages
-
 # Security
 security = HTTPBearer()
 
 # Pydantic models
 class ChatMessage(BaseModel):
     message: str
+    conversation_id: Optional[str] = None
 
 class AdminConfig(BaseModel):
     openai_key: str
     user_email: Optional[str] = None
 
+class ProfilingRequest(BaseModel):
+    count: int = 1
+    path_prefix: Optional[str] = None
+    sample_rate: Optional[float] = None
+
 class UserProfile(BaseModel):
     email: str
     name: str
@@ -108,34 +300,70 @@ def create_jwt_token(user_data: dict):
     return jwt.encode(payload, 'secret-key', algorithm='HS256')
 
 def verify_jwt_token(token: str):
-    """Verify JWT token"""
+    """Verify JWT token, reusing earlier verifications until the token expires"""
+    token_hash = hashlib.sha256(token.encode()).hexdigest()
+    payload = token_cache.get(token_hash)
+    if payload is not MISSING:
+        return payload
     try:
         payload = jwt.decode(token, 'secret-key', algorithms=['HS256'])
-        return payload
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token expired")
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
+    ttl = min(payload['exp'] - time.time(), token_cache.ttl)
+    if ttl > 0:
+        token_cache.set(token_hash, payload, ttl=ttl)
+    return payload
 
-def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    """Get current user from token"""
+async def load_current_user(credentials: HTTPAuthorizationCredentials, use_cache: bool = True):
+    """Verify the token and load its user, from user_cache when use_cache is set"""
     token = credentials.credentials
-    payload = verify_jwt_token(token)
-    user = users_collection.find_one({"user_id": payload['user_id']})
-    if not user:
-        raise HTTPException(status_code=401, detail="User not found")
+    with tracer.span("auth.verify_token"):
+        payload = verify_jwt_token(token)
+    with tracer.span("auth.user_lookup") as span:
+        user = user_cache.get(payload['user_id']) if use_cache else MISSING
+        span.set_attribute("cache.hit", user is not MISSING)
+        if user is MISSING:
+            user = await users_collection.find_one({"user_id": payload['user_id']})
+            if not user:
+                user_cache.invalidate(payload['user_id'])
+                raise HTTPException(status_code=401, detail="User not found")
+            user_cache.set(payload['user_id'], user)
+    bind_request(user_id=user['user_id'])
     return user
 
-def get_user_api_key(user_id: str):
-    """Get user's assigned API key"""
-    user = users_collection.find_one({"user_id": user_id})
-    if user and user.get('api_key'):
-        return {'key': user['api_key'], 'source': 'user_specific'}
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Get current user from token"""
+    return await load_current_user(credentials)
+
+async def get_current_user_uncached(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Get current user from token, read from the database rather than user_cache
+
+    Used by admin endpoints: user_cache is per process, so another worker's
+    invalidation does not reach it, and a revoked is_admin or a deleted user
+    would otherwise stay authorized here for up to USER_CACHE_TTL.
+    """
+    return await load_current_user(credentials, use_cache=False)
+
+async def get_user_api_key(user: dict):
+    """Get the API key for a user document: their own key, else the default"""
+    user_key = user.get('api_key')
+    if user_key:
+        return {'key': user_key, 'source': 'user_specific'}
     
+    return await get_default_api_key()
+
+async def get_default_api_key():
+    """Get the key used by users without a personal key"""
     # Check for default admin key
-    admin_config = admin_collection.find_one({"type": "default"})
-    if admin_config and admin_config.get('api_key'):
-        return {'key': admin_config.get('api_key'), 'source': 'default_admin'}
+    default_key = default_api_key_cache.get('default')
+    if default_key is MISSING:
+        admin_config = await admin_collection.find_one({"type": "default"})
+        default_key = admin_config.get('api_key') if admin_config else None
+        default_api_key_cache.set('default', default_key)
+    if default_key:
+        return {'key': default_key, 'source': 'default_admin'}
     
     # Fallback to environment variable
     if OPENAI_API_KEY:
@@ -143,11 +371,183 @@ def get_user_api_key(user_id: str):
     
     return None  # No API key available
 
+def invalidate_user_cache(user_id: Optional[str]):
+    """Drop a user's cached document, including their API key, after an admin changes it"""
+    if user_id:
+        user_cache.invalidate(user_id)
+
+CHAT_MODEL = "gpt-4"
+SYSTEM_PROMPT = "You are a helpful assistant."
+
+context_builder = ContextBuilder.from_env()
+
+def build_chat_messages(user_message: str, history: Optional[list] = None, summary: Optional[dict] = None):
+    """Build the prompt sent upstream: system prompt, conversation summary, the
+    earlier turns that fit the model's token budget, then the new message
+    
+    Returns (messages, context); see ContextBuilder.build.
+    """
+    return context_builder.build(
+        CHAT_MODEL, SYSTEM_PROMPT, after_checkpoint(history or [], summary), user_message, summary=summary
+    )
+
+async def record_turn(conversation_id: str, user_id: str, user_message: str, response: str, context: dict, api_key: str):
+    """Store a finished exchange with its token counts cached on the messages,
+    scheduling a summary once enough of the conversation is unsummarized
+
+    Runs as a turn_jobs job so the writes stay off the response path.
+    """
+    await store_token_counts(messages_collection, context["counted"])
+    tokens = (context["user_tokens"], context_builder.count(CHAT_MODEL, response))
+    conversation = await append_turn(
+        messages_collection, conversations_collection, conversation_id, user_id, user_message, response, tokens
+    )
+    if SUMMARY_TRIGGER_TOKENS and conversation.get("unsummarized_tokens", 0) >= SUMMARY_TRIGGER_TOKENS:
+        summary_jobs.schedule(conversation_id, summarize_in_background, conversation_id, user_id, api_key)
+
+async def summarize_in_background(conversation_id: str, user_id: str, api_key: str):
+    """Background job folding older turns into the conversation summary"""
+    async def complete(messages):
+        cost = sum(context_builder.count(CHAT_MODEL, message["content"]) for message in messages)
+        async with upstream_scheduler.slot(api_key, user_id, cost, 'summary'), openai_clients.client(api_key) as client:
+            completion = await upstream_policy.call(
+                lambda: client.chat.completions.create(model=CHAT_MODEL, messages=messages), hedge=False
+            )
+        record_usage('summary', getattr(completion, 'usage', None))
+        return completion.choices[0].message.content
+    
+    summary = await summarize_conversation(
+        messages_collection, conversations_collection, conversation_id, user_id, complete,
+        count=lambda text: context_builder.count(CHAT_MODEL, text), keep_turns=SUMMARY_KEEP_TURNS
+    )
+    if summary:
+        logger.info("Summarized %s messages of conversation %s", summary['messages'], conversation_id)
+
+async def enforce_rate_limit(user_id: str, source: str, prompt_tokens: int):
+    """Admit a chat request or reject it with 429 and Retry-After"""
+    try:
+        await rate_limiter.check(user_id, source, prompt_tokens)
+    except RateLimited as e:
+        raise HTTPException(
+            status_code=429,
+            detail=f"Rate limit exceeded ({e.scope}), please retry later",
+            headers={"Retry-After": str(max(1, math.ceil(e.retry_after)))}
+        )
+    except Exception as e:
+        # A shared limiter backend outage should not take chat down with it
+        logger.error("Rate limiter unavailable: %s", e)
+
+async def charge_completion(user_id: str, source: str, usage, response: str):
+    """Charge the reply's tokens to the rate limiter's token buckets"""
+    tokens = getattr(usage, 'completion_tokens', None) or context_builder.count(CHAT_MODEL, response)
+    try:
+        await rate_limiter.charge(user_id, source, tokens)
+    except Exception as e:
+        logger.error("Rate limiter unavailable: %s", e)
+
+async def load_conversation_context(message: ChatMessage, user_id: str):
+    """Resolve the conversation and load its summary and recent turns
+    
+    The two reads run concurrently. Returns (conversation_id, history,
+    summary). A new conversation is started when no conversation_id is
+    given; an unknown one is a 404.
+    """
+    if not message.conversation_id:
+        return new_conversation_id(), [], None
+    # Read this worker's own pending writes to the conversation
+    await turn_jobs.wait(message.conversation_id)
+    history, conversation = await asyncio.gather(
+        load_recent_messages(messages_collection, message.conversation_id, user_id, CONTEXT_TURNS),
+        conversations_collection.find_one(
+            {"conversation_id": message.conversation_id, "user_id": user_id}, CONVERSATION_SUMMARY_PROJECTION
+        )
+    )
+    if not history:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    return message.conversation_id, history, (conversation or {}).get("summary")
+
+async def find_cached_response(user_id: str, user_message: str, api_key_info: dict, history: Optional[list] = None):
+    """Look a prompt up in the exact, then the semantic response cache
+    
+    Returns (response, cache_type, pending). After a miss, pass pending to
+    store_cached_response so the new answer is cached without re-embedding.
+    Only the first turn of a conversation is cacheable, since later answers
+    depend on the earlier turns.
+    """
+    if history:
+        return None, None, None
+    scope = key_scope(api_key_info, user_id)
+    pending = {"scope": f"{CHAT_MODEL}:{scope}", "exact_key": None, "vector": None}
+    if response_cache is not None:
+        pending["exact_key"] = cache_key(CHAT_MODEL, SYSTEM_PROMPT, user_message, scope)
+        response = await response_cache.get(pending["exact_key"])
+        if response is not None:
+            return response, "exact", pending
+    if semantic_cache is not None:
+        try:
+            response, _, pending["vector"] = await semantic_cache.lookup(user_message, pending["scope"], api_key_info['key'])
+        except Exception as e:
+            logger.warning("Semantic cache lookup failed: %s", e)
+            response = None
+        if response is not None:
+            return response, "semantic", pending
+    return None, None, pending
+
+async def store_cached_response(pending: dict, response: str):
+    """Cache a fresh answer in the tiers that missed"""
+    if pending is None:
+        return
+    if pending["exact_key"]:
+        await response_cache.set(pending["exact_key"], response)
+    if pending["vector"] is not None:
+        semantic_cache.add(pending["vector"], pending["scope"], response)
+
+def create_chat_record(user_id: str, session_id: str, user_message: str, response: str, api_key_source: str, cached: bool = False):
+    """Build the chat history document for a completed exchange"""
+    return add_previews({
+        "chat_id": str(uuid.uuid4()),
+        "user_id": user_id,
+        "session_id": session_id,
+        "user_message": user_message,
+        "assistant_response": response,
+        "timestamp": datetime.utcnow(),
+        "api_key_source": api_key_source,
+        "cached": cached
+    })
+
+def upstream_span_attributes(api_key_info: dict, context: dict):
+    """Attributes of an upstream call span, following the GenAI semantic conventions"""
+    return {
+        "gen_ai.system": "openai",
+        "gen_ai.request.model": CHAT_MODEL,
+        "api_key.source": api_key_info['source'],
+        "chat.prompt_tokens.estimated": context.get("prompt_tokens"),
+    }
+
+def record_span_usage(span, usage):
+    """Copy token counts reported by OpenAI onto an upstream call span"""
+    if usage is not None:
+        span.set_attribute("gen_ai.usage.input_tokens", getattr(usage, 'prompt_tokens', None))
+        span.set_attribute("gen_ai.usage.output_tokens", getattr(usage, 'completion_tokens', None))
+
+def sse_event(data: dict, event: Optional[str] = None):
+    """Format a server-sent event"""
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
 # Routes
 @app.get("/")
 async def root():
     return {"message": "ChatGPT Proxy POC Application API"}
 
+@app.get("/metrics")
+async def metrics(request: Request):
+    """Prometheus metrics; requires METRICS_TOKEN as a bearer token when set"""
+    if METRICS_TOKEN and request.headers.get('authorization') != f"Bearer {METRICS_TOKEN}":
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+    content, content_type = render_metrics()
+    return Response(content=content, media_type=content_type)
+
 @app.get("/api/login/google")
 async def google_login(request: Request):
     """Initiate Google OAuth login"""
@@ -155,8 +555,8 @@ async def google_login(request: Request):
         # Use the frontend URL as the redirect URI
         redirect_uri = f"{FRONTEND_URL}/auth/google"
         return await oauth.google.authorize_redirect(request, redirect_uri)
-    except Exception as e:
-        logger.error(f"Google login error: {str(e)}")
+    except Exception:
+        logger.exception("Google login error")
         raise HTTPException(status_code=500, detail="Login failed")
 
 @app.get("/auth/google")
@@ -181,17 +581,17 @@ async def google_auth(request: Request):
         }
         
         # Check if user exists
-        existing_user = users_collection.find_one({"email": user_info['email']})
+        existing_user = await users_collection.find_one({"email": user_info['email']})
         if existing_user:
             # Update last login
-            users_collection.update_one(
+            await users_collection.update_one(
                 {"email": user_info['email']},
                 {"$set": {"last_login": datetime.utcnow()}}
             )
             user_data['user_id'] = existing_user['user_id']
         else:
             # Create new user
-            users_collection.insert_one(user_data)
+            await users_collection.insert_one(user_data)
         
         # Create JWT token
         jwt_token = create_jwt_token(user_data)
@@ -202,8 +602,8 @@ async def google_auth(request: Request):
             status_code=302
         )
         
-    except Exception as e:
-        logger.error(f"Google auth error: {str(e)}")
+    except Exception:
+        logger.exception("Google auth error")
         raise HTTPException(status_code=500, detail="Authentication failed")
 
 @app.get("/api/user/profile")
@@ -227,7 +627,10 @@ async def send_message(
         user_id = current_user['user_id']
         
         # Get user's API key
-        api_key_info = get_user_api_key(user_id)
+        with tracer.span("api_key.resolve") as span:
+            api_key_info = await get_user_api_key(current_user)
+            span.set_attribute("api_key.source", api_key_info['source'] if api_key_info else None)
+            bind_request(key_source=api_key_info['source'] if api_key_info else None)
         if not api_key_info:
             raise HTTPException(
                 status_code=400, 
@@ -236,66 +639,282 @@ async def send_message(
         
         api_key = api_key_info['key']
         
-        # Create chat session
-        session_id = f"chat_{user_id}_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}"
-        client = AsyncOpenAI(api_key=api_key)
-        
-        # Send message
-        chat_completion = await client.chat.completions.create(
-            model="gpt-4",
-            messages=[
-                {"role": "system", "content": "You are a helpful assistant."},
-                {"role": "user", "content": message.message}
-            ]
-        )
-        response = chat_completion.choices[0].message.content
+        # Continue or start a conversation
+        conversation_id, history, summary = await load_conversation_context(message, user_id)
+        session_id = conversation_id
+        upstream_messages, context = build_chat_messages(message.message, history, summary)
+        await enforce_rate_limit(user_id, api_key_info['source'], context["prompt_tokens"])
+        
+        # Serve repeated prompts from the response caches
+        response, cache_type, pending = await find_cached_response(user_id, message.message, api_key_info, history)
+        cached = response is not None
+        
+        if not cached:
+            # Send message
+            async with upstream_scheduler.slot(api_key, user_id, context["prompt_tokens"], api_key_info['source']):
+                upstream_start = time.perf_counter()
+                with tracer.span("openai.chat.completions", CLIENT, **upstream_span_attributes(api_key_info, context)) as span:
+                    async with openai_clients.client(api_key) as client:
+                        chat_completion = await upstream_policy.call(
+                            lambda: client.chat.completions.create(
+                                model=CHAT_MODEL,
+                                messages=upstream_messages
+                            ),
+                            hedge_slot=lambda: upstream_scheduler.try_slot(api_key)
+                        )
+                    record_span_usage(span, getattr(chat_completion, 'usage', None))
+            UPSTREAM_LATENCY.labels(api_key_info['source'], 'false').observe(time.perf_counter() - upstream_start)
+            record_usage(api_key_info['source'], getattr(chat_completion, 'usage', None))
+            response = chat_completion.choices[0].message.content
+            await charge_completion(user_id, api_key_info['source'], getattr(chat_completion, 'usage', None), response)
+            await store_cached_response(pending, response)
         
         # Store chat history
-        chat_record = {
-            "chat_id": str(uuid.uuid4()),
-            "user_id": user_id,
-            "session_id": session_id,
-            "user_message": message.message,
-            "assistant_response": response,
-            "timestamp": datetime.utcnow(),
-            "api_key_source": api_key_info['source']
-        }
-        chats_collection.insert_one(chat_record)
+        with tracer.span("chat_history.insert", **{"chat.cached": cached}):
+            chat_record = create_chat_record(user_id, session_id, message.message, response, api_key_info['source'], cached)
+            await chat_writer.put(chat_record)
+            turn_jobs.chain(conversation_id, record_turn, conversation_id, user_id, message.message, response, context,
+                            api_key)
         
         return {
             "response": response,
             "session_id": session_id,
+            "conversation_id": conversation_id,
             "timestamp": datetime.utcnow().isoformat(),
-            "api_key_source": api_key_info['source']
+            "api_key_source": api_key_info['source'],
+            "cached": cached,
+            "cache_type": cache_type
         }
         
+    except HTTPException:
+        raise
+    except UpstreamError as e:
+        logger.error("Chat upstream error: %s", e.detail)
+        raise HTTPException(
+            status_code=e.status_code,
+            detail=e.detail,
+            headers={"Retry-After": str(max(1, math.ceil(e.retry_after)))} if e.retry_after else None
+        )
+    except QueueTimeout:
+        raise HTTPException(
+            status_code=503,
+            detail="The API key is busy, please retry shortly",
+            headers={"Retry-After": "5"}
+        )
     except Exception as e:
-        logger.error(f"Chat error: {str(e)}")
-        if "No ChatGPT API key configured" in str(e):
-            raise e
+        logger.exception("Chat error")
         raise HTTPException(status_code=500, detail=f"Chat failed: {str(e)}")
 
+@app.post("/api/chat/stream")
+async def stream_message(
+    message: ChatMessage,
+    request: Request,
+    current_user: dict = Depends(get_current_user)
+):
+    """Send message to ChatGPT and stream the reply as server-sent events"""
+    user_id = current_user['user_id']
+    
+    with tracer.span("api_key.resolve") as span:
+        api_key_info = await get_user_api_key(current_user)
+        span.set_attribute("api_key.source", api_key_info['source'] if api_key_info else None)
+        bind_request(key_source=api_key_info['source'] if api_key_info else None)
+    if not api_key_info:
+        raise HTTPException(
+            status_code=400, 
+            detail="No ChatGPT API key configured for your account. Please contact your administrator to configure an API key."
+        )
+    
+    conversation_id, history, summary = await load_conversation_context(message, user_id)
+    session_id = conversation_id
+    upstream_messages, context = build_chat_messages(message.message, history, summary)
+    await enforce_rate_limit(user_id, api_key_info['source'], context["prompt_tokens"])
+    
+    async def event_stream():
+        parts = []
+        usage = None
+        try:
+            # A cached reply is sent as a single delta
+            response, cache_type, pending = await find_cached_response(user_id, message.message, api_key_info, history)
+            cached = response is not None
+            if cached:
+                parts.append(response)
+                yield sse_event({"delta": response})
+            else:
+                async with upstream_scheduler.slot(api_key_info['key'], user_id, context["prompt_tokens"], api_key_info['source']):
+                    upstream_start = time.perf_counter()
+                    span = tracer.start_span("openai.chat.completions", CLIENT, attributes={
+                        **upstream_span_attributes(api_key_info, context), "gen_ai.request.stream": True
+                    })
+                    try:
+                        async with openai_clients.client(api_key_info['key']) as client:
+                            # Retries only cover opening the stream; tokens are never replayed
+                            stream = await upstream_policy.call(
+                                lambda: client.chat.completions.create(
+                                    model=CHAT_MODEL,
+                                    messages=upstream_messages,
+                                    stream=True,
+                                    stream_options={"include_usage": True}
+                                ),
+                                hedge=False
+                            )
+                            try:
+                                async for chunk in stream:
+                                    if await request.is_disconnected():
+                                        logger.info("Client disconnected, cancelling upstream stream for %s", session_id)
+                                        return
+                                    # The final chunk carries usage and no choices
+                                    record_usage(api_key_info['source'], getattr(chunk, 'usage', None))
+                                    usage = getattr(chunk, 'usage', None) or usage
+                                    delta = chunk.choices[0].delta.content if chunk.choices else None
+                                    if delta:
+                                        if not parts:
+                                            TIME_TO_FIRST_TOKEN.labels(api_key_info['source']).observe(time.perf_counter() - upstream_start)
+                                        parts.append(delta)
+                                        yield sse_event({"delta": delta})
+                            finally:
+                                # Closing the stream aborts the upstream HTTP response
+                                await stream.close()
+                    except (asyncio.CancelledError, GeneratorExit):
+                        span.set_attribute("openai.stream.cancelled", True)
+                        raise
+                    except BaseException as e:
+                        span.record_exception(e)
+                        raise
+                    finally:
+                        record_span_usage(span, usage)
+                        span.end()
+                UPSTREAM_LATENCY.labels(api_key_info['source'], 'true').observe(time.perf_counter() - upstream_start)
+                await charge_completion(user_id, api_key_info['source'], usage, "".join(parts))
+                await store_cached_response(pending, "".join(parts))
+            
+            # Store chat history once the full reply has been assembled
+            with tracer.span("chat_history.insert", **{"chat.cached": cached}):
+                chat_record = create_chat_record(user_id, session_id, message.message, "".join(parts), api_key_info['source'], cached)
+                await chat_writer.put(chat_record)
+                turn_jobs.chain(conversation_id, record_turn, conversation_id, user_id, message.message, "".join(parts),
+                                context, api_key_info['key'])
+            
+            yield sse_event({
+                "session_id": session_id,
+                "conversation_id": conversation_id,
+                "timestamp": datetime.utcnow().isoformat(),
+                "api_key_source": api_key_info['source'],
+                "cached": cached,
+                "cache_type": cache_type
+            }, event="done")
+            
+        except asyncio.CancelledError:
+            logger.info("Chat stream cancelled for %s", session_id)
+            raise
+        except UpstreamError as e:
+            logger.error("Chat stream upstream error: %s", e.detail)
+            yield sse_event({"detail": e.detail, "status": e.status_code, "retry_after": e.retry_after}, event="error")
+        except Exception as e:
+            logger.exception("Chat stream error")
+            yield sse_event({"detail": f"Chat failed: {str(e)}"}, event="error")
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.get("/api/chat/history")
-async def get_chat_history(current_user: dict = Depends(get_current_user)):
-    """Get user's chat history"""
+async def get_chat_history(
+    before: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=200),
+    summary: bool = False,
+    current_user: dict = Depends(get_current_user)
+):
+    """Get a page of the user's chat history, newest first
+    
+    Pass the returned next_before as `before` to fetch older chats. With
+    summary=true only truncated previews are returned; fetch full bodies
+    from /api/chat/{chat_id}.
+    """
     try:
-        user_id = current_user['user_id']
-        chats = list(chats_collection.find(
-            {"user_id": user_id},
-            {"_id": 0}
-        ).sort("timestamp", -1).limit(50))
+        query = history_query(current_user['user_id'], before)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid history cursor")
+    
+    try:
+        projection = SUMMARY_PROJECTION if summary else FULL_PROJECTION
+        chats = await chats_collection.find(query, projection).sort(HISTORY_SORT).limit(limit + 1).to_list(length=limit + 1)
+        has_more = len(chats) > limit
+        chats = chats[:limit]
         
-        return {"chats": chats}
+        return {
+            "chats": chats,
+            "next_before": encode_cursor(chats[-1]) if has_more else None
+        }
         
-    except Exception as e:
-        logger.error(f"Chat history error: {str(e)}")
+    except Exception:
+        logger.exception("Chat history error")
         raise HTTPException(status_code=500, detail="Failed to get chat history")
 
+@app.get("/api/conversations")
+async def get_conversations(
+    before: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=100),
+    current_user: dict = Depends(get_current_user)
+):
+    """Get a page of the user's conversations, most recently updated first
+    
+    Pass the returned next_before as `before` to fetch older conversations.
+    """
+    query = {"user_id": current_user['user_id']}
+    if before:
+        try:
+            updated_at, conversation_id = decode_cursor(before)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid conversation cursor")
+        query["$or"] = [
+            {"updated_at": {"$lt": updated_at}},
+            {"updated_at": updated_at, "conversation_id": {"$lt": conversation_id}}
+        ]
+    
+    conversations = await conversations_collection.find(
+        query,
+        {"_id": 0, "user_id": 0, "summary": 0}
+    ).sort([("updated_at", -1), ("conversation_id", -1)]).limit(limit + 1).to_list(length=limit + 1)
+    has_more = len(conversations) > limit
+    conversations = conversations[:limit]
+    
+    last = conversations[-1] if has_more else None
+    return {
+        "conversations": conversations,
+        "next_before": f"{last['updated_at'].isoformat()},{last['conversation_id']}" if last else None
+    }
+
+@app.get("/api/conversations/{conversation_id}/messages")
+async def get_conversation_messages(
+    conversation_id: str,
+    limit: int = Query(50, ge=2, le=200),
+    current_user: dict = Depends(get_current_user)
+):
+    """Get the most recent messages of a conversation, oldest first"""
+    await turn_jobs.wait(conversation_id)
+    messages = await load_recent_messages(messages_collection, conversation_id, current_user['user_id'], limit // 2)
+    if not messages:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    return {"conversation_id": conversation_id, "messages": messages}
+
+@app.get("/api/chat/{chat_id}")
+async def get_chat(chat_id: str, current_user: dict = Depends(get_current_user)):
+    """Get a single chat with full message bodies"""
+    chat = await chats_collection.find_one(
+        {"user_id": current_user['user_id'], "chat_id": chat_id},
+        FULL_PROJECTION
+    )
+    if not chat:
+        raise HTTPException(status_code=404, detail="Chat not found")
+    return chat
+
 # Admin routes
 @app.post("/api/admin/configure")
 async def configure_api_key(
     config: AdminConfig,
-    current_user: dict = Depends(get_current_user)
+    current_user: dict = Depends(get_current_user_uncached)
 ):
     """Configure API key for user (admin only)"""
     if not current_user.get('is_admin'):
@@ -304,71 +923,194 @@ async def configure_api_key(
     try:
         if config.user_email:
             # Configure for specific user
-            users_collection.update_one(
+            user = await users_collection.find_one_and_update(
                 {"email": config.user_email},
-                {"$set": {"api_key": config.openai_key}},
-                upsert=True
+                {
+                    "$set": {"api_key": config.openai_key},
+                    "$setOnInsert": {"user_id": str(uuid.uuid4()), "created_at": datetime.utcnow()}
+                },
+                projection={"user_id": 1},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
             )
+            invalidate_user_cache(user.get('user_id'))
         else:
             # Configure default key
-            admin_collection.update_one(
+            await admin_collection.update_one(
                 {"type": "default"},
                 {"$set": {"api_key": config.openai_key, "updated_at": datetime.utcnow()}},
                 upsert=True
             )
+            default_api_key_cache.clear()
         
         return {"message": "API key configured successfully"}
         
-    except Exception as e:
-        logger.error(f"Admin config error: {str(e)}")
+    except Exception:
+        logger.exception("Admin config error")
         raise HTTPException(status_code=500, detail="Configuration failed")
 
+# Fields returned by the admin user list; api_key is only read to derive flags
+USER_LIST_PROJECTION = {
+    "_id": 0,
+    "user_id": 1,
+    "email": 1,
+    "name": 1,
+    "picture": 1,
+    "is_admin": 1,
+    "created_at": 1,
+    "last_login": 1,
+    "api_key": 1
+}
+
 @app.get("/api/admin/users")
-async def get_users(current_user: dict = Depends(get_current_user)):
-    """Get all users with API key status (admin only)"""
+async def get_users(
+    after: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=500),
+    current_user: dict = Depends(get_current_user_uncached)
+):
+    """Get a page of users with API key status (admin only)
+    
+    Pages are ordered by user_id; pass the returned next_cursor as `after`
+    to fetch the following page.
+    """
     if not current_user.get('is_admin'):
         raise HTTPException(status_code=403, detail="Admin access required")
     
     try:
-        users = list(users_collection.find({}, {"_id": 0}))
+        query = {"user_id": {"$gt": after}} if after else {}
+        users = await users_collection.find(query, USER_LIST_PROJECTION).sort("user_id", 1).limit(limit + 1).to_list(length=limit + 1)
+        has_more = len(users) > limit
+        users = users[:limit]
+        
+        # Resolve the shared key once instead of once per user
+        default_key_info = await get_default_api_key()
         
         # Add API key status to each user
         for user in users:
-            api_key_info = get_user_api_key(user['user_id'])
+            has_personal_key = bool(user.pop('api_key', None))
+            api_key_info = {'source': 'user_specific'} if has_personal_key else default_key_info
             user['has_api_key'] = api_key_info is not None
             user['api_key_source'] = api_key_info['source'] if api_key_info else None
-            user['has_personal_key'] = bool(user.get('api_key'))
+            user['has_personal_key'] = has_personal_key
         
-        return {"users": users}
+        return {
+            "users": users,
+            "next_cursor": users[-1]['user_id'] if has_more else None
+        }
         
-    except Exception as e:
-        logger.error(f"Get users error: {str(e)}")
+    except Exception:
+        logger.exception("Get users error")
         raise HTTPException(status_code=500, detail="Failed to get users")
 
 @app.get("/api/admin/stats")
-async def get_admin_stats(current_user: dict = Depends(get_current_user)):
+async def get_admin_stats(current_user: dict = Depends(get_current_user_uncached)):
     """Get admin statistics"""
     if not current_user.get('is_admin'):
         raise HTTPException(status_code=403, detail="Admin access required")
     
     try:
-        total_users = users_collection.count_documents({})
-        total_chats = chats_collection.count_documents({})
+        total_users = await users_collection.count_documents({})
+        total_chats = await chats_collection.count_documents({})
         
         return {
             "total_users": total_users,
             "total_chats": total_chats,
+            "chat_write_queue": chat_writer.stats(),
+            "tracing": tracer.stats(),
+            "logging": {"queued": log_listener.queue.qsize(), "dropped": log_listener.queue_handler.dropped},
             "admin_email": current_user['email']
         }
         
-    except Exception as e:
-        logger.error(f"Admin stats error: {str(e)}")
+    except Exception:
+        logger.exception("Admin stats error")
         raise HTTPException(status_code=500, detail="Failed to get statistics")
 
+@app.get("/api/admin/cache-stats")
+async def get_cache_stats(current_user: dict = Depends(get_current_user_uncached)):
+    """Get response cache hit-rate metrics (admin only)"""
+    if not current_user.get('is_admin'):
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    return {
+        "enabled": response_cache is not None,
+        "response_cache": response_cache.stats() if response_cache else None,
+        "semantic_cache": semantic_cache.stats() if semantic_cache else None
+    }
+
+@app.get("/api/admin/loop-diagnostics")
+async def get_loop_diagnostics(current_user: dict = Depends(get_current_user_uncached)):
+    """Get cumulative event loop stall time and recent blocking samples (admin only)"""
+    if not current_user.get('is_admin'):
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    if not loop_detector:
+        return {"enabled": False}
+    return {"enabled": True, **loop_detector.stats()}
+
+@app.get("/api/admin/profiles")
+async def get_profiles(current_user: dict = Depends(get_current_user_uncached)):
+    """List captured request profiles and the profiler settings (admin only)"""
+    if not current_user.get('is_admin'):
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    return {**profiler.stats(), "profiles": await profiler.recent()}
+
+@app.post("/api/admin/profiles")
+async def arm_profiler(request: ProfilingRequest, current_user: dict = Depends(get_current_user_uncached)):
+    """Profile the next requests, optionally under a path prefix (admin only)"""
+    if not current_user.get('is_admin'):
+        raise HTTPException(status_code=403, detail="Admin access required")
+    if request.count < 0 or not 0 <= (request.sample_rate or 0) <= 1:
+        raise HTTPException(status_code=400, detail="count must be >= 0 and sample_rate between 0 and 1")
+    
+    await profiler.arm(request.count, request.path_prefix, request.sample_rate)
+    return {**profiler.stats(), "profiles": await profiler.recent()}
+
+@app.get("/api/admin/profiles/{profile_id}")
+async def download_profile(
+    profile_id: str,
+    format: str = Query('speedscope', pattern='^(speedscope|collapsed)$'),
+    kind: str = Query('wall', pattern='^(wall|cpu)$'),
+    current_user: dict = Depends(get_current_user_uncached)
+):
+    """Download a profile as speedscope JSON or collapsed stacks (admin only)"""
+    if not current_user.get('is_admin'):
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    profile = await profiler.load(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    if format == 'collapsed':
+        filename = f"profile-{profile.id}-{kind}.folded"
+        return Response(profile.collapsed(kind), media_type="text/plain",
+                        headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+    return JSONResponse(profile.speedscope(),
+                        headers={"Content-Disposition": f'attachment; filename="profile-{profile.id}.speedscope.json"'})
+
+@app.get("/api/admin/upstream-queue")
+async def get_upstream_queue(current_user: dict = Depends(get_current_user_uncached)):
+    """Get in-flight and queued upstream requests per API key (admin only)"""
+    if not current_user.get('is_admin'):
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    return {
+        "max_concurrency": upstream_scheduler.max_concurrency,
+        "keys": upstream_scheduler.stats(),
+        "resilience": upstream_policy.stats()
+    }
+
+@app.get("/api/admin/rate-limits")
+async def get_rate_limits(current_user: dict = Depends(get_current_user_uncached)):
+    """Get configured rate limits and admitted/limited request counts (admin only)"""
+    if not current_user.get('is_admin'):
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    return rate_limiter.stats()
+
 @app.post("/api/admin/user-api-key")
 async def manage_user_api_key(
     request: dict,
-    current_user: dict = Depends(get_current_user)
+    current_user: dict = Depends(get_current_user_uncached)
 ):
     """Assign, update, or remove API key for a specific user (admin only)"""
     if not current_user.get('is_admin'):
@@ -383,37 +1125,38 @@ async def manage_user_api_key(
             raise HTTPException(status_code=400, detail="Email is required")
         
         # Find user by email
-        user = users_collection.find_one({"email": email})
+        user = await users_collection.find_one({"email": email})
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
         
         if action == 'remove' or not api_key:
             # Remove API key
-            users_collection.update_one(
+            await users_collection.update_one(
                 {"email": email},
                 {"$unset": {"api_key": ""}}
             )
             message = f"API key removed for {email}"
         else:
             # Set/update API key
-            users_collection.update_one(
+            await users_collection.update_one(
                 {"email": email},
                 {"$set": {"api_key": api_key}}
             )
             message = f"API key updated for {email}"
         
+        invalidate_user_cache(user['user_id'])
+        
         return {"message": message}
         
-    except Exception as e:
-        logger.error(f"Manage user API key error: {str(e)}")
+    except Exception:
+        logger.exception("Manage user API key error")
         raise HTTPException(status_code=500, detail="Failed to manage user API key")
 
 @app.get("/api/user/api-key-status")
 async def get_user_api_key_status(current_user: dict = Depends(get_current_user)):
     """Get current user's API key status"""
     try:
-        user_id = current_user['user_id']
-        api_key_info = get_user_api_key(user_id)
+        api_key_info = await get_user_api_key(current_user)
         
         return {
             "has_api_key": api_key_info is not None,
@@ -421,14 +1164,14 @@ async def get_user_api_key_status(current_user: dict = Depends(get_current_user)
             "has_personal_key": bool(current_user.get('api_key'))
         }
         
-    except Exception as e:
-        logger.error(f"Get API key status error: {str(e)}")
+    except Exception:
+        logger.exception("Get API key status error")
         raise HTTPException(status_code=500, detail="Failed to get API key status")
 
 @app.post("/api/admin/manage-admin")
 async def manage_admin_access(
     request: dict,
-    current_user: dict = Depends(get_current_user)
+    current_user: dict = Depends(get_current_user_uncached)
 ):
     """Add or remove admin access for a user (super admin only)"""
     if not current_user.get('is_admin'):
@@ -443,24 +1186,29 @@ async def manage_admin_access(
         
         # Update user in database
         if action == 'add':
-            users_collection.update_one(
+            user = await users_collection.find_one_and_update(
                 {"email": email},
                 {"$set": {"is_admin": True}},
+                projection={"user_id": 1},
                 upsert=False
             )
             message = f"Admin access granted to {email}"
         else:
-            users_collection.update_one(
+            user = await users_collection.find_one_and_update(
                 {"email": email},
                 {"$set": {"is_admin": False}},
+                projection={"user_id": 1},
                 upsert=False
             )
             message = f"Admin access removed from {email}"
         
+        if user:
+            invalidate_user_cache(user.get('user_id'))
+        
         return {"message": message}
         
-    except Exception as e:
-        logger.error(f"Manage admin error: {str(e)}")
+    except Exception:
+        logger.exception("Manage admin error")
         raise HTTPException(status_code=500, detail="Failed to manage admin access")
 
 if __name__ == "__main__":
@@ -0,0 +1,244 @@
+"""Structured JSON logs written off the event loop.
+
+configure_logging() routes every log record through a bounded queue to a
+listener thread that formats and writes it, so a slow stderr or log
+collector never blocks request handling (records are dropped and counted
+when the queue is full). Each record is rendered as one JSON object with:
+
+* timestamp, level, logger, message, and the exception text if any;
+* the trace and span ids of the current request (see tracing.py);
+* the request context: method, route, a hash of the user id, the API key
+  source, and on the closing access line, status and latency.
+
+API keys, bearer tokens and JWTs are redacted from messages, exception
+text and structured fields. INFO and lower records can be sampled; the
+decision follows the trace id so a request's lines are kept or dropped
+together, and warnings and errors are always kept.
+"""
+import atexit
+import contextvars
+import hashlib
+import json
+import logging
+import os
+import queue
+import random
+import re
+import sys
+import time
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+from tracing import TraceContextFilter
+
+# Loggers uvicorn gives their own synchronous handlers; routed through the queue instead
+UVICORN_LOGGERS = ('uvicorn', 'uvicorn.error', 'uvicorn.access')
+
+_request_context = contextvars.ContextVar('log_request_context', default=None)
+
+_SECRETS = [
+    (re.compile(r'\bsk-[A-Za-z0-9_\-]{8,}'), lambda match: 'sk-***' + match.group(0)[-4:]),
+    (re.compile(r'(?i)\b(bearer\s+)[A-Za-z0-9\-._~+/]+=*'), r'\1***'),
+    (re.compile(r'\beyJ[A-Za-z0-9_-]+\.[A-Za-z0-9_-]+\.[A-Za-z0-9_-]*'), '***'),
+]
+_SECRET_FIELDS = {'api_key', 'openai_key', 'authorization', 'token', 'password'}
+# Attributes every LogRecord has, so anything else came from `extra`
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {
+    'message', 'asctime', 'trace', 'trace_id', 'span_id', 'request'
+}
+
+
+def redact(text: str):
+    """Mask API keys, bearer tokens and JWTs in text"""
+    for pattern, replacement in _SECRETS:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+def hash_user_id(user_id: str):
+    """Stable pseudonymous id for logs, so user ids never appear in plain text"""
+    return hashlib.sha256(user_id.encode()).hexdigest()[:16]
+
+
+def bind_request(**fields):
+    """Add fields to the current request's log context (user_id is hashed)"""
+    context = _request_context.get()
+    if context is None:
+        return
+    user_id = fields.pop('user_id', None)
+    if user_id:
+        context['user'] = hash_user_id(user_id)
+    context.update(fields)
+
+
+class ContextFilter(TraceContextFilter):
+    """Copies the trace ids and request context onto the record while still in the request"""
+
+    def filter(self, record):
+        super().filter(record)
+        context = _request_context.get()
+        record.request = dict(context) if context else None
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps a fraction of INFO and lower records, per trace when there is one"""
+
+    def __init__(self, rate: float = 1.0):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if self.rate >= 1 or record.levelno >= logging.WARNING:
+            return True
+        trace_id = getattr(record, 'trace_id', '')
+        if trace_id:
+            return int(trace_id[:8], 16) < self.rate * 0x100000000
+        return random.random() < self.rate
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """Queue handler that drops records instead of waiting when the queue is full"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record):
+        # Render message and traceback now: args and exc_info may not survive the thread hop
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = redact(record.getMessage())
+        record.args = None
+        if record.exc_info:
+            record.exc_text = redact(logging.Formatter().formatException(record.exc_info))
+        record.exc_info = None
+        return record
+
+
+def _redact_fields(fields: dict):
+    return {
+        key: '***' if key.lower() in _SECRET_FIELDS else redact(value) if isinstance(value, str) else value
+        for key, value in fields.items()
+    }
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record"""
+
+    def format(self, record):
+        entry = {
+            "timestamp": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": redact(record.getMessage()),
+        }
+        if getattr(record, 'trace_id', ''):
+            entry["trace_id"] = record.trace_id
+            entry["span_id"] = record.span_id
+        if getattr(record, 'request', None):
+            entry.update(record.request)
+        extra = {key: value for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES}
+        if extra:
+            entry.update(_redact_fields(extra))
+        if record.exc_info and not record.exc_text:
+            record.exc_text = redact(self.formatException(record.exc_info))
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class RequestLogMiddleware:
+    """Pure ASGI middleware holding the request's log context and writing one access line
+
+    Place it inside TracingMiddleware so the access line carries the trace id.
+    """
+
+    def __init__(self, app, logger_name: str = 'access'):
+        self.app = app
+        self.logger = logging.getLogger(logger_name)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        context = {"method": scope['method'], "path": scope['path']}
+        token = _request_context.set(context)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get('route')
+            if route is not None:
+                context["route"] = route.path
+            context["status"] = status
+            context["latency_ms"] = round((time.perf_counter() - start) * 1000, 2)
+            self.logger.log(logging.WARNING if status >= 500 else logging.INFO,
+                            "%s %s %s", scope['method'], context.get("route", scope['path']), status)
+            _request_context.reset(token)
+
+
+def configure_logging(level: str = 'INFO', fmt: str = 'json', sample_rate: float = 1.0, queue_size: int = 10000,
+                      stream=None, logger: logging.Logger = None):
+    """Replace the handlers of logger (default: root) with the queued pipeline
+
+    When configuring the root logger, uvicorn's loggers lose their own
+    stream handlers and propagate to it. Returns the started QueueListener;
+    it is stopped, flushing queued records, at interpreter exit.
+    """
+    logger = logger or logging.getLogger()
+    target = logging.StreamHandler(stream or sys.stderr)
+    if fmt == 'json':
+        target.setFormatter(JsonFormatter())
+    else:
+        target.setFormatter(logging.Formatter('%(levelname)s:%(name)s:%(message)s%(trace)s'))
+
+    handler = NonBlockingQueueHandler(queue.Queue(maxsize=queue_size))
+    handler.addFilter(ContextFilter())
+    handler.addFilter(SamplingFilter(sample_rate))
+    for existing in list(logger.handlers):
+        logger.removeHandler(existing)
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    if logger is logging.getLogger():
+        for name in UVICORN_LOGGERS:
+            uvicorn_logger = logging.getLogger(name)
+            for existing in list(uvicorn_logger.handlers):
+                uvicorn_logger.removeHandler(existing)
+            uvicorn_logger.propagate = True
+
+    listener = QueueListener(handler.queue, target)
+    listener.queue_handler = handler
+    listener.start()
+    atexit.register(stop_listener, listener)
+    return listener
+
+
+def configure_logging_from_env(env=os.environ):
+    """configure_logging() from LOG_LEVEL, LOG_FORMAT, LOG_INFO_SAMPLE_RATE and LOG_QUEUE_SIZE"""
+    return configure_logging(
+        level=env.get('LOG_LEVEL', 'INFO').upper(),
+        fmt=env.get('LOG_FORMAT', 'json'),
+        sample_rate=float(env.get('LOG_INFO_SAMPLE_RATE', 1.0)),
+        queue_size=int(env.get('LOG_QUEUE_SIZE', 10000)),
+    )
+
+
+def stop_listener(listener: QueueListener):
+    """Write out the queued records and stop the listener thread, if still running"""
+    if listener._thread is not None:
+        listener.stop()
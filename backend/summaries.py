@@ -0,0 +1,172 @@
+"""Rolling summaries that compact the older turns of long conversations.
+
+Once a conversation's unsummarized messages pass a token threshold, a
+background job folds the oldest of them (all but the most recent turns)
+into a running summary stored on the conversation document. The summary
+records a checkpoint, the timestamp and message_id of the last message it
+covers. The checkpoint is advanced with a compare-and-set on the previous
+one, so a duplicate or concurrent job (e.g. in another worker) is a no-op
+rather than a double-count. Chat requests read the summary and the turns
+after its checkpoint.
+"""
+import asyncio
+import logging
+from datetime import datetime
+
+from conversations import RECENT_SORT
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PROMPT = (
+    "You maintain a running summary of a conversation between a user and an assistant. "
+    "Update the summary with the new messages. Keep facts, decisions, names, numbers and "
+    "open questions; drop pleasantries. Reply with the summary only."
+)
+CONVERSATION_SUMMARY_PROJECTION = {"_id": 0, "summary": 1, "unsummarized_tokens": 1}
+
+
+def summary_message(summary: dict):
+    """The system message that carries a summary into the prompt"""
+    return {"role": "system", "content": f"Summary of the earlier conversation:\n{summary['text']}"}
+
+
+def after_checkpoint(history, summary: dict):
+    """Drop messages already covered by the summary"""
+    if not summary:
+        return history
+    through = summary["through"]
+    return [doc for doc in history if doc["timestamp"] > through]
+
+
+def summary_request(previous: str, docs):
+    """Messages asking the model to fold docs into the previous summary"""
+    transcript = "\n".join(f"{doc['role']}: {doc['content']}" for doc in docs)
+    content = f"Current summary:\n{previous or '(none)'}\n\nNew messages:\n{transcript}"
+    return [
+        {"role": "system", "content": SUMMARY_PROMPT},
+        {"role": "user", "content": content}
+    ]
+
+
+async def summarize_conversation(messages_collection, conversations_collection, conversation_id: str, user_id: str,
+                                 complete, count, keep_turns: int = 4, max_messages: int = 200):
+    """Fold older unsummarized turns into the conversation summary
+
+    complete(messages) returns the model's reply and count(text) a token
+    count. Returns the new summary document, or None when there was nothing
+    to do or another job advanced the checkpoint first.
+    """
+    conversation = await conversations_collection.find_one(
+        {"conversation_id": conversation_id, "user_id": user_id}, CONVERSATION_SUMMARY_PROJECTION
+    )
+    if conversation is None:
+        return None
+    previous = conversation.get("summary")
+
+    query = {"conversation_id": conversation_id, "user_id": user_id}
+    if previous:
+        query["timestamp"] = {"$gt": previous["through"]}
+    # Newest first so the turns kept verbatim can be skipped, then oldest first
+    docs = await messages_collection.find(
+        query, {"_id": 0, "message_id": 1, "role": 1, "content": 1, "tokens": 1, "timestamp": 1}
+    ).sort(RECENT_SORT).skip(keep_turns * 2).limit(max_messages).to_list(length=max_messages)
+    docs.reverse()
+    # Only fold whole turns so the checkpoint never splits a user/assistant pair
+    while docs and docs[-1]["role"] != "assistant":
+        docs.pop()
+    if not docs:
+        return None
+
+    text = await complete(summary_request(previous["text"] if previous else None, docs))
+    folded_tokens = sum(doc.get("tokens") or count(doc["content"]) for doc in docs)
+    summary = {
+        "text": text,
+        "tokens": count(text),
+        "through": docs[-1]["timestamp"],
+        "through_id": docs[-1]["message_id"],
+        "messages": (previous["messages"] if previous else 0) + len(docs),
+        "updated_at": datetime.utcnow()
+    }
+
+    # Compare-and-set on the previous checkpoint keeps retries idempotent
+    result = await conversations_collection.update_one(
+        {
+            "conversation_id": conversation_id,
+            "user_id": user_id,
+            "summary.through_id": previous["through_id"] if previous else None
+        },
+        {"$set": {"summary": summary}, "$inc": {"unsummarized_tokens": -folded_tokens}}
+    )
+    if not result.modified_count:
+        logger.info("Summary checkpoint for %s already advanced, discarding", conversation_id)
+        return None
+    return summary
+
+
+class BackgroundJobs:
+    """Runs fire-and-forget coroutines off the request path
+
+    At most one job runs per key. schedule() ignores a key that is already
+    running; chain() queues the job behind it so a key's jobs run in order.
+    Failures are logged, never raised into the request.
+    """
+
+    def __init__(self):
+        self.tasks = {}
+        self.completed = 0
+        self.failed = 0
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def schedule(self, key, job, *args, **kwargs):
+        if key in self.tasks:
+            return None
+        task = asyncio.get_running_loop().create_task(job(*args, **kwargs))
+        self.tasks[key] = task
+        task.add_done_callback(lambda done: self._finished(key, done))
+        return task
+
+    def chain(self, key, job, *args, **kwargs):
+        previous = self.tasks.get(key)
+
+        async def run_after():
+            if previous is not None:
+                await asyncio.wait([previous])
+            await job(*args, **kwargs)
+
+        task = asyncio.get_running_loop().create_task(run_after())
+        self.tasks[key] = task
+        task.add_done_callback(lambda done: self._finished(key, done))
+        return task
+
+    async def wait(self, key):
+        """Wait for the key's queued jobs, whatever their outcome"""
+        task = self.tasks.get(key)
+        if task is not None:
+            await asyncio.wait([task])
+
+    def _finished(self, key, task):
+        if self.tasks.get(key) is task:
+            del self.tasks[key]
+        if task.cancelled():
+            return
+        if task.exception() is not None:
+            self.failed += 1
+            logger.error("Background job %s failed", key, exc_info=task.exception())
+        else:
+            self.completed += 1
+
+    async def drain(self, timeout: float = 10.0):
+        """Wait for running jobs on shutdown, cancelling any that overrun"""
+        if not self.tasks:
+            return
+        tasks = list(self.tasks.values())
+        done, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    def stats(self):
+        return {"running": len(self.tasks), "completed": self.completed, "failed": self.failed}
@@ -0,0 +1,399 @@
+"""Lightweight OpenTelemetry-style request tracing.
+
+Spans follow the OpenTelemetry data model (128-bit trace id, 64-bit span
+ids, kind, attributes, status) and propagate through W3C `traceparent`
+headers, so traces started in the browser continue through the proxy and
+can be shipped to any OTLP collector. Only the small subset the proxy
+needs is implemented, without the OpenTelemetry SDK:
+
+* TracingMiddleware starts a server span per request, continuing the
+  caller's trace when a traceparent header is present, and returns the
+  trace id in an X-Trace-Id header;
+* tracer.span(name) opens a child of the current span (tracked in a
+  context variable, so it follows the request into spawned tasks);
+* finished spans are batched on a background thread to an exporter: JSON
+  lines in a local file, or OTLP/HTTP JSON to a collector;
+* TraceContextFilter stamps the current trace and span ids on log records.
+
+Whether a request is recorded is decided here by the sampling rate: an
+incoming traceparent supplies the trace and parent ids, and its sampled
+flag can only opt a request out, so clients cannot force exports. A
+request that is not sampled still carries its trace id, so its logs can
+be correlated, but records and exports nothing.
+"""
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+INTERNAL, SERVER, CLIENT = 1, 2, 3
+_KIND_NAMES = {INTERNAL: 'internal', SERVER: 'server', CLIENT: 'client'}
+_TRACEPARENT = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+
+def current_span():
+    return _current_span.get()
+
+
+def parse_traceparent(header: str):
+    """(trace_id, parent_span_id, sampled) from a W3C traceparent header, or None"""
+    match = _TRACEPARENT.match((header or '').strip().lower())
+    if not match or match.group(1) == '0' * 32 or match.group(2) == '0' * 16:
+        return None
+    return match.group(1), match.group(2), bool(int(match.group(3), 16) & 1)
+
+
+class Span:
+    """One timed operation; a no-op apart from its ids when not recording"""
+
+    def __init__(self, tracer, name: str, trace_id: str, parent_id: str = None, kind: int = INTERNAL,
+                 recording: bool = True, attributes: dict = None):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = '%016x' % random.getrandbits(64)
+        self.parent_id = parent_id
+        self.kind = kind
+        self.recording = recording
+        self.attributes = dict(attributes or {})
+        self.status = 'unset'
+        self.status_message = None
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+
+    @property
+    def traceparent(self):
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.recording else '00'}"
+
+    def set_attribute(self, key: str, value):
+        if self.recording and value is not None:
+            self.attributes[key] = value
+
+    def set_attributes(self, attributes: dict):
+        for key, value in attributes.items():
+            self.set_attribute(key, value)
+
+    def record_exception(self, error: BaseException):
+        if self.recording:
+            self.status = 'error'
+            self.status_message = f"{type(error).__name__}: {error}"
+            self.attributes['exception.type'] = type(error).__name__
+
+    def end(self):
+        if self.end_ns is None:
+            self.end_ns = time.time_ns()
+            if self.recording:
+                self.tracer.processor.on_end(self)
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_span_id": self.parent_id,
+            "kind": _KIND_NAMES[self.kind],
+            "start_time_unix_nano": self.start_ns,
+            "end_time_unix_nano": self.end_ns,
+            "duration_ms": round((self.end_ns - self.start_ns) / 1e6, 3),
+            "attributes": self.attributes,
+            "status": self.status,
+            "status_message": self.status_message,
+        }
+
+
+class FileSpanExporter:
+    """Appends finished spans to a file as JSON lines"""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def export(self, spans):
+        with open(self.path, 'a') as f:
+            for span in spans:
+                f.write(json.dumps(span.to_dict(), default=str) + "\n")
+
+    def shutdown(self):
+        pass
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attributes(attributes: dict):
+    return [{"key": key, "value": _otlp_value(value)} for key, value in attributes.items()]
+
+
+class OTLPHttpExporter:
+    """Sends spans to an OpenTelemetry collector with OTLP/HTTP JSON"""
+
+    def __init__(self, endpoint: str = 'http://localhost:4318/v1/traces', headers: dict = None,
+                 service_name: str = 'chatgpt-proxy', timeout: float = 10.0):
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self.client = httpx.Client(headers=headers, timeout=timeout)
+
+    def payload(self, spans):
+        return {"resourceSpans": [{
+            "resource": {"attributes": _otlp_attributes({"service.name": self.service_name})},
+            "scopeSpans": [{
+                "scope": {"name": "chatgpt-proxy"},
+                "spans": [{
+                    "traceId": span.trace_id,
+                    "spanId": span.span_id,
+                    "parentSpanId": span.parent_id or "",
+                    "name": span.name,
+                    "kind": span.kind,
+                    "startTimeUnixNano": str(span.start_ns),
+                    "endTimeUnixNano": str(span.end_ns),
+                    "attributes": _otlp_attributes(span.attributes),
+                    "status": {"code": {'unset': 0, 'ok': 1, 'error': 2}[span.status],
+                               "message": span.status_message or ""},
+                } for span in spans]
+            }]
+        }]}
+
+    def export(self, spans):
+        response = self.client.post(self.endpoint, json=self.payload(spans))
+        response.raise_for_status()
+
+    def shutdown(self):
+        self.client.close()
+
+
+class BatchSpanProcessor:
+    """Queues finished spans and exports them in batches from a background thread
+
+    Spans are dropped rather than blocking requests when the queue is full.
+    """
+
+    def __init__(self, exporter, max_queue_size: int = 2048, batch_size: int = 512, interval: float = 1.0):
+        self.exporter = exporter
+        self.batch_size = batch_size
+        self.interval = interval
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.exported = 0
+        self.dropped = 0
+        self.failed = 0
+        self._wake = threading.Event()
+        self._export_lock = threading.Lock()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="span-exporter", daemon=True)
+        self._thread.start()
+
+    def on_end(self, span):
+        try:
+            self.queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+            return
+        if self.queue.qsize() >= self.batch_size:
+            self._wake.set()
+
+    def _drain(self):
+        batch = []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def force_flush(self):
+        """Export everything queued so far from the calling thread"""
+        with self._export_lock:
+            while True:
+                batch = self._drain()
+                if not batch:
+                    return
+                try:
+                    self.exporter.export(batch)
+                    self.exported += len(batch)
+                except Exception as e:
+                    self.failed += len(batch)
+                    logger.warning("Span export failed, dropping %s spans: %s", len(batch), e)
+
+    def _run(self):
+        while not self._stopped:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.force_flush()
+
+    def shutdown(self):
+        self._stopped = True
+        self._wake.set()
+        self._thread.join(timeout=10)
+        self.force_flush()
+        self.exporter.shutdown()
+
+
+class _NoopProcessor:
+    exported = dropped = failed = 0
+
+    def on_end(self, span):
+        pass
+
+    def force_flush(self):
+        pass
+
+    def shutdown(self):
+        pass
+
+
+class Tracer:
+    """Creates spans; processor is None to only propagate trace ids"""
+
+    def __init__(self, processor=None, sample_rate: float = 1.0):
+        self.processor = processor or _NoopProcessor()
+        self.enabled = processor is not None
+        self.sample_rate = sample_rate
+
+    @classmethod
+    def from_env(cls):
+        """Build from TRACING_EXPORTER ('none', 'file' or 'otlp') and the standard OTEL_* variables"""
+        exporter_name = os.environ.get('TRACING_EXPORTER', 'none').lower()
+        if exporter_name == 'file':
+            exporter = FileSpanExporter(os.environ.get('TRACING_FILE', 'traces.jsonl'))
+        elif exporter_name == 'otlp':
+            headers = dict(
+                item.split('=', 1) for item in os.environ.get('OTEL_EXPORTER_OTLP_HEADERS', '').split(',') if '=' in item
+            )
+            endpoint = os.environ.get('OTEL_EXPORTER_OTLP_TRACES_ENDPOINT') or (
+                os.environ.get('OTEL_EXPORTER_OTLP_ENDPOINT', 'http://localhost:4318').rstrip('/') + '/v1/traces'
+            )
+            exporter = OTLPHttpExporter(endpoint, headers, os.environ.get('OTEL_SERVICE_NAME', 'chatgpt-proxy'))
+        else:
+            return cls()
+        return cls(BatchSpanProcessor(exporter), float(os.environ.get('TRACING_SAMPLE_RATE', 1.0)))
+
+    def start_span(self, name: str, kind: int = INTERNAL, attributes: dict = None, traceparent: str = None):
+        """Start a span under the current one, or a root continuing traceparent"""
+        parent = _current_span.get()
+        if parent is not None:
+            return Span(self, name, parent.trace_id, parent.span_id, kind, parent.recording, attributes)
+        incoming = parse_traceparent(traceparent)
+        if incoming:
+            trace_id, parent_id, sampled = incoming
+        else:
+            trace_id, parent_id, sampled = '%032x' % random.getrandbits(128), None, True
+        sampled = sampled and random.random() < self.sample_rate
+        return Span(self, name, trace_id, parent_id, kind, self.enabled and sampled, attributes)
+
+    @contextmanager
+    def span(self, name: str, kind: int = INTERNAL, **attributes):
+        """Run the block in a child span of the current one
+
+        Inside unsampled requests this yields the current span itself, so
+        untraced requests pay only for a context variable lookup.
+        """
+        parent = _current_span.get()
+        if parent is None or not parent.recording:
+            yield parent or _UNTRACED
+            return
+        span = Span(self, name, parent.trace_id, parent.span_id, kind, True, attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.record_exception(e)
+            raise
+        finally:
+            _current_span.reset(token)
+            span.end()
+
+    def force_flush(self):
+        self.processor.force_flush()
+
+    def shutdown(self):
+        self.processor.shutdown()
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "sample_rate": self.sample_rate,
+            "exported": self.processor.exported,
+            "dropped": self.processor.dropped,
+            "failed": self.processor.failed,
+        }
+
+
+_UNTRACED = Span(Tracer(), 'untraced', '0' * 32, recording=False)
+
+
+class TracingMiddleware:
+    """Pure ASGI middleware opening a server span per HTTP request"""
+
+    def __init__(self, app, tracer: Tracer):
+        self.app = app
+        self.tracer = tracer
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        traceparent = None
+        for name, value in scope['headers']:
+            if name == b'traceparent':
+                traceparent = value.decode('latin-1')
+                break
+        span = self.tracer.start_span(
+            f"{scope['method']} {scope['path']}", SERVER, traceparent=traceparent,
+            attributes={"http.request.method": scope['method'], "url.path": scope['path']}
+        )
+        token = _current_span.set(span)
+
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                span.set_attribute("http.response.status_code", message['status'])
+                if message['status'] >= 500:
+                    span.status = 'error'
+                message = {**message, 'headers': list(message.get('headers', [])) +
+                           [(b'x-trace-id', span.trace_id.encode())]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except BaseException as e:
+            span.record_exception(e)
+            raise
+        finally:
+            route = scope.get('route')
+            if route is not None:
+                # Name by route template to keep span names low-cardinality
+                span.name = f"{scope['method']} {route.path}"
+                span.set_attribute("http.route", route.path)
+            _current_span.reset(token)
+            span.end()
+
+
+class TraceContextFilter(logging.Filter):
+    """Adds trace_id and span_id (or '') to log records, plus a ready-made ' trace_id=...' suffix"""
+
+    def filter(self, record):
+        span = _current_span.get()
+        if span is None:
+            record.trace_id = record.span_id = record.trace = ''
+        else:
+            record.trace_id = span.trace_id
+            record.span_id = span.span_id
+            record.trace = f" trace_id={span.trace_id} span_id={span.span_id}"
+        return True
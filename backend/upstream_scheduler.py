@@ -0,0 +1,177 @@
+"""Per-key concurrency limits with fair queueing across users.
+
+Every upstream call takes a slot for its resolved API key. Once a key has
+max_concurrency calls in flight, further requests wait in per-user queues
+served by deficit round-robin: each backlogged user earns `quantum` credit
+per round and is served while its credit covers the cost of its next
+request. With cost set to the prompt's token count, a user sending huge
+prompts cannot starve users sending small ones, and a user with many
+queued requests gets no more turns than one with a single request.
+"""
+import asyncio
+import hashlib
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+from metrics import UPSTREAM_QUEUE_DEPTH, UPSTREAM_QUEUE_WAIT
+
+
+class QueueTimeout(Exception):
+    """Raised when a request waited longer than the scheduler's queue timeout"""
+
+
+class _Waiter:
+    __slots__ = ("user_id", "cost", "future")
+
+    def __init__(self, user_id, cost, future):
+        self.user_id = user_id
+        self.cost = cost
+        self.future = future
+
+
+class _KeyState:
+    """Slots in use and per-user backlogs for one API key"""
+
+    def __init__(self, key):
+        self.key = key
+        self.in_flight = 0
+        self.queues = {}
+        self.deficits = {}
+        self.active = deque()
+
+    @property
+    def queued(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+
+class FairScheduler:
+    """Caps concurrent upstream calls per key and schedules waiters fairly"""
+
+    def __init__(self, max_concurrency: int = 16, quantum: int = 1000, queue_timeout: float = 30.0):
+        self.max_concurrency = max_concurrency
+        self.quantum = quantum
+        self.queue_timeout = queue_timeout
+        self._keys = {}
+
+    @staticmethod
+    def key_for(api_key: str):
+        return hashlib.sha256(api_key.encode()).hexdigest()
+
+    @asynccontextmanager
+    async def slot(self, api_key: str, user_id: str, cost: int = 1, source: str = "unknown"):
+        """Hold one of the key's concurrency slots for the duration of the block"""
+        key = self.key_for(api_key)
+        state = self._keys.get(key)
+        if state is None:
+            state = self._keys[key] = _KeyState(key)
+
+        if state.in_flight < self.max_concurrency and not state.active:
+            state.in_flight += 1
+            UPSTREAM_QUEUE_WAIT.labels(source).observe(0.0)
+        else:
+            await self._wait(state, user_id, max(1, cost), source)
+        try:
+            yield
+        finally:
+            self._release(state)
+
+    def try_slot(self, api_key: str):
+        """Take a spare slot of the key without queueing, e.g. for a hedged request
+
+        Returns a callable releasing the slot, or None when the key is at its
+        limit or other requests are waiting.
+        """
+        key = self.key_for(api_key)
+        state = self._keys.get(key)
+        if state is None:
+            state = self._keys[key] = _KeyState(key)
+        if state.in_flight >= self.max_concurrency or state.active:
+            return None
+        state.in_flight += 1
+        return lambda: self._release(state)
+
+    async def _wait(self, state, user_id, cost, source):
+        waiter = _Waiter(user_id, cost, asyncio.get_running_loop().create_future())
+        queue = state.queues.get(user_id)
+        if queue is None:
+            queue = state.queues[user_id] = deque()
+            state.deficits[user_id] = 0
+            state.active.append(user_id)
+        queue.append(waiter)
+
+        depth = UPSTREAM_QUEUE_DEPTH.labels(source)
+        depth.inc()
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), timeout=self.queue_timeout)
+        except BaseException as e:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # Granted just as we gave up: hand the slot on
+                self._release(state)
+            else:
+                waiter.future.cancel()
+                self._discard(state, waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                raise QueueTimeout(f"Waited {self.queue_timeout}s for an upstream slot") from None
+            raise
+        finally:
+            depth.dec()
+            UPSTREAM_QUEUE_WAIT.labels(source).observe(time.perf_counter() - start)
+
+    def _discard(self, state, waiter):
+        queue = state.queues.get(waiter.user_id)
+        if queue is None:
+            return
+        try:
+            queue.remove(waiter)
+        except ValueError:
+            return
+        if not queue:
+            self._deactivate(state, waiter.user_id)
+
+    def _deactivate(self, state, user_id):
+        del state.queues[user_id]
+        del state.deficits[user_id]
+        state.active.remove(user_id)
+
+    def _next_waiter(self, state):
+        """Deficit round-robin over users with queued requests"""
+        while state.active:
+            user_id = state.active[0]
+            queue = state.queues[user_id]
+            waiter = queue[0]
+            if state.deficits[user_id] >= waiter.cost:
+                state.deficits[user_id] -= waiter.cost
+                queue.popleft()
+                if not queue:
+                    # An idle user keeps no credit; the next user's turn begins
+                    self._deactivate(state, user_id)
+                    if state.active:
+                        state.deficits[state.active[0]] += self.quantum
+                return waiter
+            # Out of credit: move on and give the next user its quantum
+            state.active.rotate(-1)
+            state.deficits[state.active[0]] += self.quantum
+        return None
+
+    def _release(self, state):
+        waiter = self._next_waiter(state)
+        if waiter is not None:
+            # The slot passes straight to the next waiter
+            waiter.future.set_result(None)
+            return
+        state.in_flight -= 1
+        if not state.in_flight and not state.active:
+            self._keys.pop(state.key, None)
+
+    def stats(self):
+        """In-flight and queued counts per key (hash prefix)"""
+        return {
+            key[:12]: {
+                "in_flight": state.in_flight,
+                "queued": state.queued,
+                "queued_users": len(state.active)
+            }
+            for key, state in self._keys.items()
+        }
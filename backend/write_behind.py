@@ -0,0 +1,235 @@
+"""Write-behind queue that takes chat history inserts off the request path.
+
+Records are queued in memory and a single worker flushes them with
+insert_many once a batch fills or flush_interval passes. The queue is
+bounded: when it is full, put() waits up to put_timeout for room and then
+writes the record itself, so callers slow down rather than lose data.
+
+Batches that cannot be written (e.g. Mongo is down), and the rows of a batch
+that Mongo rejected, are appended to a local JSON-lines spill file, one per
+process. Spill files left by any process, including replays abandoned
+mid-way, are replayed after the next successful flush. The queue drains on
+stop(). While the queue is not running, put() writes straight through.
+"""
+import asyncio
+import glob
+import logging
+import os
+
+from bson import json_util
+from pymongo.errors import BulkWriteError
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_KEY = 11000
+
+
+def _claimed_by_live_process(path: str):
+    """Whether the process named in a .replaying.<pid> claim is still running
+
+    Claims by this process's pid count as stale: replays in one process run
+    one at a time, so such a claim was left by an earlier process with the same pid.
+    """
+    pid = int(path.rsplit('.', 1)[1])
+    if pid == os.getpid():
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class WriteBehindQueue:
+    """Batches documents into insert_many calls on a background task"""
+
+    def __init__(self, write, max_size: int = 10000, batch_size: int = 100, flush_interval: float = 0.25,
+                 put_timeout: float = 1.0, spill_path: str = None):
+        """write(docs) inserts a batch; spill_path is the spill file prefix (no spilling if None)"""
+        self.write = write
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.spill_path = spill_path
+        self.queue = asyncio.Queue(maxsize=max_size)
+        self.written = 0
+        self.batches = 0
+        self.spilled = 0
+        self.replayed = 0
+        self.direct_writes = 0
+        self._worker = None
+        self._inflight = []
+        self._spill_pending = False
+
+    @property
+    def running(self):
+        return self._worker is not None and not self._worker.done()
+
+    def start(self):
+        """Start the flush worker; call from inside the loop"""
+        self._spill_pending = bool(self._spill_files())
+        self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def put(self, doc: dict):
+        """Queue a document, applying backpressure when the queue is full"""
+        if not self.running:
+            await self._write_batch([doc])
+            return
+        try:
+            self.queue.put_nowait(doc)
+        except asyncio.QueueFull:
+            try:
+                await asyncio.wait_for(self.queue.put(doc), timeout=self.put_timeout)
+            except asyncio.TimeoutError:
+                self.direct_writes += 1
+                await self._write_batch([doc])
+
+    async def _run(self):
+        while True:
+            batch = [await self.queue.get()]
+            deadline = asyncio.get_running_loop().time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - asyncio.get_running_loop().time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout=timeout))
+                except asyncio.TimeoutError:
+                    break
+            self._inflight = batch
+            await self._flush(batch)
+            self._inflight = []
+
+    async def _flush(self, batch):
+        try:
+            if await self._write_batch(batch) and self._spill_pending:
+                await self.replay_spill()
+        finally:
+            for _ in batch:
+                self.queue.task_done()
+
+    async def _write_batch(self, docs):
+        """Insert docs, spilling them to disk on failure; True when Mongo took them all"""
+        try:
+            await self.write(docs)
+        except BulkWriteError as e:
+            # Records already stored (e.g. a replayed spill) are not an error
+            failed = [docs[error['index']] for error in e.details.get('writeErrors', [])
+                      if error.get('code') != DUPLICATE_KEY]
+            if failed:
+                logger.error("Chat history batch partially failed, spilling %s records: %s",
+                             len(failed), e.details.get('writeErrors', [])[:3])
+                await self._spill(failed)
+                self.written += len(docs) - len(failed)
+                self.batches += 1
+                return False
+        except Exception as e:
+            logger.error("Chat history write failed, spilling %s records: %s", len(docs), e)
+            await self._spill(docs)
+            return False
+        self.written += len(docs)
+        self.batches += 1
+        return True
+
+    def _own_spill_file(self):
+        return f"{self.spill_path}.{os.getpid()}.jsonl"
+
+    def _spill_files(self):
+        """Spill files plus replay claims abandoned by a process that exited mid-replay"""
+        if not self.spill_path:
+            return []
+        prefix = glob.escape(self.spill_path)
+        claims = glob.glob(f"{prefix}.*.jsonl.replaying.*")
+        stale = [path for path in claims if not _claimed_by_live_process(path)]
+        return sorted(glob.glob(f"{prefix}.*.jsonl")) + sorted(stale)
+
+    async def _spill(self, docs):
+        if not self.spill_path:
+            logger.error("No spill file configured, dropping %s chat records", len(docs))
+            return
+        lines = "".join(json_util.dumps(doc) + "\n" for doc in docs)
+
+        def append():
+            with open(self._own_spill_file(), "a") as f:
+                f.write(lines)
+                f.flush()
+                os.fsync(f.fileno())
+
+        await asyncio.to_thread(append)
+        self.spilled += len(docs)
+        self._spill_pending = True
+
+    async def replay_spill(self):
+        """Insert records from spill files; returns the number replayed
+
+        A claimed file is removed only once each of its batches has been
+        written or spilled again, so a crash mid-replay leaves it to be picked
+        up on the next start (duplicates of records already written are skipped).
+        """
+        self._spill_pending = False
+        replayed = 0
+        for path in self._spill_files():
+            # Renaming claims the file so concurrent workers do not replay it twice
+            claimed = f"{path.partition('.replaying.')[0]}.replaying.{os.getpid()}"
+            try:
+                os.rename(path, claimed)
+            except FileNotFoundError:
+                continue
+            docs = await asyncio.to_thread(self._read_spill, claimed)
+            failed = False
+            for start in range(0, len(docs), self.batch_size):
+                batch = docs[start:start + self.batch_size]
+                if await self._write_batch(batch):
+                    replayed += len(batch)
+                else:
+                    # Mongo is failing again: keep the rest for a later replay
+                    rest = docs[start + self.batch_size:]
+                    if rest:
+                        await self._spill(rest)
+                    failed = True
+                    break
+            os.remove(claimed)
+            if failed:
+                break
+        self.replayed += replayed
+        if replayed:
+            logger.info("Replayed %s spilled chat records", replayed)
+        return replayed
+
+    @staticmethod
+    def _read_spill(path):
+        with open(path) as f:
+            return [json_util.loads(line) for line in f if line.strip()]
+
+    async def stop(self, timeout: float = 10.0):
+        """Flush queued records, then stop the worker; spill what cannot be written"""
+        if self._worker is None:
+            return
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Timed out draining chat history queue")
+        self._worker.cancel()
+        try:
+            await self._worker
+        except asyncio.CancelledError:
+            pass
+        self._worker = None
+        # A batch interrupted mid-write is spilled; replays skip duplicates
+        leftover, self._inflight = self._inflight, []
+        while not self.queue.empty():
+            leftover.append(self.queue.get_nowait())
+        if leftover:
+            await self._spill(leftover)
+
+    def stats(self):
+        return {
+            "queued": self.queue.qsize(),
+            "written": self.written,
+            "batches": self.batches,
+            "spilled": self.spilled,
+            "replayed": self.replayed,
+            "direct_writes": self.direct_writes
+        }
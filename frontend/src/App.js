@@ -2,13 +2,17 @@ import React, { useState, useEffect } from 'react';
 import { GoogleOAuthProvider, GoogleLogin } from '@react-oauth/google';
 import axios from 'axios';
 import './App.css';
+import { installTracing, newTraceparent, traceIdOf } from './tracing';
 
 const API_BASE_URL = process.env.REACT_APP_BACKEND_URL;
 
+installTracing(axios);
+
 function App() {
   const [user, setUser] = useState(null);
   const [isLoading, setIsLoading] = useState(true);
   const [messages, setMessages] = useState([]);
+  const [conversationId, setConversationId] = useState(null);
   const [inputMessage, setInputMessage] = useState('');
   const [isSending, setIsSending] = useState(false);
   const [isAdmin, setIsAdmin] = useState(false);
@@ -16,6 +20,7 @@ function App() {
   const [apiKey, setApiKey] = useState('');
   const [userEmail, setUserEmail] = useState('');
   const [users, setUsers] = useState([]);
+  const [usersCursor, setUsersCursor] = useState(null);
   const [adminStats, setAdminStats] = useState(null);
   const [newAdminEmail, setNewAdminEmail] = useState('');
   const [isManagingAdmin, setIsManagingAdmin] = useState(false);
@@ -74,14 +79,17 @@ function App() {
     }
   };
 
-  const fetchUsers = async () => {
+  const fetchUsers = async (after = null) => {
     try {
       const response = await axios.get(`${API_BASE_URL}/api/admin/users`, {
         headers: {
           'Authorization': `Bearer ${localStorage.getItem('authToken')}`
-        }
+        },
+        params: after ? { after } : {}
       });
-      setUsers(response.data.users);
+      // Append when loading the next page, replace on refresh
+      setUsers(prev => after ? [...prev, ...response.data.users] : response.data.users);
+      setUsersCursor(response.data.next_cursor);
     } catch (error) {
       console.error('Failed to fetch users:', error);
     }
@@ -95,10 +103,16 @@ function App() {
     localStorage.removeItem('authToken');
     setUser(null);
     setMessages([]);
+    setConversationId(null);
     setIsAdmin(false);
     setShowAdminPanel(false);
   };
 
+  const startNewConversation = () => {
+    setMessages([]);
+    setConversationId(null);
+  };
+
   const sendMessage = async () => {
     if (!inputMessage.trim() || isSending) return;
 
@@ -113,38 +127,87 @@ function App() {
       timestamp: new Date().toISOString() 
     }]);
 
+    const traceparent = newTraceparent();
     try {
-      const response = await axios.post(
-        `${API_BASE_URL}/api/chat`,
-        { message: userMessage },
-        {
-          headers: {
-            'Authorization': `Bearer ${localStorage.getItem('authToken')}`,
-            'Content-Type': 'application/json'
+      const response = await fetch(`${API_BASE_URL}/api/chat/stream`, {
+        method: 'POST',
+        headers: {
+          'Authorization': `Bearer ${localStorage.getItem('authToken')}`,
+          'Content-Type': 'application/json',
+          traceparent
+        },
+        body: JSON.stringify({ message: userMessage, conversation_id: conversationId })
+      });
+
+      if (!response.ok) {
+        const data = await response.json().catch(() => ({}));
+        const requestError = new Error('Chat request failed');
+        requestError.response = { status: response.status, data };
+        throw requestError;
+      }
+
+      // Add an empty assistant message and fill it in as tokens arrive;
+      // updaters stay pure because StrictMode may call them twice
+      setMessages(prev => [...prev, { type: 'assistant', content: '', timestamp: new Date().toISOString() }]);
+      const appendToken = (delta) => {
+        setMessages(prev => {
+          const last = prev[prev.length - 1];
+          return [...prev.slice(0, -1), { ...last, content: last.content + delta }];
+        });
+      };
+
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+
+      while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        // Server-sent events are separated by a blank line
+        const events = buffer.split('\n\n');
+        buffer = events.pop();
+
+        for (const block of events) {
+          let event = 'message';
+          let data = '';
+          for (const line of block.split('\n')) {
+            if (line.startsWith('event: ')) event = line.slice(7);
+            else if (line.startsWith('data: ')) data += line.slice(6);
           }
-        }
-      );
+          if (!data) continue;
+          const payload = JSON.parse(data);
 
-      // Add assistant response to chat
-      setMessages(prev => [...prev, {
-        type: 'assistant',
-        content: response.data.response,
-        timestamp: response.data.timestamp
-      }]);
+          if (event === 'message') {
+            appendToken(payload.delta);
+          } else if (event === 'done') {
+            setConversationId(payload.conversation_id);
+          } else if (event === 'error') {
+            throw new Error(payload.detail);
+          }
+        }
+      }
 
     } catch (error) {
-      console.error('Failed to send message:', error);
+      // The trace id finds this request's spans and backend log lines
+      console.error(`Failed to send message (trace ${traceIdOf(traceparent)}):`, error);
       let errorMessage = 'Sorry, something went wrong. Please try again.';
       
       if (error.response?.status === 400 && error.response?.data?.detail) {
         errorMessage = error.response.data.detail;
       }
       
-      setMessages(prev => [...prev, {
-        type: 'error',
-        content: errorMessage,
-        timestamp: new Date().toISOString()
-      }]);
+      // Replace the assistant placeholder if no tokens arrived
+      setMessages(prev => {
+        const last = prev[prev.length - 1];
+        const kept = last?.type === 'assistant' && !last.content ? prev.slice(0, -1) : prev;
+        return [...kept, {
+          type: 'error',
+          content: errorMessage,
+          timestamp: new Date().toISOString()
+        }];
+      });
     } finally {
       setIsSending(false);
     }
@@ -425,7 +488,7 @@ function App() {
               <div className="flex justify-between items-center mb-4">
                 <h3 className="text-lg font-medium text-gray-800">Users</h3>
                 <button
-                  onClick={fetchUsers}
+                  onClick={() => fetchUsers()}
                   className="bg-gray-600 text-white px-4 py-2 rounded-lg hover:bg-gray-700 transition-colors"
                 >
                   Refresh
@@ -508,6 +571,14 @@ function App() {
                         </div>
                       </div>
                     ))}
+                    {usersCursor && (
+                      <button
+                        onClick={() => fetchUsers(usersCursor)}
+                        className="w-full text-sm text-blue-600 hover:text-blue-800 py-2"
+                      >
+                        Load more
+                      </button>
+                    )}
                   </div>
                 ) : (
                   <p className="text-gray-500 text-center py-4">No users found</p>
@@ -579,8 +650,15 @@ function App() {
         {/* Chat Interface */}
         <div className="bg-white rounded-xl shadow-sm h-[600px] flex flex-col">
           {/* Chat Header */}
-          <div className="p-4 border-b">
+          <div className="p-4 border-b flex items-center justify-between">
             <h2 className="text-lg font-semibold text-gray-800">Chat with GPT-4</h2>
+            <button
+              onClick={startNewConversation}
+              disabled={isSending || messages.length === 0}
+              className="text-sm text-blue-600 hover:text-blue-800 disabled:text-gray-400"
+            >
+              New chat
+            </button>
           </div>
           
           {/* Messages */}
@@ -596,7 +674,7 @@ function App() {
                 <p className="text-sm text-gray-400 mt-2">Type your message below to get started</p>
               </div>
             ) : (
-              messages.map((message, index) => (
+              messages.map((message, index) => message.type === 'assistant' && !message.content ? null : (
                 <div key={index} className={`flex ${message.type === 'user' ? 'justify-end' : 'justify-start'}`}>
                   <div className={`max-w-xs lg:max-w-md px-4 py-2 rounded-lg ${
                     message.type === 'user' 
@@ -611,7 +689,7 @@ function App() {
               ))
             )}
             
-            {isSending && (
+            {isSending && !(messages[messages.length - 1]?.type === 'assistant' && messages[messages.length - 1].content) && (
               <div className="flex justify-start">
                 <div className="bg-gray-100 text-gray-800 px-4 py-2 rounded-lg">
                   <div className="flex space-x-1">
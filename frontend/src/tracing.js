@@ -0,0 +1,24 @@
+// W3C trace context for API calls, so a chat can be followed from the
+// browser through the backend spans and logs (see backend/tracing.py).
+
+const randomHex = (bytes) => {
+  const values = new Uint8Array(bytes);
+  window.crypto.getRandomValues(values);
+  return Array.from(values, (value) => value.toString(16).padStart(2, '0')).join('');
+};
+
+// A fresh trace per request; the backend applies TRACING_SAMPLE_RATE to it,
+// the sampled flag only lets a caller opt out
+export const newTraceparent = () => `00-${randomHex(16)}-${randomHex(8)}-01`;
+
+export const traceIdOf = (traceparent) => traceparent.split('-')[1];
+
+export const installTracing = (client) => {
+  client.interceptors.request.use((config) => {
+    config.headers = config.headers || {};
+    if (!config.headers.traceparent) {
+      config.headers.traceparent = newTraceparent();
+    }
+    return config;
+  });
+};
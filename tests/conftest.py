@@ -0,0 +1,147 @@
+import asyncio
+import os
+import sys
+import uuid
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backend'))
+
+import server  # noqa: E402
+from database import Database  # noqa: E402
+from openai_clients import OpenAIClientRegistry  # noqa: E402
+from summaries import BackgroundJobs  # noqa: E402
+
+
+class FakeStream:
+    """Async iterator of chat completion chunks, one per word"""
+
+    def __init__(self, reply, chunk_delay):
+        self.words = reply.split(' ')
+        self.chunk_delay = chunk_delay
+        self.sent = 0
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.closed or self.sent >= len(self.words):
+            raise StopAsyncIteration
+        if self.chunk_delay:
+            await asyncio.sleep(self.chunk_delay)
+        word = self.words[self.sent]
+        content = word if self.sent == 0 else ' ' + word
+        self.sent += 1
+        delta = SimpleNamespace(content=content)
+        return SimpleNamespace(choices=[SimpleNamespace(delta=delta)])
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeCompletions:
+    """Stand-in for client.chat.completions with a configurable delay"""
+
+    def __init__(self, delay=0.0, reply="Hello from the fake upstream", chunk_delay=0.0):
+        self.delay = delay
+        self.reply = reply
+        self.chunk_delay = chunk_delay
+        self.calls = []
+        self.streams = []
+
+    async def create(self, **kwargs):
+        self.calls.append(kwargs)
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if kwargs.get('stream'):
+            stream = FakeStream(self.reply, self.chunk_delay)
+            self.streams.append(stream)
+            return stream
+        message = SimpleNamespace(content=self.reply)
+        usage = SimpleNamespace(prompt_tokens=12, completion_tokens=len(self.reply.split()))
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=usage)
+
+
+class FakeAsyncOpenAI:
+    """Replacement for openai.AsyncOpenAI that never touches the network"""
+
+    completions = FakeCompletions()
+
+    def __init__(self, api_key=None, **kwargs):
+        self.api_key = api_key
+        self.closed = False
+        self.chat = SimpleNamespace(completions=FakeAsyncOpenAI.completions)
+
+    async def close(self):
+        self.closed = True
+
+
+class CountingCollection:
+    """Wraps a collection and counts the calls made to each method"""
+
+    def __init__(self, collection):
+        self._collection = collection
+        self.calls = {}
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if not callable(attr):
+            return attr
+
+        def counted(*args, **kwargs):
+            self.calls[name] = self.calls.get(name, 0) + 1
+            return attr(*args, **kwargs)
+
+        return counted
+
+    def reset(self):
+        self.calls = {}
+
+
+@pytest.fixture
+def mongo(monkeypatch):
+    """Point server.py at an in-memory Motor-compatible database"""
+    database = Database(AsyncMongoMockClient(), 'test_' + uuid.uuid4().hex[:8])
+    monkeypatch.setattr(server, 'mongo', database)
+    monkeypatch.setattr(server, 'users_collection', database.users)
+    monkeypatch.setattr(server, 'chats_collection', database.chats)
+    monkeypatch.setattr(server, 'admin_collection', database.admin)
+    monkeypatch.setattr(server, 'messages_collection', database.messages)
+    monkeypatch.setattr(server, 'conversations_collection', database.conversations)
+    monkeypatch.setattr(server, 'turn_jobs', BackgroundJobs())
+    for cache in (server.default_api_key_cache, server.token_cache, server.user_cache):
+        cache.clear()
+    return database
+
+
+@pytest.fixture
+def fake_openai(monkeypatch):
+    """Replace the OpenAI client with an in-process fake"""
+    FakeAsyncOpenAI.completions = FakeCompletions()
+    monkeypatch.setattr(server, 'openai_clients', OpenAIClientRegistry(client_factory=FakeAsyncOpenAI))
+    return FakeAsyncOpenAI.completions
+
+
+@pytest.fixture
+def create_user(mongo):
+    """Async factory that inserts a user and returns it with a signed token"""
+
+    async def factory(email='user@test.com', is_admin=False, **extra):
+        user = {
+            'user_id': str(uuid.uuid4()),
+            'email': email,
+            'name': email.split('@')[0],
+            'picture': '',
+            'is_admin': is_admin,
+            'created_at': datetime.utcnow(),
+            'last_login': datetime.utcnow(),
+        }
+        user.update(extra)
+        await mongo.users.insert_one(dict(user))
+        return user, server.create_jwt_token(user)
+
+    return factory
@@ -0,0 +1,51 @@
+import asyncio
+
+import httpx
+
+import server
+from tests.conftest import CountingCollection
+
+
+def test_user_list_pages_without_per_user_queries(mongo, create_user, monkeypatch):
+    users = CountingCollection(mongo.users)
+    admin = CountingCollection(mongo.admin)
+    monkeypatch.setattr(server, 'users_collection', users)
+    monkeypatch.setattr(server, 'admin_collection', admin)
+
+    async def scenario():
+        await mongo.admin.insert_one({'type': 'default', 'api_key': 'sk-default'})
+        _, token = await create_user(email='admin@test.com', is_admin=True)
+        for i in range(9):
+            extra = {'api_key': 'sk-personal'} if i % 3 == 0 else {}
+            await create_user(email=f'user{i}@test.com', **extra)
+        users.reset()
+
+        headers = {'Authorization': f'Bearer {token}'}
+        pages = []
+        after = None
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+            while True:
+                params = {'limit': 4}
+                if after:
+                    params['after'] = after
+                response = await client.get('/api/admin/users', params=params, headers=headers)
+                body = response.json()
+                pages.append(body['users'])
+                after = body['next_cursor']
+                if not after:
+                    break
+        return pages
+
+    pages = asyncio.run(scenario())
+    listed = [user for page in pages for user in page]
+    assert [len(page) for page in pages] == [4, 4, 2]
+    assert [u['user_id'] for u in listed] == sorted(u['user_id'] for u in listed)
+    assert len({u['email'] for u in listed}) == 10
+    assert all('api_key' not in u for u in listed)
+    assert sum(u['has_personal_key'] for u in listed) == 3
+    assert {u['api_key_source'] for u in listed if not u['has_personal_key']} == {'default_admin'}
+    # One page query per request and one admin read (admin checks skip the
+    # user cache); the default key is read once
+    assert users.calls == {'find_one': 3, 'find': 3}
+    assert admin.calls == {'find_one': 1}
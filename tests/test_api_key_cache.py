@@ -0,0 +1,88 @@
+import asyncio
+import time
+
+import httpx
+
+import server
+from cache import MISSING, TTLCache
+from tests.conftest import CountingCollection
+
+
+def test_ttl_cache_expires_and_evicts_lru(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+    cache = TTLCache(maxsize=2, ttl=10)
+    cache.set('a', 1)
+    cache.set('b', None)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    cache.set('c', 3)  # 'a' was used more recently than 'b'
+    assert cache.get('b') is MISSING
+    now[0] += 11
+    assert cache.get('a') is MISSING
+    assert cache.get('c') is MISSING
+
+
+def test_warm_chat_path_reads_no_keys_from_db(mongo, fake_openai, create_user, monkeypatch):
+    users = CountingCollection(mongo.users)
+    admin = CountingCollection(mongo.admin)
+    monkeypatch.setattr(server, 'users_collection', users)
+    monkeypatch.setattr(server, 'admin_collection', admin)
+
+    async def scenario():
+        await mongo.admin.insert_one({'type': 'default', 'api_key': 'sk-default'})
+        _, token = await create_user()
+        headers = {'Authorization': f'Bearer {token}'}
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+            await client.post('/api/chat', json={'message': 'warm up'}, headers=headers)
+            users.reset()
+            admin.reset()
+            response = await client.post('/api/chat', json={'message': 'hi'}, headers=headers)
+        return response
+
+    response = asyncio.run(scenario())
+    assert response.json()['api_key_source'] == 'default_admin'
+    assert admin.calls == {}
+    assert users.calls == {}
+
+
+def test_admin_writes_invalidate_cached_keys(mongo, fake_openai, create_user, monkeypatch):
+    monkeypatch.setattr(server, 'OPENAI_API_KEY', None)
+
+    async def scenario():
+        _, admin_token = await create_user(email='admin@test.com', is_admin=True)
+        user, token = await create_user()
+        admin_headers = {'Authorization': f'Bearer {admin_token}'}
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+            async def resolved_key():
+                """The key the user's next chat would use, through the cached user document"""
+                await client.get('/api/user/api-key-status', headers={'Authorization': f'Bearer {token}'})
+                return await server.get_user_api_key(server.user_cache.get(user['user_id']))
+
+            # Prime the caches with "no key configured"
+            assert await resolved_key() is None
+
+            await client.post('/api/admin/configure', json={'openai_key': 'sk-default'}, headers=admin_headers)
+            default = await resolved_key()
+
+            await client.post(
+                '/api/admin/user-api-key',
+                json={'email': user['email'], 'api_key': 'sk-personal'},
+                headers=admin_headers,
+            )
+            personal = await resolved_key()
+
+            await client.post(
+                '/api/admin/configure',
+                json={'openai_key': 'sk-other', 'user_email': user['email']},
+                headers=admin_headers,
+            )
+            reconfigured = await resolved_key()
+        return default, personal, reconfigured
+
+    default, personal, reconfigured = asyncio.run(scenario())
+    assert default == {'key': 'sk-default', 'source': 'default_admin'}
+    assert personal == {'key': 'sk-personal', 'source': 'user_specific'}
+    assert reconfigured == {'key': 'sk-other', 'source': 'user_specific'}
@@ -0,0 +1,94 @@
+import asyncio
+import time
+
+import httpx
+
+import server
+
+
+class SlowCollection:
+    """Wraps a collection so every write waits like a remote round trip"""
+
+    def __init__(self, collection, delay):
+        self._collection = collection
+        self._delay = delay
+        self.writes = 0
+
+    def __getattr__(self, name):
+        return getattr(self._collection, name)
+
+    async def insert_one(self, document):
+        self.writes += 1
+        await asyncio.sleep(self._delay)
+        return await self._collection.insert_one(document)
+
+    async def insert_many(self, documents, **kwargs):
+        self.writes += 1
+        await asyncio.sleep(self._delay)
+        return await self._collection.insert_many(documents, **kwargs)
+
+
+def p99(samples):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+
+
+async def profile_latencies(client, headers, count, interval=0.0):
+    samples = []
+    for _ in range(count):
+        start = time.perf_counter()
+        response = await client.get('/api/user/profile', headers=headers)
+        samples.append(time.perf_counter() - start)
+        assert response.status_code == 200
+        await asyncio.sleep(interval)
+    return samples
+
+
+def test_profile_latency_flat_while_chats_in_flight(mongo, fake_openai, create_user, monkeypatch):
+    fake_openai.delay = 0.2
+    slow_chats = SlowCollection(mongo.chats, 0.1)
+    monkeypatch.setattr(server, 'chats_collection', slow_chats)
+    monkeypatch.setattr(server, 'OPENAI_API_KEY', 'sk-test')
+
+    async def scenario():
+        user, token = await create_user()
+        headers = {'Authorization': f'Bearer {token}'}
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+            baseline = await profile_latencies(client, headers, 50)
+
+            chats = [
+                asyncio.create_task(client.post('/api/chat', json={'message': 'hi'}, headers=headers))
+                for _ in range(25)
+            ]
+            await asyncio.sleep(0.01)
+            # Spread samples across the upstream wait and the history inserts
+            loaded = await profile_latencies(client, headers, 50, interval=0.008)
+            responses = await asyncio.gather(*chats)
+
+        assert all(r.status_code == 200 for r in responses)
+        assert await mongo.chats.count_documents({'user_id': user['user_id']}) == 25
+        assert slow_chats.writes == 25
+        return p99(baseline), p99(loaded)
+
+    baseline_p99, loaded_p99 = asyncio.run(scenario())
+    # A blocking driver would stall profile calls behind 25 x 0.1s of inserts
+    assert loaded_p99 < baseline_p99 + 0.1
+
+
+def test_chat_history_reads_through_async_driver(mongo, fake_openai, create_user, monkeypatch):
+    monkeypatch.setattr(server, 'OPENAI_API_KEY', 'sk-test')
+
+    async def scenario():
+        _, token = await create_user()
+        headers = {'Authorization': f'Bearer {token}'}
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+            await client.post('/api/chat', json={'message': 'first'}, headers=headers)
+            await asyncio.sleep(0.01)  # Mongo stores millisecond timestamps
+            await client.post('/api/chat', json={'message': 'second'}, headers=headers)
+            return await client.get('/api/chat/history', headers=headers)
+
+    response = asyncio.run(scenario())
+    assert response.status_code == 200
+    assert [c['user_message'] for c in response.json()['chats']] == ['second', 'first']
@@ -0,0 +1,77 @@
+import asyncio
+import hashlib
+import time
+
+import httpx
+import jwt
+import server
+from cache import MISSING
+from tests.conftest import CountingCollection
+
+
+def test_warm_auth_makes_no_db_reads_and_no_decodes(mongo, create_user, monkeypatch):
+    users = CountingCollection(mongo.users)
+    monkeypatch.setattr(server, 'users_collection', users)
+    decodes = []
+    real_decode = jwt.decode
+    monkeypatch.setattr(jwt, 'decode', lambda *a, **k: decodes.append(1) or real_decode(*a, **k))
+
+    async def scenario():
+        _, token = await create_user()
+        headers = {'Authorization': f'Bearer {token}'}
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+            for _ in range(5):
+                assert (await client.get('/api/user/profile', headers=headers)).status_code == 200
+
+    asyncio.run(scenario())
+    assert len(decodes) == 1
+    assert users.calls == {'find_one': 1}
+
+
+def test_cached_token_is_bounded_by_expiry(mongo, monkeypatch):
+    token = jwt.encode({'user_id': 'u', 'email': 'e', 'exp': int(time.time()) + 2}, 'secret-key', algorithm='HS256')
+    server.verify_jwt_token(token)
+    token_hash = hashlib.sha256(token.encode()).hexdigest()
+    assert server.token_cache.get(token_hash) is not MISSING
+
+    now = time.monotonic()
+    monkeypatch.setattr(time, 'monotonic', lambda: now + 3)
+    assert server.token_cache.get(token_hash) is MISSING
+
+
+def test_manage_admin_invalidates_cached_user(mongo, create_user):
+    async def scenario():
+        _, admin_token = await create_user(email='admin@test.com', is_admin=True)
+        user, token = await create_user()
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+            before = (await client.get('/api/user/profile', headers={'Authorization': f'Bearer {token}'})).json()
+            await client.post(
+                '/api/admin/manage-admin',
+                json={'email': user['email'], 'action': 'add'},
+                headers={'Authorization': f'Bearer {admin_token}'},
+            )
+            after = (await client.get('/api/user/profile', headers={'Authorization': f'Bearer {token}'})).json()
+        return before, after
+
+    before, after = asyncio.run(scenario())
+    assert before['is_admin'] is False
+    assert after['is_admin'] is True
+
+
+def test_admin_endpoints_see_a_revocation_made_by_another_worker(mongo, create_user):
+    async def scenario():
+        admin, token = await create_user(email='admin@test.com', is_admin=True)
+        headers = {'Authorization': f'Bearer {token}'}
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+            before = await client.get('/api/admin/users', headers=headers)
+            # Another worker revokes admin; this worker's user_cache never hears of it
+            await mongo.users.update_one({'user_id': admin['user_id']}, {'$set': {'is_admin': False}})
+            after = await client.get('/api/admin/users', headers=headers)
+        return before, after
+
+    before, after = asyncio.run(scenario())
+    assert before.status_code == 200
+    assert after.status_code == 403
@@ -0,0 +1,80 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import httpx
+
+import server
+from chat_history import PREVIEW_LENGTH, backfill_previews
+
+
+async def seed_chats(mongo, user_id, count):
+    base = datetime(2026, 1, 1)
+    for i in range(count):
+        # Pairs of chats share a timestamp to exercise the chat_id tiebreaker
+        record = server.create_chat_record(user_id, 'session', f'question {i}', 'answer ' * 100, 'environment')
+        record['chat_id'] = f'chat-{i:03d}'
+        record['timestamp'] = base + timedelta(seconds=i // 2)
+        await mongo.chats.insert_one(record)
+
+
+def test_history_pages_with_keyset_cursor(mongo, create_user):
+    async def scenario():
+        user, token = await create_user()
+        await seed_chats(mongo, user['user_id'], 7)
+        headers = {'Authorization': f'Bearer {token}'}
+        pages = []
+        before = None
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+            while True:
+                params = {'limit': 3}
+                if before:
+                    params['before'] = before
+                body = (await client.get('/api/chat/history', params=params, headers=headers)).json()
+                pages.append([chat['chat_id'] for chat in body['chats']])
+                before = body['next_before']
+                if not before:
+                    break
+        return pages
+
+    pages = asyncio.run(scenario())
+    assert pages == [
+        ['chat-006', 'chat-005', 'chat-004'],
+        ['chat-003', 'chat-002', 'chat-001'],
+        ['chat-000'],
+    ]
+
+
+def test_summary_returns_previews_and_chat_fetches_full_body(mongo, create_user):
+    async def scenario():
+        user, token = await create_user()
+        await seed_chats(mongo, user['user_id'], 2)
+        headers = {'Authorization': f'Bearer {token}'}
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+            summary = (await client.get('/api/chat/history', params={'summary': 'true'}, headers=headers)).json()
+            full = await client.get(f"/api/chat/{summary['chats'][0]['chat_id']}", headers=headers)
+            missing = await client.get('/api/chat/unknown', headers=headers)
+            bad_cursor = await client.get('/api/chat/history', params={'before': 'garbage'}, headers=headers)
+        return summary, full, missing, bad_cursor
+
+    summary, full, missing, bad_cursor = asyncio.run(scenario())
+    row = summary['chats'][0]
+    assert 'assistant_response' not in row and 'user_message' not in row
+    assert len(row['assistant_response_preview']) <= PREVIEW_LENGTH
+    assert full.json()['assistant_response'] == 'answer ' * 100
+    assert 'assistant_response_preview' not in full.json()
+    assert missing.status_code == 404
+    assert bad_cursor.status_code == 400
+
+
+def test_backfill_previews_on_legacy_chats(mongo):
+    async def scenario():
+        await mongo.chats.insert_one({'chat_id': 'old', 'user_message': 'hi', 'assistant_response': 'x' * 500})
+        count = await backfill_previews(mongo.chats)
+        return count, await mongo.chats.find_one({'chat_id': 'old'})
+
+    count, chat = asyncio.run(scenario())
+    assert count == 1
+    assert chat['user_message_preview'] == 'hi'
+    assert chat['assistant_response_preview'].endswith('…')
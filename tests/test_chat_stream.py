@@ -0,0 +1,94 @@
+import asyncio
+import json
+
+import httpx
+
+import server
+
+
+def parse_events(body):
+    events = []
+    for block in body.strip().split('\n\n'):
+        event = 'message'
+        data = None
+        for line in block.split('\n'):
+            if line.startswith('event: '):
+                event = line[len('event: '):]
+            elif line.startswith('data: '):
+                data = json.loads(line[len('data: '):])
+        events.append((event, data))
+    return events
+
+
+def test_stream_sends_deltas_and_persists_record(mongo, fake_openai, create_user, monkeypatch):
+    monkeypatch.setattr(server, 'OPENAI_API_KEY', 'sk-test')
+
+    async def scenario():
+        user, token = await create_user()
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+            response = await client.post(
+                '/api/chat/stream', json={'message': 'hi'}, headers={'Authorization': f'Bearer {token}'}
+            )
+        record = await mongo.chats.find_one({'user_id': user['user_id']})
+        return response, record
+
+    response, record = asyncio.run(scenario())
+    assert response.headers['content-type'].startswith('text/event-stream')
+    events = parse_events(response.text)
+    deltas = [data['delta'] for event, data in events if event == 'message']
+    assert ''.join(deltas) == fake_openai.reply
+    assert events[-1][0] == 'done'
+    assert events[-1][1]['api_key_source'] == 'environment'
+    assert fake_openai.calls[0]['stream'] is True
+    assert record['assistant_response'] == fake_openai.reply
+
+
+def test_client_disconnect_cancels_upstream(mongo, fake_openai, create_user, monkeypatch):
+    monkeypatch.setattr(server, 'OPENAI_API_KEY', 'sk-test')
+    fake_openai.reply = ' '.join(['token'] * 50)
+    fake_openai.chunk_delay = 0.01
+
+    async def scenario():
+        user, token = await create_user()
+        first_chunk = asyncio.Event()
+        request_sent = False
+
+        async def receive():
+            nonlocal request_sent
+            if not request_sent:
+                request_sent = True
+                return {'type': 'http.request', 'body': b'{"message": "hi"}', 'more_body': False}
+            await first_chunk.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            if message['type'] == 'http.response.body' and message.get('body'):
+                first_chunk.set()
+
+        scope = {
+            'type': 'http',
+            'asgi': {'version': '3.0', 'spec_version': '2.3'},
+            'http_version': '1.1',
+            'method': 'POST',
+            'scheme': 'http',
+            'path': '/api/chat/stream',
+            'raw_path': b'/api/chat/stream',
+            'query_string': b'',
+            'root_path': '',
+            'headers': [
+                (b'host', b'test'),
+                (b'content-type', b'application/json'),
+                (b'authorization', f'Bearer {token}'.encode()),
+            ],
+            'client': ('127.0.0.1', 1234),
+            'server': ('test', 80),
+        }
+        await server.app(scope, receive, send)
+        return await mongo.chats.count_documents({'user_id': user['user_id']})
+
+    saved = asyncio.run(scenario())
+    stream = fake_openai.streams[0]
+    assert stream.closed
+    assert stream.sent < 50
+    assert saved == 0
@@ -0,0 +1,116 @@
+import asyncio
+import time
+
+import httpx
+
+import context_window
+import server
+from context_window import ContextBuilder, TokenCounter, parse_budgets
+from conversations import build_turn
+
+
+class CountingCounter(TokenCounter):
+    """Token counter that records how many texts it tokenized"""
+
+    calls = 0
+
+    def count(self, text):
+        CountingCounter.calls += 1
+        return super().count(text)
+
+
+def make_history(turns, tokens=True):
+    builder = ContextBuilder()
+    history = []
+    for i in range(turns):
+        question, answer = f'question {i} ' * 20, f'answer {i} ' * 60
+        counts = (builder.count('gpt-4', question), builder.count('gpt-4', answer)) if tokens else (None, None)
+        history.extend(build_turn('conversation', 'user', question, answer, counts))
+    return history
+
+
+def test_trims_oldest_turns_to_budget_and_starts_with_user():
+    builder = ContextBuilder({'gpt-4': 2000})
+    history = make_history(50)
+    messages, context = builder.build('gpt-4', server.SYSTEM_PROMPT, history, 'latest')
+
+    assert context['prompt_tokens'] <= 2000
+    assert context['dropped'] > 0 and context['kept'] + context['dropped'] == len(history)
+    assert messages[0]['role'] == 'system' and messages[1]['role'] == 'user'
+    assert messages[-2]['content'] == history[-1]['content']
+    assert messages[-1] == {'role': 'user', 'content': 'latest'}
+
+
+def test_counts_are_cached_on_messages_and_persisted(mongo, fake_openai, create_user, monkeypatch):
+    monkeypatch.setattr(server, 'OPENAI_API_KEY', 'sk-test')
+
+    async def scenario():
+        user, token = await create_user()
+        # A message stored before counts were cached
+        legacy = build_turn('legacy', user['user_id'], 'old question', 'old answer')
+        await mongo.messages.insert_many(legacy)
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+            await client.post('/api/chat', json={'message': 'next', 'conversation_id': 'legacy'},
+                              headers={'Authorization': f'Bearer {token}'})
+        await server.turn_jobs.drain()
+        return await mongo.messages.find({'conversation_id': 'legacy'}).to_list(length=None)
+
+    stored = asyncio.run(scenario())
+    assert len(stored) == 4
+    assert all(isinstance(doc['tokens'], int) and doc['tokens'] > 0 for doc in stored)
+
+
+def test_failing_encoding_load_falls_back_to_estimate(mongo, fake_openai, create_user, monkeypatch):
+    monkeypatch.setattr(server, 'OPENAI_API_KEY', 'sk-test')
+
+    def unreachable(model):
+        raise OSError('cannot download cl100k_base.tiktoken')
+
+    monkeypatch.setattr(context_window, 'load_encoding', unreachable)
+    builder = ContextBuilder()
+    monkeypatch.setattr(server, 'context_builder', builder)
+
+    async def scenario():
+        await builder.preload(['gpt-4'])
+        _, token = await create_user()
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+            return await client.post('/api/chat', json={'message': 'hi'}, headers={'Authorization': f'Bearer {token}'})
+
+    response = asyncio.run(scenario())
+    assert response.status_code == 200
+    assert builder.counter('gpt-4').encoding is None
+    assert builder.count('gpt-4', 'x' * 40) == 40 // context_window.CHARS_PER_TOKEN + 1 + context_window.MESSAGE_OVERHEAD
+
+
+def test_budget_overrides_parse():
+    assert parse_budgets('gpt-4=6000, gpt-4o=90000,') == {'gpt-4': 6000, 'gpt-4o': 90000}
+    assert ContextBuilder({'custom': 100}).budget('custom') == 100
+
+
+def test_context_assembly_benchmark_on_1k_turn_conversation(record_property):
+    """Cached counts make assembly independent of message length"""
+    cached = make_history(1000)
+    uncached = make_history(1000, tokens=False)
+    builder = ContextBuilder({'gpt-4': 10 ** 9}, counter_factory=CountingCounter)
+    iterations = 20
+
+    def timed(history_factory):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            builder.build('gpt-4', server.SYSTEM_PROMPT, history_factory(), 'latest')
+        return (time.perf_counter() - start) / iterations
+
+    CountingCounter.calls = 0
+    with_cache = min(timed(lambda: cached) for _ in range(3))
+    cached_calls = CountingCounter.calls
+    without_cache = min(timed(lambda: [dict(doc, tokens=None) for doc in uncached]) for _ in range(3))
+    record_property('context_assembly_cached_ms', round(with_cache * 1e3, 2))
+    record_property('context_assembly_recounting_ms', round(without_cache * 1e3, 2))
+
+    # Only the system prompt (once) and the new message are tokenized
+    assert cached_calls <= 1 + 3 * iterations
+    assert with_cache < without_cache
+    # Generous bound so slow CI machines do not flake; typically ~0.5ms
+    assert with_cache < 0.02
@@ -0,0 +1,74 @@
+import asyncio
+
+import httpx
+
+import server
+from tests.conftest import CountingCollection
+
+
+def test_follow_up_sends_earlier_turns_with_one_read(mongo, fake_openai, create_user, monkeypatch):
+    monkeypatch.setattr(server, 'OPENAI_API_KEY', 'sk-test')
+    monkeypatch.setattr(server, 'CONTEXT_TURNS', 2)
+    counting = CountingCollection(mongo.messages)
+    monkeypatch.setattr(server, 'messages_collection', counting)
+
+    async def scenario():
+        user, token = await create_user()
+        headers = {'Authorization': f'Bearer {token}'}
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+            first = (await client.post('/api/chat', json={'message': 'one'}, headers=headers)).json()
+            conversation_id = first['conversation_id']
+            for text in ('two', 'three'):
+                await asyncio.sleep(0.01)
+                await client.post('/api/chat', json={'message': text, 'conversation_id': conversation_id},
+                                  headers=headers)
+            await server.turn_jobs.drain()
+            counting.reset()
+            await asyncio.sleep(0.01)
+            await client.post('/api/chat', json={'message': 'four', 'conversation_id': conversation_id},
+                              headers=headers)
+            # The turn is written after the response, off the request path
+            await server.turn_jobs.drain()
+            turn_calls = dict(counting.calls)
+            listing = (await client.get('/api/conversations', headers=headers)).json()
+            messages = (await client.get(f'/api/conversations/{conversation_id}/messages',
+                                         headers=headers)).json()
+        return conversation_id, turn_calls, listing, messages
+
+    conversation_id, turn_calls, listing, messages = asyncio.run(scenario())
+    # Only the last two turns are sent upstream, oldest first
+    sent = fake_openai.calls[-1]['messages']
+    assert [m['content'] for m in sent[1:] if m['role'] == 'user'] == ['two', 'three', 'four']
+    assert sent[-1] == {'role': 'user', 'content': 'four'}
+    assert turn_calls == {'find': 1, 'insert_many': 1}
+    assert listing['conversations'][0]['conversation_id'] == conversation_id
+    assert listing['conversations'][0]['turns'] == 4
+    assert listing['conversations'][0]['title'] == 'one'
+    assert [m['content'] for m in messages['messages'] if m['role'] == 'user'] == ['one', 'two', 'three', 'four']
+
+
+def test_unknown_or_foreign_conversation_is_not_found(mongo, fake_openai, create_user, monkeypatch):
+    monkeypatch.setattr(server, 'OPENAI_API_KEY', 'sk-test')
+
+    async def scenario():
+        owner, owner_token = await create_user('owner@test.com')
+        _, other_token = await create_user('other@test.com')
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+            first = (await client.post('/api/chat', json={'message': 'hi'},
+                                       headers={'Authorization': f'Bearer {owner_token}'})).json()
+            foreign = await client.post(
+                '/api/chat/stream', json={'message': 'hi', 'conversation_id': first['conversation_id']},
+                headers={'Authorization': f'Bearer {other_token}'}
+            )
+            unknown = await client.post(
+                '/api/chat', json={'message': 'hi', 'conversation_id': 'missing'},
+                headers={'Authorization': f'Bearer {owner_token}'}
+            )
+        return foreign, unknown
+
+    foreign, unknown = asyncio.run(scenario())
+    assert foreign.status_code == 404
+    assert unknown.status_code == 404
+    assert len(fake_openai.calls) == 1
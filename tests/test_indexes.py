@@ -0,0 +1,96 @@
+import asyncio
+import os
+import uuid
+from datetime import datetime
+
+import pytest
+
+from database import Database, create_client
+from indexes import (INDEXES, IndexBuildError, acquire_migration_lock, backfill_user_ids, ensure_indexes,
+                     find_collection_scans, migrate, plan_stages, run_migrations)
+
+
+def test_ensure_indexes_creates_every_index(mongo):
+    created = asyncio.run(ensure_indexes(mongo, progress_interval=0.01))
+    assert created == {name: [model.document['name'] for model in models] for name, models in INDEXES.items()}
+
+    info = asyncio.run(mongo.users.index_information())
+    assert info['user_id_unique']['unique']
+    assert info['email_unique']['unique']
+
+
+def test_failed_index_build_does_not_stop_the_others(mongo):
+    async def scenario():
+        # Duplicate emails make the unique index fail to build
+        await mongo.users.insert_many([{'user_id': 'u-1', 'email': 'same@test.com'},
+                                       {'user_id': 'u-2', 'email': 'same@test.com'}])
+        with pytest.raises(IndexBuildError) as raised:
+            await ensure_indexes(mongo, progress_interval=0.01)
+        return raised.value, await mongo.profiles.index_information()
+
+    error, profile_indexes = asyncio.run(scenario())
+    assert error.failed == {'users': ['email_unique']}
+    assert error.created['users'] == ['user_id_unique']
+    assert 'started_at' in profile_indexes
+
+
+def test_migrations_run_in_one_worker_at_a_time(mongo):
+    async def scenario():
+        assert await acquire_migration_lock(mongo, 'other-worker')
+        skipped = await migrate(mongo)
+        indexes_while_locked = await mongo.chats.index_information()
+        await mongo.admin.update_one({'type': 'migration_lock'}, {'$set': {'expires_at': datetime(2000, 1, 1)}})
+        created = await migrate(mongo)
+        return skipped, indexes_while_locked, created, await mongo.admin.find_one({'type': 'migration_lock'})
+
+    skipped, indexes_while_locked, created, lock = asyncio.run(scenario())
+    assert skipped is None and 'chat_id_unique' not in indexes_while_locked
+    # An expired lock is taken over, and released once done
+    assert 'chat_id_unique' in created['chats']
+    assert lock is None
+
+
+def test_backfill_assigns_user_ids(mongo):
+    async def scenario():
+        await mongo.users.insert_one({'email': 'placeholder@test.com', 'api_key': 'sk-x'})
+        await mongo.users.insert_one({'email': 'real@test.com', 'user_id': 'u-1'})
+        count = await backfill_user_ids(mongo)
+        return count, await mongo.users.find_one({'email': 'placeholder@test.com'})
+
+    count, user = asyncio.run(scenario())
+    assert count == 1
+    assert user['user_id']
+
+
+def test_migrations_run_once(mongo):
+    async def scenario():
+        await mongo.chats.insert_one({'chat_id': 'c-1', 'user_message': 'hi', 'assistant_response': 'hello'})
+        first = await run_migrations(mongo)
+        # A later startup must not scan chats again
+        await mongo.chats.insert_one({'chat_id': 'c-2', 'user_message': 'hi', 'assistant_response': 'hello'})
+        second = await run_migrations(mongo)
+        return first, second, await mongo.chats.find_one({'chat_id': 'c-2'})
+
+    first, second, unscanned = asyncio.run(scenario())
+    assert first == ['user_ids', 'chat_previews']
+    assert second == []
+    assert 'user_message_preview' not in unscanned
+
+
+def test_plan_stages_finds_nested_collscan():
+    plan = {'stage': 'LIMIT', 'inputStage': {'stage': 'SORT', 'inputStage': {'stage': 'COLLSCAN'}}}
+    assert list(plan_stages(plan)) == ['LIMIT', 'SORT', 'COLLSCAN']
+
+
+@pytest.mark.skipif(not os.environ.get('TEST_MONGO_URL'), reason="explain() needs a real MongoDB (set TEST_MONGO_URL)")
+def test_hot_queries_do_not_collection_scan():
+    async def scenario():
+        database = Database(create_client(os.environ['TEST_MONGO_URL']), 'test_indexes_' + uuid.uuid4().hex[:8])
+        try:
+            await migrate(database)
+            return await find_collection_scans(database)
+        finally:
+            await database.client.drop_database(database.db.name)
+            database.close()
+
+    assert asyncio.run(scenario()) == []
@@ -0,0 +1,62 @@
+import asyncio
+import json
+
+from mongomock_motor import AsyncMongoMockClient
+
+import server
+from database import Database
+from fake_upstream import FakeUpstreamConfig
+from loadtest import DEFAULT_MIX, configure_server, format_report, percentile, run_load
+
+
+def test_percentile_uses_nearest_rank():
+    ordered = list(range(1, 101))
+    assert percentile(ordered, 0.50) == 50
+    assert percentile(ordered, 0.99) == 99
+    assert percentile([7], 0.95) == 7
+    assert percentile([], 0.5) is None
+
+
+def test_load_run_reports_every_endpoint(tmp_path):
+    originals = server.mongo, server.openai_clients, server.upstream_policy
+    report = asyncio.run(run_load(
+        concurrency=4, duration=0, requests=60, users=3, warmup=len(DEFAULT_MIX),
+        upstream_config=FakeUpstreamConfig(latency=0.01, reply_tokens=5)
+    ))
+
+    assert set(report['endpoints']) == set(DEFAULT_MIX)
+    assert report['overall']['requests'] == 60
+    assert report['overall']['errors'] == 0
+    for row in report['endpoints'].values():
+        latency = row['latency_ms']
+        assert latency['p50'] <= latency['p95'] <= latency['p99'] <= latency['max']
+    assert 'first_event_ms' in report['endpoints']['POST /api/chat/stream']
+    # Warmup requests reach the upstream but are not recorded
+    chats = sum(report['endpoints'][endpoint]['requests'] for endpoint in ('POST /api/chat', 'POST /api/chat/stream'))
+    assert report['upstream']['requests'] == chats + 2
+    # server.py globals are restored after the run
+    assert (server.mongo, server.openai_clients, server.upstream_policy) == originals
+
+    path = tmp_path / 'run.json'
+    path.write_text(json.dumps(report))
+    assert json.loads(path.read_text())['meta']['mongo'] == 'in-memory'
+    assert 'overall' in format_report(report)
+
+
+def test_profiles_go_to_the_load_test_database():
+    database = Database(AsyncMongoMockClient(), 'loadtest_profiles')
+    original = server.profiler.store
+    with configure_server(database, 'http://127.0.0.1:1/v1'):
+        store = server.profiler.store
+    assert store.control is database.admin and store.profiles is database.profiles
+    assert server.profiler.store is original
+
+
+def test_injected_upstream_errors_are_counted():
+    report = asyncio.run(run_load(
+        concurrency=2, duration=0, requests=10, users=2, warmup=0,
+        mix={'POST /api/chat': 1, 'POST /api/chat/stream': 1},
+        upstream_config=FakeUpstreamConfig(error_rate=1.0, error_status=400)
+    ))
+    assert report['overall']['errors'] == 10
+    assert report['endpoints']['POST /api/chat']['statuses'] == {'400': report['endpoints']['POST /api/chat']['requests']}
@@ -0,0 +1,42 @@
+import asyncio
+import time
+
+from loop_monitor import LoopBlockingDetector
+
+
+def blocking_lookup():
+    time.sleep(0.25)  # stands in for a synchronous driver call
+
+
+def test_detector_reports_blocking_line_and_cumulative_time():
+    detector = LoopBlockingDetector(threshold=0.1, interval=0.01)
+
+    async def scenario():
+        detector.start()
+        await asyncio.sleep(0.05)
+        blocking_lookup()
+        await asyncio.sleep(0.05)
+        await detector.stop()
+
+    asyncio.run(scenario())
+    stats = detector.stats()
+    assert stats['stalls'] == 1
+    assert stats['stall_seconds'] >= 0.2
+    sample = stats['recent'][0]
+    assert sample['culprit'].startswith('test_loop_monitor.py:')
+    assert sample['culprit'].endswith('in blocking_lookup')
+    assert 'time.sleep(0.25)' in sample['stack']
+
+
+def test_detector_ignores_short_callbacks():
+    detector = LoopBlockingDetector(threshold=0.1, interval=0.01)
+
+    async def scenario():
+        detector.start()
+        for _ in range(5):
+            time.sleep(0.01)
+            await asyncio.sleep(0.01)
+        await detector.stop()
+
+    asyncio.run(scenario())
+    assert detector.stats()['stalls'] == 0
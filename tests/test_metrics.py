@@ -0,0 +1,73 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import httpx
+from prometheus_client import REGISTRY
+
+import server
+from metrics import MetricsMiddleware, MongoCommandMetrics
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+def test_metrics_endpoint_reports_routes_upstream_and_tokens(mongo, fake_openai, create_user, monkeypatch):
+    monkeypatch.setattr(server, 'OPENAI_API_KEY', 'sk-test')
+    route_before = sample('http_request_duration_seconds_count', route='/api/chat', method='POST', status='200')
+    tokens_before = sample('openai_tokens_total', api_key_source='environment', direction='in')
+
+    async def scenario():
+        _, token = await create_user()
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+            await client.post('/api/chat', json={'message': 'hi'}, headers={'Authorization': f'Bearer {token}'})
+            await client.post('/api/chat/stream', json={'message': 'hi'}, headers={'Authorization': f'Bearer {token}'})
+            return await client.get('/metrics')
+
+    response = asyncio.run(scenario())
+    assert response.status_code == 200
+    assert 'openai_time_to_first_token_seconds_bucket' in response.text
+    assert sample('http_request_duration_seconds_count', route='/api/chat', method='POST', status='200') == route_before + 1
+    assert sample('openai_tokens_total', api_key_source='environment', direction='in') == tokens_before + 12
+    assert sample('openai_request_duration_seconds_count', api_key_source='environment', stream='true') >= 1
+
+
+def test_mongo_listener_labels_by_collection():
+    listener = MongoCommandMetrics()
+    before = sample('mongo_operation_duration_seconds_count', collection='chats', operation='insert', outcome='success')
+    listener.started(SimpleNamespace(command={'insert': 'chats'}, command_name='insert', connection_id=('h', 1), request_id=7))
+    listener.succeeded(SimpleNamespace(command_name='insert', connection_id=('h', 1), request_id=7, duration_micros=1500))
+    after = sample('mongo_operation_duration_seconds_count', collection='chats', operation='insert', outcome='success')
+    assert after == before + 1
+
+
+def test_middleware_overhead_is_a_few_microseconds(record_property):
+    async def app(scope, receive, send):
+        await send({'type': 'http.response.start', 'status': 200})
+
+    async def send(message):
+        pass
+
+    instrumented = MetricsMiddleware(app)
+    scope = {'type': 'http', 'method': 'GET', 'route': SimpleNamespace(path='/bench')}
+    iterations = 20000
+
+    async def timed(handler):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            await handler(scope, None, send)
+        return (time.perf_counter() - start) / iterations
+
+    async def scenario():
+        await timed(instrumented)  # warm the label cache
+        bare = [await timed(app) for _ in range(3)]
+        with_metrics = [await timed(instrumented) for _ in range(3)]
+        return min(bare), min(with_metrics)
+
+    bare, with_metrics = asyncio.run(scenario())
+    overhead_us = (with_metrics - bare) * 1e6
+    record_property('metrics_middleware_overhead_us', round(overhead_us, 2))
+    # Generous bound so slow CI machines do not flake; typically ~2us
+    assert overhead_us < 20
@@ -0,0 +1,75 @@
+import asyncio
+
+import httpx
+
+import server
+from openai_clients import OpenAIClientRegistry
+from tests.conftest import FakeAsyncOpenAI
+
+
+def test_same_key_reuses_client():
+    registry = OpenAIClientRegistry(client_factory=FakeAsyncOpenAI)
+
+    async def scenario():
+        async with registry.client('sk-a') as first:
+            pass
+        async with registry.client('sk-a') as second:
+            pass
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert first is second
+    assert len(registry) == 1
+
+
+def test_lru_eviction_defers_close_until_released():
+    registry = OpenAIClientRegistry(max_clients=2, client_factory=FakeAsyncOpenAI)
+
+    async def scenario():
+        async with registry.client('sk-a') as a:
+            async with registry.client('sk-b'):
+                pass
+            async with registry.client('sk-c'):
+                pass
+            # 'sk-a' was least recently used but is still borrowed
+            assert not a.closed
+        return a
+
+    a = asyncio.run(scenario())
+    assert a.closed
+    assert len(registry) == 2
+
+
+def test_idle_clients_closed_and_shutdown_closes_rest():
+    registry = OpenAIClientRegistry(idle_timeout=0, client_factory=FakeAsyncOpenAI)
+
+    async def scenario():
+        async with registry.client('sk-a') as a:
+            pass
+        closed = await registry.close_idle()
+        async with registry.client('sk-b') as b:
+            pass
+        registry.idle_timeout = 3600
+        await registry.aclose()
+        return closed, a, b
+
+    closed, a, b = asyncio.run(scenario())
+    assert closed == 1
+    assert a.closed and b.closed
+    assert len(registry) == 0
+
+
+def test_users_sharing_default_key_share_one_client(mongo, fake_openai, create_user):
+    async def scenario():
+        await mongo.admin.insert_one({'type': 'default', 'api_key': 'sk-shared'})
+        tokens = [(await create_user(email=f'u{i}@test.com'))[1] for i in range(3)]
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+            for token in tokens:
+                response = await client.post(
+                    '/api/chat', json={'message': 'hi'}, headers={'Authorization': f'Bearer {token}'}
+                )
+                assert response.json()['api_key_source'] == 'default_admin'
+
+    asyncio.run(scenario())
+    assert len(server.openai_clients) == 1
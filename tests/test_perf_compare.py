@@ -0,0 +1,58 @@
+import pytest
+
+from perf_compare import compare, failed, format_table
+
+
+def report(rps=100.0, p50=50.0, p95=120.0, error_rate=0.0, endpoint='POST /api/chat'):
+    return {'meta': {'concurrency': 16}, 'endpoints': {endpoint: {
+        'requests': 1000, 'errors': int(error_rate * 1000), 'error_rate': error_rate, 'throughput_rps': rps,
+        'latency_ms': {'mean': p50, 'p50': p50, 'p95': p95, 'p99': p95, 'max': p95},
+    }}}
+
+
+def statuses(rows):
+    return {(row['endpoint'], row['metric']): row['status'] for row in rows}
+
+
+def test_changes_within_threshold_pass():
+    rows = compare([report()], [report(rps=95, p50=54, p95=130)])
+    assert not failed(rows)
+    assert set(statuses(rows).values()) == {'ok'}
+
+
+def test_latency_and_throughput_regressions_fail():
+    rows = compare([report()], [report(rps=80, p95=150, error_rate=0.05)])
+    assert statuses(rows) == {
+        ('POST /api/chat', 'throughput_rps'): 'regressed',
+        ('POST /api/chat', 'p50_ms'): 'ok',
+        ('POST /api/chat', 'p95_ms'): 'regressed',
+        ('POST /api/chat', 'error_rate'): 'regressed',
+    }
+    assert 'REGRESSED' in format_table(rows)
+
+
+def test_run_to_run_noise_widens_tolerance():
+    # Baseline runs already vary by 30%, so a 20% slower median is noise
+    baseline = [report(p95=100), report(p95=120), report(p95=130)]
+    rows = compare(baseline, [report(p95=144)], metrics=['p95_ms'])
+    [row] = [row for row in rows if row['metric'] == 'p95_ms']
+    assert row['baseline'] == 120
+    assert row['tolerance'] == pytest.approx(0.25)
+    assert row['status'] == 'ok'
+
+    rows = compare(baseline, [report(p95=160)], metrics=['p95_ms'])
+    assert failed(rows)
+
+
+def test_small_absolute_latency_changes_are_ignored():
+    # Auth-only routes answer in about a millisecond; +50% is still under the floor
+    endpoint = 'GET /api/user/profile'
+    rows = compare([report(p50=1.0, p95=1.5, endpoint=endpoint)], [report(p50=1.5, p95=2.2, endpoint=endpoint)])
+    assert not failed(rows)
+    rows = compare([report(p50=1.0, p95=1.5, endpoint=endpoint)], [report(p50=1.5, p95=4.0, endpoint=endpoint)])
+    assert statuses(rows)[(endpoint, 'p95_ms')] == 'regressed'
+
+
+def test_endpoint_missing_from_candidate_fails():
+    rows = compare([report()], [report(endpoint='GET /api/chat/history')])
+    assert [row['status'] for row in failed(rows)] == ['missing']
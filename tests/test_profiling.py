@@ -0,0 +1,159 @@
+import asyncio
+import json
+import time
+
+import httpx
+import pytest
+
+import server
+from profiling import AWAITING, MongoProfileStore, Profiler, ProfilingMiddleware
+
+
+@pytest.fixture
+def profiler(monkeypatch):
+    profiler = Profiler(interval=0.001)
+    monkeypatch.setattr(server, 'profiler', profiler)
+    # The middleware captured the original profiler when the stack was built
+    for middleware in server.app.user_middleware:
+        if middleware.cls is ProfilingMiddleware:
+            monkeypatch.setitem(middleware.kwargs, 'profiler', profiler)
+    monkeypatch.setattr(server.app, 'middleware_stack', None)
+    return profiler
+
+
+def test_armed_request_is_profiled_and_downloadable(profiler, mongo, fake_openai, create_user, monkeypatch):
+    monkeypatch.setattr(server, 'OPENAI_API_KEY', 'sk-test')
+    fake_openai.delay = 0.1
+
+    async def scenario():
+        user, token = await create_user()
+        admin, admin_token = await create_user('admin@test.com', is_admin=True)
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+            armed = await client.post('/api/admin/profiles', json={'count': 1, 'path_prefix': '/api/chat'},
+                                      headers={'Authorization': f'Bearer {admin_token}'})
+            skipped = await client.get('/api/user/profile', headers={'Authorization': f'Bearer {token}'})
+            profiled = await client.post('/api/chat', json={'message': 'hi'},
+                                         headers={'Authorization': f'Bearer {token}'})
+            unprofiled = await client.post('/api/chat', json={'message': 'again'},
+                                           headers={'Authorization': f'Bearer {token}'})
+            admin_headers = {'Authorization': f'Bearer {admin_token}'}
+            profile_id = profiled.headers['x-profile-id']
+            listing = await client.get('/api/admin/profiles', headers=admin_headers)
+            speedscope = await client.get(f'/api/admin/profiles/{profile_id}', headers=admin_headers)
+            collapsed = await client.get(f'/api/admin/profiles/{profile_id}?format=collapsed', headers=admin_headers)
+            forbidden = await client.get(f'/api/admin/profiles/{profile_id}', headers={'Authorization': f'Bearer {token}'})
+        return armed, skipped, profiled, unprofiled, listing, speedscope, collapsed, forbidden
+
+    armed, skipped, profiled, unprofiled, listing, speedscope, collapsed, forbidden = asyncio.run(scenario())
+    assert armed.json()['armed'] == 1
+    assert 'x-profile-id' not in skipped.headers
+    assert profiled.status_code == 200
+    assert 'x-profile-id' not in unprofiled.headers
+
+    [summary] = listing.json()['profiles']
+    assert summary['path'] == '/api/chat' and summary['reason'] == 'armed' and summary['status'] == 200
+    assert summary['wall_samples'] >= 20
+    assert summary['cpu_samples'] <= summary['wall_samples']
+
+    # The wait on the upstream call is attributed to the route that awaited it
+    stacks = [line.rsplit(' ', 1)[0].split(';') for line in collapsed.text.splitlines()]
+    awaiting_upstream = [stack for stack in stacks if stack[-1] == AWAITING
+                         and any(frame.startswith('FakeCompletions.create') for frame in stack)]
+    assert awaiting_upstream
+    assert any(frame.startswith('send_message ') for frame in awaiting_upstream[0])
+    assert 'attachment' in collapsed.headers['content-disposition']
+
+    document = speedscope.json()
+    assert [profile['type'] for profile in document['profiles']] == ['sampled', 'sampled']
+    frames = document['shared']['frames']
+    wall = document['profiles'][0]
+    assert all(0 <= index < len(frames) for sample in wall['samples'] for index in sample)
+    assert wall['endValue'] == pytest.approx(summary['wall_samples'])
+    assert forbidden.status_code == 403
+
+
+def test_header_token_triggers_profile_and_busy_loop_counts_as_cpu():
+    profiler = Profiler(token='secret', interval=0.001)
+
+    async def busy_app(scope, receive, send):
+        deadline = time.perf_counter() + 0.1
+        while time.perf_counter() < deadline:
+            json.dumps(list(range(100)))
+        await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+        await send({'type': 'http.response.body', 'body': b'ok'})
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=ProfilingMiddleware(busy_app, profiler))
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+            wrong = await client.get('/busy', headers={'X-Profile': 'guess'})
+            right = await client.get('/busy', headers={'X-Profile': 'secret'})
+        return wrong, right
+
+    wrong, right = asyncio.run(scenario())
+    assert 'x-profile-id' not in wrong.headers
+    profile = profiler.get(right.headers['x-profile-id'])
+    assert profile.reason == 'header'
+    # Samples land at most once per GIL switch interval (5ms by default)
+    assert sum(profile.cpu.values()) >= 5
+    assert all(any(frame.startswith('test_header_token_triggers_profile_and_busy_loop_counts_as_cpu.<locals>.busy_app ')
+                   for frame in stack) for stack in profile.cpu)
+    # The task factory is removed again once nothing is being profiled
+    assert profiler._factories == {}
+
+
+def test_arming_and_profiles_are_shared_between_workers(mongo):
+    # Two Profilers over one database stand in for two worker processes
+    armed_on, served_by = (Profiler(interval=0.001, store=MongoProfileStore(mongo.admin, mongo.profiles),
+                                    sync_interval=0.01) for _ in range(2))
+
+    async def app(scope, receive, send):
+        await asyncio.sleep(0.02)
+        await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+        await send({'type': 'http.response.body', 'body': b'ok'})
+
+    async def scenario():
+        await armed_on.arm(1, '/api/chat')
+        served_by.start()
+        await asyncio.sleep(0.05)
+        transport = httpx.ASGITransport(app=ProfilingMiddleware(app, served_by))
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+            responses = await asyncio.gather(*(client.post('/api/chat') for _ in range(3)))
+        await served_by.stop()
+        profile_ids = [response.headers['x-profile-id'] for response in responses if 'x-profile-id' in response.headers]
+        return profile_ids, await armed_on.recent(), await armed_on.load(profile_ids[0])
+
+    profile_ids, recent, profile = asyncio.run(scenario())
+    assert len(profile_ids) == 1
+    assert [summary['id'] for summary in recent] == profile_ids
+    assert profile.path == '/api/chat' and profile.status == 200
+    assert sum(profile.wall.values()) == recent[0]['wall_samples'] > 0
+    assert profile.speedscope()['profiles'][0]['samples']
+
+
+def test_disabled_profiler_adds_no_measurable_overhead(record_property):
+    """Benchmark: pass-through cost of the middleware when profiling is off"""
+    profiler = Profiler()
+
+    async def app(scope, receive, send):
+        pass
+
+    scope = {'type': 'http', 'method': 'GET', 'path': '/api/chat/history', 'headers': []}
+    wrapped = ProfilingMiddleware(app, profiler)
+
+    async def per_call(target):
+        iterations = 50000
+        start = time.perf_counter()
+        for _ in range(iterations):
+            await target(scope, None, None)
+        return (time.perf_counter() - start) / iterations
+
+    async def scenario():
+        bare = min([await per_call(app) for _ in range(3)])
+        with_middleware = min([await per_call(wrapped) for _ in range(3)])
+        return bare, with_middleware
+
+    bare, with_middleware = asyncio.run(scenario())
+    record_property('disabled_profiling_overhead_ns', round((with_middleware - bare) * 1e9))
+    assert with_middleware - bare < 2e-6
+    assert not profiler.profiles
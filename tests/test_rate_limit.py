@@ -0,0 +1,153 @@
+import asyncio
+import os
+import time
+import uuid
+
+import httpx
+import pytest
+from pymongo.errors import DuplicateKeyError
+
+import server
+from database import Database, create_client
+from rate_limit import MongoBucketBackend, RateLimited, RateLimiter
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_requests_per_minute_refill_continuously():
+    clock = FakeClock()
+    limiter = RateLimiter({'user': (3, 0)}, clock=clock)
+
+    async def scenario():
+        for _ in range(3):
+            await limiter.check('u1', 'environment')
+        with pytest.raises(RateLimited) as denied:
+            await limiter.check('u1', 'environment')
+        # Other users have their own buckets
+        await limiter.check('u2', 'environment')
+        clock.now += 20
+        await limiter.check('u1', 'environment')
+        return denied.value
+
+    denied = asyncio.run(scenario())
+    assert denied.scope == 'user requests per minute'
+    assert denied.retry_after == pytest.approx(20)
+
+
+def test_denied_request_takes_nothing_and_completion_tokens_are_charged():
+    clock = FakeClock()
+    limiter = RateLimiter({'user': (0, 100), 'global': (2, 0)}, clock=clock)
+
+    async def scenario():
+        await limiter.check('u1', 'environment', prompt_tokens=80)
+        await limiter.charge('u1', 'environment', 50)
+        # 30 tokens in debt: 40 more need 70 tokens of refill (42s at 100/min)
+        with pytest.raises(RateLimited) as tokens_denied:
+            await limiter.check('u1', 'environment', prompt_tokens=40)
+        await limiter.check('u2', 'environment', prompt_tokens=10)
+        with pytest.raises(RateLimited) as global_denied:
+            await limiter.check('u3', 'environment', prompt_tokens=10)
+        return tokens_denied.value, global_denied.value
+
+    tokens_denied, global_denied = asyncio.run(scenario())
+    assert tokens_denied.scope == 'user tokens per minute'
+    assert tokens_denied.retry_after == pytest.approx(42)
+    # The denied u1 request did not use up a global request slot
+    assert global_denied.scope == 'global requests per minute'
+    assert limiter.stats()['limited'] == 2
+
+
+def test_chat_returns_429_with_retry_after(mongo, fake_openai, create_user, monkeypatch):
+    monkeypatch.setattr(server, 'OPENAI_API_KEY', 'sk-test')
+    monkeypatch.setattr(server, 'rate_limiter', RateLimiter({'user': (2, 0)}))
+
+    async def scenario():
+        user, token = await create_user()
+        headers = {'Authorization': f'Bearer {token}'}
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+            allowed = [await client.post('/api/chat', json={'message': f'hi {i}'}, headers=headers) for i in range(2)]
+            limited = await client.post('/api/chat', json={'message': 'again'}, headers=headers)
+            limited_stream = await client.post('/api/chat/stream', json={'message': 'again'}, headers=headers)
+        return allowed, limited, limited_stream
+
+    allowed, limited, limited_stream = asyncio.run(scenario())
+    assert [response.status_code for response in allowed] == [200, 200]
+    for response in (limited, limited_stream):
+        assert response.status_code == 429
+        assert int(response.headers['Retry-After']) == 30
+    assert len(fake_openai.calls) == 2
+
+
+def test_enforcement_cost_is_constant_per_request(record_property):
+    """Benchmark: checks cost the same with 100 or 100k tracked users"""
+    limits = {'user': (10 ** 6, 10 ** 9), 'source': (10 ** 6, 10 ** 9), 'global': (10 ** 9, 10 ** 12)}
+
+    async def per_check(users):
+        limiter = RateLimiter(limits)
+        for i in range(users):
+            await limiter.check(f'user-{i}', 'environment', 10)
+        iterations = 20000
+        start = time.perf_counter()
+        for i in range(iterations):
+            await limiter.check(f'user-{i % users}', 'environment', 10)
+        return (time.perf_counter() - start) / iterations
+
+    async def scenario():
+        small = min([await per_check(100) for _ in range(3)])
+        large = min([await per_check(100000) for _ in range(3)])
+        return small, large
+
+    small, large = asyncio.run(scenario())
+    record_property('rate_limit_check_100_users_us', round(small * 1e6, 2))
+    record_property('rate_limit_check_100k_users_us', round(large * 1e6, 2))
+    # Generous bounds so slow CI machines do not flake; typically ~3us
+    assert large < small * 3
+    assert large < 50e-6
+
+
+def test_mongo_backend_retries_a_racing_first_upsert():
+    class RacingCollection:
+        """Loses the race to insert each bucket once, as when two first requests arrive together"""
+
+        def __init__(self):
+            self.raced = set()
+            self.calls = 0
+
+        async def find_one_and_update(self, query, update, **kwargs):
+            self.calls += 1
+            if query['_id'] not in self.raced:
+                self.raced.add(query['_id'])
+                raise DuplicateKeyError('E11000 duplicate key error')
+            return {'tokens': 2, 'allowed': True}
+
+    collection = RacingCollection()
+    limiter = RateLimiter({'user': (3, 0)}, MongoBucketBackend(collection), FakeClock())
+    asyncio.run(limiter.check('u1', 'environment'))
+    assert collection.calls == 2 and limiter.allowed == 1
+
+
+@pytest.mark.skipif(not os.environ.get('TEST_MONGO_URL'), reason="pipeline updates need a real MongoDB (set TEST_MONGO_URL)")
+def test_mongo_backend_shares_buckets():
+    async def scenario():
+        database = Database(create_client(os.environ['TEST_MONGO_URL']), 'test_rate_' + uuid.uuid4().hex[:8])
+        clock = FakeClock()
+        try:
+            # Two limiters stand in for two instances sharing one backend
+            instances = [RateLimiter({'user': (3, 0)}, MongoBucketBackend(database.rate_limits), clock) for _ in range(2)]
+            for limiter in instances + instances[:1]:
+                await limiter.check('u1', 'environment')
+            with pytest.raises(RateLimited) as denied:
+                await instances[1].check('u1', 'environment')
+            return denied.value
+        finally:
+            await database.client.drop_database(database.db.name)
+            database.close()
+
+    assert asyncio.run(scenario()).retry_after == pytest.approx(20)
@@ -0,0 +1,187 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+from openai import AsyncOpenAI
+
+import server
+from fake_upstream import FakeUpstreamConfig, FakeUpstreamServer
+from openai_clients import OpenAIClientRegistry
+from resilience import CircuitBreaker, CircuitOpen, LatencyTracker, UpstreamError, UpstreamPolicy
+from upstream_scheduler import FairScheduler
+
+
+@pytest.fixture
+def upstream():
+    """A fake OpenAI API on a local port"""
+    with FakeUpstreamServer(FakeUpstreamConfig()) as fake:
+        yield fake
+
+
+def run_calls(upstream, policy, count=1, **request):
+    """Make count sequential chat calls through policy with a real SDK client"""
+
+    async def scenario():
+        client = AsyncOpenAI(api_key='sk-test', base_url=upstream.base_url, max_retries=0)
+        results = []
+        try:
+            for _ in range(count):
+                results.append(await policy.call(
+                    lambda: client.chat.completions.create(model='gpt-4', messages=[{'role': 'user', 'content': 'hi'}],
+                                                           **request)
+                ))
+        finally:
+            await client.close()
+        return results
+
+    return asyncio.run(scenario())
+
+
+def test_retries_transient_errors_after_retry_after(upstream):
+    upstream.config.script.extend([{'status': 503, 'retry_after': 0.3}, {'status': 502}, {}])
+    policy = UpstreamPolicy(backoff_base=0.01, backoff_max=0.02)
+
+    start = time.perf_counter()
+    [completion] = run_calls(upstream, policy)
+    elapsed = time.perf_counter() - start
+
+    assert completion.choices[0].message.content.startswith('token0')
+    assert upstream.stats['requests'] == 3
+    assert policy.retries == 2
+    assert elapsed >= 0.3
+
+
+def test_client_errors_are_not_retried(upstream):
+    upstream.config.script.append({'status': 400})
+    policy = UpstreamPolicy(backoff_base=0.01)
+
+    with pytest.raises(UpstreamError) as failure:
+        run_calls(upstream, policy)
+    assert failure.value.status_code == 400
+    assert upstream.stats['requests'] == 1
+
+
+def test_attempt_timeout_retries_and_total_deadline_gives_up(upstream):
+    upstream.config.script.extend([{'latency': 1}, {}])
+    policy = UpstreamPolicy(attempt_timeout=0.2, backoff_base=0.01)
+    start = time.perf_counter()
+    run_calls(upstream, policy)
+    assert time.perf_counter() - start < 1.0
+    assert policy.retries == 1
+
+    upstream.config.latency = 1
+    policy = UpstreamPolicy(attempt_timeout=0.2, total_timeout=0.5, max_attempts=10, backoff_base=0.01)
+    start = time.perf_counter()
+    with pytest.raises(UpstreamError) as failure:
+        run_calls(upstream, policy)
+    assert failure.value.status_code == 504
+    assert time.perf_counter() - start < 1.0
+
+
+def test_slow_attempt_is_hedged_after_p95_delay(upstream):
+    upstream.config.latency = 0.02
+    policy = UpstreamPolicy(hedge=True, latency=LatencyTracker(min_samples=10))
+    run_calls(upstream, policy, count=10)
+    assert policy.hedges == 0
+
+    # The next request stalls; a hedge fired after ~p95 answers first
+    upstream.config.script.append({'latency': 1})
+    start = time.perf_counter()
+    run_calls(upstream, policy)
+    assert time.perf_counter() - start < 1.0
+    assert policy.hedges == 1 and policy.hedge_wins == 1
+
+
+def test_stream_opens_leave_the_hedge_delay_unchanged():
+    policy = UpstreamPolicy(hedge=True, latency=LatencyTracker(min_samples=10, recompute_every=1))
+    for _ in range(10):
+        policy.latency.observe(0.5)
+
+    async def open_stream():
+        return 'stream'
+
+    async def scenario():
+        for _ in range(50):
+            await policy.call(open_stream, hedge=False)
+
+    asyncio.run(scenario())
+    assert len(policy.latency.samples) == 10
+    assert policy.latency.quantile(0.95) == 0.5
+
+
+def test_hedges_only_use_a_spare_scheduler_slot():
+    def policy_with_history():
+        policy = UpstreamPolicy(hedge=True, latency=LatencyTracker(min_samples=10))
+        for _ in range(10):
+            policy.latency.observe(0.01)
+        return policy
+
+    async def call(scheduler, policy):
+        calls = []
+
+        async def attempt():
+            calls.append(scheduler.stats()[scheduler.key_for('sk-test')[:12]]['in_flight'])
+            await asyncio.sleep(0.2 if len(calls) == 1 else 0)
+            return len(calls)
+
+        async with scheduler.slot('sk-test', 'user'):
+            result = await policy.call(attempt, hedge_slot=lambda: scheduler.try_slot('sk-test'))
+            in_flight = scheduler.stats()[scheduler.key_for('sk-test')[:12]]['in_flight']
+        return result, calls, in_flight
+
+    full = policy_with_history()
+    result, calls, in_flight = asyncio.run(call(FairScheduler(max_concurrency=1), full))
+    assert (result, calls, in_flight) == (1, [1], 1)
+    assert full.hedges == 0 and full.hedges_skipped == 1
+
+    spare = policy_with_history()
+    result, calls, in_flight = asyncio.run(call(FairScheduler(max_concurrency=2), spare))
+    # The hedge ran while holding the key's second slot, then gave it back
+    assert (result, calls, in_flight) == (2, [1, 2], 1)
+    assert spare.hedges == 1 and spare.hedge_wins == 1
+
+
+def test_circuit_opens_fails_fast_and_recovers_after_probe(upstream):
+    now = [0.0]
+    breaker = CircuitBreaker(window=4, failure_ratio=0.5, min_calls=2, cooldown=10, clock=lambda: now[0])
+    policy = UpstreamPolicy(max_attempts=1, breaker=breaker)
+    upstream.config.script.extend([{'status': 500}, {'status': 500}])
+
+    for _ in range(2):
+        with pytest.raises(UpstreamError):
+            run_calls(upstream, policy)
+    assert breaker.state == 'open'
+    with pytest.raises(CircuitOpen) as fast_fail:
+        run_calls(upstream, policy)
+    assert upstream.stats['requests'] == 2
+    assert fast_fail.value.retry_after == pytest.approx(10)
+
+    now[0] += 10
+    run_calls(upstream, policy)
+    assert breaker.state == 'closed'
+
+
+def test_chat_relays_upstream_rate_limit(upstream, mongo, create_user, monkeypatch):
+    monkeypatch.setattr(server, 'OPENAI_API_KEY', 'sk-test')
+    monkeypatch.setattr(server, 'upstream_policy', UpstreamPolicy(max_attempts=2, backoff_base=0.01))
+    monkeypatch.setattr(server, 'openai_clients', OpenAIClientRegistry(
+        client_factory=lambda api_key: AsyncOpenAI(api_key=api_key, base_url=upstream.base_url, max_retries=0)
+    ))
+    upstream.config.error_rate = 1.0
+    upstream.config.error_status = 429
+    upstream.config.retry_after = 0.2
+
+    async def scenario():
+        user, token = await create_user()
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+            response = await client.post('/api/chat', json={'message': 'hi'},
+                                         headers={'Authorization': f'Bearer {token}'})
+        await server.openai_clients.aclose()
+        return response
+
+    response = asyncio.run(scenario())
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '1'
+    assert upstream.stats['requests'] == 2
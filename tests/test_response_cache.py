@@ -0,0 +1,56 @@
+import asyncio
+
+import httpx
+
+import server
+from response_cache import MongoCacheBackend, ResponseCache, cache_key, normalize_message
+
+
+def test_normalization_and_scoping():
+    assert normalize_message('  What   is\tPython?\n') == 'What is Python?'
+    key = cache_key('gpt-4', 'sys', 'What is Python?', 'default_admin')
+    assert key == cache_key('gpt-4', 'sys', ' What is  Python? ', 'default_admin')
+    assert key != cache_key('gpt-4', 'sys', 'What is Python?', 'user_specific:u1')
+    assert key != cache_key('gpt-4o', 'sys', 'What is Python?', 'default_admin')
+
+
+def test_backend_tier_fills_local_tier(mongo):
+    async def scenario():
+        writer = ResponseCache(backend=MongoCacheBackend(mongo.response_cache))
+        await writer.set('k', 'cached answer')
+        reader = ResponseCache(backend=MongoCacheBackend(mongo.response_cache))
+        first = await reader.get('k')
+        second = await reader.get('k')
+        missing = await reader.get('other')
+        return reader, first, second, missing
+
+    reader, first, second, missing = asyncio.run(scenario())
+    assert first == second == 'cached answer'
+    assert missing is None
+    stats = reader.stats()
+    assert (stats['backend_hits'], stats['local_hits'], stats['misses']) == (1, 1, 1)
+
+
+def test_repeated_prompt_served_from_cache(mongo, fake_openai, create_user, monkeypatch):
+    monkeypatch.setattr(server, 'OPENAI_API_KEY', 'sk-test')
+    monkeypatch.setattr(server, 'response_cache', ResponseCache(backend=MongoCacheBackend(mongo.response_cache)))
+
+    async def scenario():
+        _, token = await create_user()
+        _, other_token = await create_user(email='other@test.com', api_key='sk-personal')
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+            post = lambda t, m: client.post('/api/chat', json={'message': m}, headers={'Authorization': f'Bearer {t}'})
+            first = (await post(token, 'Summarize the report')).json()
+            second = (await post(token, 'Summarize  the report ')).json()
+            personal = (await post(other_token, 'Summarize the report')).json()
+        return first, second, personal
+
+    first, second, personal = asyncio.run(scenario())
+    assert first['cached'] is False
+    assert second['cached'] is True
+    assert second['response'] == first['response']
+    # Personal keys are scoped separately and miss the shared entry
+    assert personal['cached'] is False
+    assert len(fake_openai.calls) == 2
+    assert server.response_cache.stats()['local_hits'] == 1
@@ -0,0 +1,28 @@
+import run
+
+
+def test_options_from_environment():
+    options = run.uvicorn_options({
+        'PORT': '8080',
+        'WEB_CONCURRENCY': '4',
+        'UVICORN_KEEP_ALIVE': '30',
+        'UVICORN_BACKLOG': '512',
+        'UVICORN_LIMIT_CONCURRENCY': '200',
+        'UVICORN_ACCESS_LOG': 'true',
+    })
+    assert options['port'] == 8080
+    assert options['workers'] == 4
+    assert options['timeout_keep_alive'] == 30
+    assert options['backlog'] == 512
+    assert options['limit_concurrency'] == 200
+    assert options['access_log'] is True
+    assert options['loop'] == 'auto' and options['http'] == 'auto'
+
+
+def test_workers_default_to_available_cpus(monkeypatch):
+    monkeypatch.setattr(run, 'available_cpus', lambda: 3)
+    assert run.uvicorn_options({})['workers'] == 3
+    assert run.uvicorn_options({})['limit_concurrency'] is None
+    # Requests are logged by RequestLogMiddleware; uvicorn must not install its own handlers
+    assert run.uvicorn_options({})['access_log'] is False
+    assert run.uvicorn_options({})['log_config'] is None
@@ -0,0 +1,93 @@
+import asyncio
+import json
+
+import httpx
+import numpy as np
+import pytest
+
+import server
+from semantic_cache import HashingEmbedder, NumpyIndex, SemanticCache
+from semantic_eval import load_chats, replay
+
+
+def cosine(embedder, a, b):
+    return float(embedder.embed_one(a) @ embedder.embed_one(b))
+
+
+def test_hashing_embedder_is_deterministic_and_ranks_paraphrases():
+    embedder = HashingEmbedder()
+    assert np.array_equal(embedder.embed_one('hello world'), HashingEmbedder().embed_one('hello world'))
+    paraphrase = cosine(embedder, 'How do I reset my password?', 'how do i reset my password')
+    unrelated = cosine(embedder, 'How do I reset my password?', 'Write a poem about the sea')
+    assert paraphrase > 0.95
+    assert unrelated < 0.3
+
+
+def test_numpy_index_overwrites_oldest_when_full():
+    index = NumpyIndex(dim=2, capacity=2)
+    index.add(np.array([1.0, 0.0]), 'a')
+    index.add(np.array([0.0, 1.0]), 'b')
+    index.add(np.array([0.6, 0.8]), 'c')
+    assert len(index) == 2
+    similarity, payload = index.search(np.array([1.0, 0.0]))
+    assert payload == 'c'
+    assert similarity == pytest.approx(0.6)
+
+
+def test_lookup_respects_threshold_and_scope():
+    cache = SemanticCache(HashingEmbedder(), threshold=0.9)
+
+    async def scenario():
+        _, _, vector = await cache.lookup('What is the capital of France?', 'default_admin')
+        cache.add(vector, 'default_admin', 'Paris')
+        near = await cache.lookup('what is the capital of france', 'default_admin')
+        far = await cache.lookup('Explain quantum computing', 'default_admin')
+        other_scope = await cache.lookup('What is the capital of France?', 'user_specific:u1')
+        return near, far, other_scope
+
+    near, far, other_scope = asyncio.run(scenario())
+    assert near[0] == 'Paris'
+    assert far[0] is None
+    assert other_scope[0] is None
+    assert cache.stats()['hits'] == 1
+
+
+def test_chat_served_from_semantic_cache(mongo, fake_openai, create_user, monkeypatch):
+    monkeypatch.setattr(server, 'OPENAI_API_KEY', 'sk-test')
+    monkeypatch.setattr(server, 'semantic_cache', SemanticCache(HashingEmbedder(), threshold=0.9))
+
+    async def scenario():
+        _, token = await create_user()
+        headers = {'Authorization': f'Bearer {token}'}
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+            first = (await client.post('/api/chat', json={'message': 'How do I reset my password?'}, headers=headers)).json()
+            second = (await client.post('/api/chat', json={'message': 'how do I reset my password'}, headers=headers)).json()
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert first['cached'] is False
+    assert second['cache_type'] == 'semantic'
+    assert len(fake_openai.calls) == 1
+
+
+def test_eval_harness_sweeps_thresholds(tmp_path):
+    chats = [
+        {'user_id': 'u1', 'api_key_source': 'default_admin', 'timestamp': {'$date': f'2026-01-01T00:00:0{i}Z'},
+         'user_message': message, 'assistant_response': 'answer'}
+        for i, message in enumerate([
+            'How do I reset my password?',
+            'how do i reset my password',
+            'How do I reset my password?',
+            'Write a poem about the sea',
+        ])
+    ]
+    path = tmp_path / 'chats.jsonl'
+    path.write_text('\n'.join(json.dumps(chat) for chat in chats))
+
+    report = asyncio.run(replay(load_chats(str(path)), thresholds=[0.5, 0.99]))
+    assert report['chats'] == 4
+    assert report['exact_repeats'] == 1
+    hits = {row['threshold']: row['hits'] for row in report['sweep']}
+    assert hits[0.5] == 2
+    assert hits[0.99] >= 1
@@ -0,0 +1,100 @@
+import asyncio
+
+import httpx
+
+import server
+from conversations import append_turn
+from summaries import BackgroundJobs, summarize_conversation
+
+
+def test_long_conversation_is_summarized_in_background(mongo, fake_openai, create_user, monkeypatch):
+    monkeypatch.setattr(server, 'OPENAI_API_KEY', 'sk-test')
+    monkeypatch.setattr(server, 'SUMMARY_TRIGGER_TOKENS', 100)
+    monkeypatch.setattr(server, 'SUMMARY_KEEP_TURNS', 1)
+    monkeypatch.setattr(server, 'summary_jobs', BackgroundJobs())
+    fake_openai.reply = 'word ' * 40
+
+    async def scenario():
+        user, token = await create_user()
+        headers = {'Authorization': f'Bearer {token}'}
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+            first = (await client.post('/api/chat', json={'message': 'remember 42'}, headers=headers)).json()
+            conversation_id = first['conversation_id']
+            for text in ('second', 'third'):
+                await asyncio.sleep(0.01)
+                await client.post('/api/chat', json={'message': text, 'conversation_id': conversation_id},
+                                  headers=headers)
+            await server.summary_jobs.drain()
+            conversation = await mongo.conversations.find_one({'conversation_id': conversation_id})
+            fake_openai.reply = 'final answer'
+            await asyncio.sleep(0.01)
+            await client.post('/api/chat', json={'message': 'fourth', 'conversation_id': conversation_id},
+                              headers=headers)
+        return conversation
+
+    conversation = asyncio.run(scenario())
+    summary = conversation['summary']
+    assert summary['text'].startswith('word')
+    assert summary['messages'] % 2 == 0 and summary['messages'] >= 2
+    assert server.summary_jobs.completed >= 1 and server.summary_jobs.failed == 0
+
+    # The summarization request carried the oldest turn
+    summary_calls = [call for call in fake_openai.calls if 'running summary' in call['messages'][0]['content']]
+    assert 'remember 42' in summary_calls[0]['messages'][1]['content']
+
+    # The next chat sends the summary and only turns after its checkpoint
+    sent = fake_openai.calls[-1]['messages']
+    assert sent[1]['role'] == 'system' and 'Summary of the earlier conversation' in sent[1]['content']
+    assert 'remember 42' not in [m['content'] for m in sent]
+    assert sent[-1] == {'role': 'user', 'content': 'fourth'}
+
+
+def test_checkpoint_is_compare_and_set(mongo):
+    async def scenario():
+        for i in range(4):
+            await append_turn(mongo.messages, mongo.conversations, 'c1', 'u1', f'q{i}', f'a{i}', (10, 10))
+            await asyncio.sleep(0.01)
+
+        async def complete(messages):
+            await asyncio.sleep(0.01)
+            return 'summary'
+
+        # Two jobs race from the same checkpoint; only one may apply
+        results = await asyncio.gather(*(
+            summarize_conversation(mongo.messages, mongo.conversations, 'c1', 'u1', complete, len, keep_turns=1)
+            for _ in range(2)
+        ))
+        again = await summarize_conversation(mongo.messages, mongo.conversations, 'c1', 'u1', complete, len,
+                                             keep_turns=1)
+        return results, again, await mongo.conversations.find_one({'conversation_id': 'c1'})
+
+    results, again, conversation = asyncio.run(scenario())
+    assert sum(result is not None for result in results) == 1
+    assert again is None
+    assert conversation['summary']['messages'] == 6
+    assert conversation['unsummarized_tokens'] == 80 - 60
+
+
+def test_chained_jobs_run_in_order_per_key():
+    jobs = BackgroundJobs()
+    ran = []
+
+    async def job(name, delay, fail=False):
+        await asyncio.sleep(delay)
+        ran.append(name)
+        if fail:
+            raise RuntimeError(name)
+
+    async def scenario():
+        jobs.chain('c1', job, 'first', 0.02, fail=True)
+        jobs.chain('c1', job, 'second', 0.0)
+        jobs.chain('c2', job, 'other', 0.0)
+        await jobs.wait('c1')
+        waited = list(ran)
+        await jobs.drain()
+        return waited
+
+    waited = asyncio.run(scenario())
+    assert waited == ['other', 'first', 'second']
+    assert len(jobs) == 0 and jobs.failed == 1 and jobs.completed == 2
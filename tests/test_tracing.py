@@ -0,0 +1,186 @@
+import asyncio
+import json
+import logging
+
+import httpx
+import pytest
+
+import server
+from tracing import (BatchSpanProcessor, FileSpanExporter, OTLPHttpExporter, TraceContextFilter, Tracer,
+                     TracingMiddleware, parse_traceparent)
+
+TRACE_ID = '4bf92f3577b34da6a3ce929d0e0e4736'
+PARENT_ID = '00f067aa0ba902b7'
+
+
+@pytest.fixture
+def trace_file(tmp_path, monkeypatch):
+    """Route server spans to a JSON-lines file; returns a reader that flushes first"""
+    path = tmp_path / 'traces.jsonl'
+    tracer = Tracer(BatchSpanProcessor(FileSpanExporter(str(path))))
+    monkeypatch.setattr(server, 'tracer', tracer)
+    for middleware in server.app.user_middleware:
+        if middleware.cls is TracingMiddleware:
+            monkeypatch.setitem(middleware.kwargs, 'tracer', tracer)
+    monkeypatch.setattr(server.app, 'middleware_stack', None)
+
+    def read():
+        tracer.force_flush()
+        return [json.loads(line) for line in path.read_text().splitlines()] if path.exists() else []
+
+    yield read
+    tracer.shutdown()
+
+
+def test_parse_traceparent():
+    assert parse_traceparent(f'00-{TRACE_ID}-{PARENT_ID}-01') == (TRACE_ID, PARENT_ID, True)
+    assert parse_traceparent(f'00-{TRACE_ID}-{PARENT_ID}-00')[2] is False
+    assert parse_traceparent(f'00-{"0" * 32}-{PARENT_ID}-01') is None
+    assert parse_traceparent('garbage') is None
+    assert parse_traceparent(None) is None
+
+
+def test_chat_spans_continue_the_browser_trace(trace_file, mongo, fake_openai, create_user, monkeypatch):
+    monkeypatch.setattr(server, 'OPENAI_API_KEY', 'sk-test')
+
+    async def scenario():
+        user, token = await create_user()
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+            return await client.post('/api/chat', json={'message': 'hi'}, headers={
+                'Authorization': f'Bearer {token}', 'traceparent': f'00-{TRACE_ID}-{PARENT_ID}-01'
+            })
+
+    response = asyncio.run(scenario())
+    assert response.status_code == 200
+    assert response.headers['x-trace-id'] == TRACE_ID
+
+    spans = {span['name']: span for span in trace_file()}
+    root = spans['POST /api/chat']
+    assert root['kind'] == 'server' and root['parent_span_id'] == PARENT_ID
+    assert root['attributes']['http.route'] == '/api/chat'
+    assert root['attributes']['http.response.status_code'] == 200
+    for name in ('auth.verify_token', 'auth.user_lookup', 'api_key.resolve', 'openai.chat.completions',
+                 'chat_history.insert'):
+        assert spans[name]['trace_id'] == TRACE_ID
+        assert spans[name]['parent_span_id'] == root['span_id']
+    upstream = spans['openai.chat.completions']
+    assert upstream['kind'] == 'client'
+    assert upstream['attributes']['gen_ai.usage.input_tokens'] == 12
+    assert upstream['attributes']['gen_ai.usage.output_tokens'] == 5
+    assert spans['api_key.resolve']['attributes']['api_key.source'] == 'environment'
+    assert spans['auth.user_lookup']['attributes']['cache.hit'] is False
+
+
+def test_stream_upstream_span_records_usage(trace_file, mongo, create_user, monkeypatch):
+    from fake_upstream import FakeUpstreamConfig, FakeUpstreamServer
+    from openai import AsyncOpenAI
+    from openai_clients import OpenAIClientRegistry
+
+    monkeypatch.setattr(server, 'OPENAI_API_KEY', 'sk-test')
+
+    async def scenario():
+        user, token = await create_user()
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+            response = await client.post('/api/chat/stream', json={'message': 'hi there'},
+                                         headers={'Authorization': f'Bearer {token}'})
+        await server.openai_clients.aclose()
+        return response
+
+    with FakeUpstreamServer(FakeUpstreamConfig(reply_tokens=3)) as upstream:
+        monkeypatch.setattr(server, 'openai_clients', OpenAIClientRegistry(
+            client_factory=lambda api_key: AsyncOpenAI(api_key=api_key, base_url=upstream.base_url, max_retries=0)
+        ))
+        response = asyncio.run(scenario())
+
+    assert 'event: done' in response.text
+    spans = {span['name']: span for span in trace_file()}
+    upstream_span = spans['openai.chat.completions']
+    assert upstream_span['attributes']['gen_ai.request.stream'] is True
+    assert upstream_span['attributes']['gen_ai.usage.output_tokens'] == 3
+    assert upstream_span['trace_id'] == response.headers['x-trace-id']
+    assert spans['chat_history.insert']['trace_id'] == response.headers['x-trace-id']
+
+
+def test_unsampled_requests_keep_their_trace_id_but_export_nothing(trace_file, mongo, create_user):
+    async def scenario():
+        user, token = await create_user()
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+            return await client.get('/api/user/profile', headers={
+                'Authorization': f'Bearer {token}', 'traceparent': f'00-{TRACE_ID}-{PARENT_ID}-00'
+            })
+
+    response = asyncio.run(scenario())
+    assert response.headers['x-trace-id'] == TRACE_ID
+    assert trace_file() == []
+
+
+def test_browser_traceparent_does_not_override_the_sampling_rate():
+    tracer = Tracer(BatchSpanProcessor(FileSpanExporter('/dev/null')), sample_rate=0)
+
+    async def start():
+        return tracer.start_span('GET /api/chat/history', traceparent=f'00-{TRACE_ID}-{PARENT_ID}-01')
+
+    span = asyncio.run(start())
+    tracer.shutdown()
+    assert span.trace_id == TRACE_ID and span.parent_id == PARENT_ID
+    assert span.recording is False
+
+
+def test_log_records_carry_the_current_trace():
+    tracer = Tracer()
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    handler.addFilter(TraceContextFilter())
+    log = logging.getLogger('test_tracing')
+    log.addHandler(handler)
+
+    async def app(scope, receive, send):
+        log.warning("inside the request")
+        await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=TracingMiddleware(app, tracer))
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+            await client.get('/', headers={'traceparent': f'00-{TRACE_ID}-{PARENT_ID}-01'})
+
+    try:
+        asyncio.run(scenario())
+        log.warning("outside any request")
+    finally:
+        log.removeHandler(handler)
+    assert records[0].trace_id == TRACE_ID
+    assert records[0].trace.startswith(f" trace_id={TRACE_ID} span_id=")
+    assert records[1].trace_id == '' and records[1].trace == ''
+
+
+def test_otlp_payload_shape():
+    tracer = Tracer(BatchSpanProcessor(FileSpanExporter('/dev/null')))
+    exporter = OTLPHttpExporter(service_name='proxy-test')
+
+    async def make_span():
+        root = tracer.start_span('POST /api/chat', traceparent=f'00-{TRACE_ID}-{PARENT_ID}-01')
+        root.set_attributes({'http.response.status_code': 200, 'cached': False, 'ratio': 0.5, 'route': '/api/chat'})
+        root.end()
+        return root
+
+    span = asyncio.run(make_span())
+    payload = exporter.payload([span])
+    exporter.shutdown()
+    tracer.shutdown()
+    resource = payload['resourceSpans'][0]
+    assert resource['resource']['attributes'] == [{'key': 'service.name', 'value': {'stringValue': 'proxy-test'}}]
+    [otlp_span] = resource['scopeSpans'][0]['spans']
+    assert otlp_span['traceId'] == TRACE_ID and otlp_span['parentSpanId'] == PARENT_ID
+    assert int(otlp_span['endTimeUnixNano']) >= int(otlp_span['startTimeUnixNano'])
+    values = {attribute['key']: attribute['value'] for attribute in otlp_span['attributes']}
+    assert values == {
+        'http.response.status_code': {'intValue': '200'},
+        'cached': {'boolValue': False},
+        'ratio': {'doubleValue': 0.5},
+        'route': {'stringValue': '/api/chat'},
+    }
@@ -0,0 +1,109 @@
+import asyncio
+
+import httpx
+import pytest
+
+import server
+from upstream_scheduler import FairScheduler, QueueTimeout
+
+
+class FakeUpstream:
+    """Fixed-latency upstream that tracks concurrency and completion order"""
+
+    def __init__(self, latency=0.01):
+        self.latency = latency
+        self.in_flight = 0
+        self.peak = 0
+        self.completed = []
+
+    async def call(self, scheduler, user_id, cost=1, key='sk-shared'):
+        async with scheduler.slot(key, user_id, cost):
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+            await asyncio.sleep(self.latency)
+            self.in_flight -= 1
+            self.completed.append(user_id)
+
+
+def test_light_user_is_not_starved_by_heavy_backlog():
+    upstream = FakeUpstream()
+
+    async def scenario():
+        scheduler = FairScheduler(max_concurrency=2, quantum=1)
+        heavy = [asyncio.create_task(upstream.call(scheduler, 'heavy')) for _ in range(30)]
+        await asyncio.sleep(0)
+        light = [asyncio.create_task(upstream.call(scheduler, 'light')) for _ in range(3)]
+        await asyncio.gather(*heavy, *light)
+        return scheduler
+
+    scheduler = asyncio.run(scenario())
+    assert upstream.peak == 2
+    # FIFO would finish the light user last; round-robin interleaves it
+    light_positions = [i for i, user in enumerate(upstream.completed) if user == 'light']
+    assert light_positions[-1] < 10
+    assert scheduler.stats() == {}
+
+
+def test_token_cost_shares_slots_by_quantum():
+    upstream = FakeUpstream(latency=0.005)
+
+    async def scenario():
+        scheduler = FairScheduler(max_concurrency=1, quantum=1000)
+        tasks = [asyncio.create_task(upstream.call(scheduler, 'long', cost=1000)) for _ in range(5)]
+        tasks += [asyncio.create_task(upstream.call(scheduler, 'short', cost=250)) for _ in range(20)]
+        await asyncio.gather(*tasks)
+
+    asyncio.run(scenario())
+    # While both are backlogged, each long prompt is matched by four short ones
+    window = upstream.completed[1:21]
+    assert window.count('long') == 4 and window.count('short') == 16
+
+
+def test_keys_are_limited_independently_and_timeouts_free_the_queue():
+    upstream = FakeUpstream(latency=0.05)
+
+    async def scenario():
+        scheduler = FairScheduler(max_concurrency=1, queue_timeout=0.01)
+        first = asyncio.create_task(upstream.call(scheduler, 'a', key='sk-one'))
+        other_key = asyncio.create_task(upstream.call(scheduler, 'b', key='sk-two'))
+        await asyncio.sleep(0)
+        with pytest.raises(QueueTimeout):
+            await upstream.call(scheduler, 'c', key='sk-one')
+        await asyncio.gather(first, other_key)
+        return scheduler
+
+    scheduler = asyncio.run(scenario())
+    assert upstream.peak == 2
+    assert sorted(upstream.completed) == ['a', 'b']
+    assert scheduler.stats() == {}
+
+
+def test_chat_requests_share_the_per_key_cap(mongo, fake_openai, create_user, monkeypatch):
+    monkeypatch.setattr(server, 'OPENAI_API_KEY', 'sk-test')
+    monkeypatch.setattr(server, 'upstream_scheduler', FairScheduler(max_concurrency=2))
+    fake_openai.delay = 0.02
+    concurrency = {'now': 0, 'peak': 0}
+    create = fake_openai.create
+
+    async def tracked_create(**kwargs):
+        concurrency['now'] += 1
+        concurrency['peak'] = max(concurrency['peak'], concurrency['now'])
+        try:
+            return await create(**kwargs)
+        finally:
+            concurrency['now'] -= 1
+
+    monkeypatch.setattr(fake_openai, 'create', tracked_create)
+
+    async def scenario():
+        tokens = [(await create_user(f'user{i}@test.com'))[1] for i in range(3)]
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+            return await asyncio.gather(*(
+                client.post('/api/chat', json={'message': f'hi {i}'}, headers={'Authorization': f'Bearer {token}'})
+                for i, token in enumerate(tokens * 2)
+            ))
+
+    responses = asyncio.run(scenario())
+    assert all(response.status_code == 200 for response in responses)
+    assert concurrency['peak'] == 2
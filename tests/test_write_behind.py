@@ -0,0 +1,164 @@
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+import httpx
+from bson import json_util
+from pymongo.errors import BulkWriteError
+
+import server
+from write_behind import WriteBehindQueue
+
+
+class FakeWriter:
+    """Records batches; fails while down and sleeps delay per batch"""
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.down = False
+        self.batches = []
+
+    async def __call__(self, docs):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if self.down:
+            raise ConnectionError('mongo unavailable')
+        self.batches.append([doc['n'] for doc in docs])
+
+    @property
+    def written(self):
+        return sorted(n for batch in self.batches for n in batch)
+
+
+def test_flushes_on_size_and_time():
+    writer = FakeWriter()
+
+    async def scenario():
+        queue = WriteBehindQueue(writer, batch_size=100, flush_interval=0.05)
+        queue.start()
+        for n in range(250):
+            await queue.put({'n': n})
+        await asyncio.sleep(0.02)
+        sized = [len(batch) for batch in writer.batches]
+        await asyncio.sleep(0.1)
+        await queue.stop()
+        return sized
+
+    sized = asyncio.run(scenario())
+    # Two full batches leave at once; the remainder waits for the interval
+    assert sized == [100, 100]
+    assert [len(batch) for batch in writer.batches] == [100, 100, 50]
+
+
+def test_backpressure_and_drain_lose_nothing():
+    writer = FakeWriter(delay=0.02)
+
+    async def scenario():
+        queue = WriteBehindQueue(writer, max_size=5, batch_size=5, flush_interval=0.01, put_timeout=0.01)
+        queue.start()
+        await asyncio.gather(*(queue.put({'n': n}) for n in range(40)))
+        await queue.stop()
+        return queue.stats()
+
+    stats = asyncio.run(scenario())
+    assert stats['direct_writes'] > 0
+    assert writer.written == list(range(40))
+
+
+def test_spills_while_mongo_is_down_and_replays(tmp_path):
+    writer = FakeWriter()
+    spill_path = str(tmp_path / 'spill')
+
+    async def scenario():
+        queue = WriteBehindQueue(writer, batch_size=10, flush_interval=0.01, spill_path=spill_path)
+        queue.start()
+        writer.down = True
+        for n in range(5):
+            await queue.put({'n': n})
+        await asyncio.sleep(0.05)
+        spilled_files = list(tmp_path.iterdir())
+        writer.down = False
+        await queue.put({'n': 5})
+        await asyncio.sleep(0.05)
+        await queue.stop()
+        return queue.stats(), spilled_files
+
+    stats, spilled_files = asyncio.run(scenario())
+    assert len(spilled_files) == 1
+    assert stats['spilled'] == 5 and stats['replayed'] == 5
+    assert writer.written == list(range(6))
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_rows_failing_a_bulk_write_are_spilled(tmp_path):
+    spill_path = str(tmp_path / 'spill')
+
+    async def partly_failing(docs):
+        raise BulkWriteError({'writeErrors': [
+            {'index': 0, 'code': 11000, 'errmsg': 'duplicate key'},
+            {'index': 2, 'code': 121, 'errmsg': 'document failed validation'}
+        ]})
+
+    async def scenario():
+        queue = WriteBehindQueue(partly_failing, spill_path=spill_path)
+        return queue, await queue._write_batch([{'n': n} for n in range(3)])
+
+    queue, ok = asyncio.run(scenario())
+    assert not ok
+    assert queue.written == 2 and queue.spilled == 1
+    [spill_file] = tmp_path.iterdir()
+    assert [json_util.loads(line)['n'] for line in spill_file.read_text().splitlines()] == [2]
+
+
+def test_replay_keeps_claims_until_written_and_recovers_abandoned_ones(tmp_path):
+    writer = FakeWriter()
+    spill_path = str(tmp_path / 'spill')
+    exited = subprocess.Popen([sys.executable, '-c', ''])
+    exited.wait()
+    # A replay that died mid-way in another process
+    abandoned = tmp_path / f'spill.{exited.pid}.jsonl.replaying.{exited.pid}'
+    abandoned.write_text(''.join(json_util.dumps({'n': n}) + '\n' for n in range(4)))
+
+    async def scenario():
+        queue = WriteBehindQueue(writer, batch_size=2, spill_path=spill_path)
+        writer.down = True
+        failed = await queue.replay_spill()
+        left = sorted(path.name for path in tmp_path.iterdir())
+        writer.down = False
+        replayed = await queue.replay_spill()
+        return failed, left, replayed
+
+    failed, left, replayed = asyncio.run(scenario())
+    # The first batch failed; every record went back to this process's spill file
+    assert failed == 0 and left == [f'spill.{os.getpid()}.jsonl']
+    assert replayed == 4 and writer.written == [0, 1, 2, 3]
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_chat_returns_without_waiting_for_history_write(mongo, fake_openai, create_user, monkeypatch):
+    monkeypatch.setattr(server, 'OPENAI_API_KEY', 'sk-test')
+
+    async def slow_insert(docs):
+        await asyncio.sleep(0.3)
+        await mongo.chats.insert_many(docs)
+
+    async def scenario():
+        queue = WriteBehindQueue(slow_insert, flush_interval=0.01)
+        monkeypatch.setattr(server, 'chat_writer', queue)
+        queue.start()
+        user, token = await create_user()
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+            start = time.perf_counter()
+            response = await client.post('/api/chat', json={'message': 'hi'},
+                                         headers={'Authorization': f'Bearer {token}'})
+            elapsed = time.perf_counter() - start
+        await queue.stop()
+        return response, elapsed, await mongo.chats.count_documents({'user_id': user['user_id']})
+
+    response, elapsed, stored = asyncio.run(scenario())
+    assert response.status_code == 200
+    assert elapsed < 0.25
+    assert stored == 1